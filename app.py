@@ -8,12 +8,32 @@ Maison Amarante - API v4
 """
 
 import os
+import io
 import json
+import time
+import hashlib
+import sqlite3
+import tempfile
+import atexit
+import fcntl
+import functools
+import threading
+import copy
+import pickle
+import multiprocessing
+import concurrent.futures
+import heapq
+import base64
+import re
+import unicodedata
 import requests as req
-from flask import Flask, request, jsonify, send_from_directory
+import numpy as np
+import segno
+from flask import Flask, request, jsonify, send_from_directory, send_file, make_response
 from flask_cors import CORS
-from datetime import datetime, timedelta
-from collections import defaultdict
+from PIL import Image, UnidentifiedImageError
+from datetime import datetime, timedelta, timezone
+from collections import defaultdict, OrderedDict
 
 app = Flask(__name__, static_folder='static')
 CORS(app)
@@ -23,6 +43,10 @@ CORS(app)
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
 AIRTABLE_API_KEY = os.environ.get("AIRTABLE_API_KEY")
 IMGBB_API_KEY = os.environ.get("IMGBB_API_KEY")
+
+# Stockage des photos: "local" (disque, adressé par contenu) ou "imgbb"
+IMAGE_STORAGE = os.environ.get("IMAGE_STORAGE", "local")
+PHOTOS_DIR = os.environ.get("PHOTOS_DIR", "/tmp/maison_amarante_photos")
 PENNYLANE_API_KEY = os.environ.get("PENNYLANE_API_KEY")
 
 # Maison Amarante DB (opérationnel)
@@ -35,9 +59,26 @@ AIRTABLE_LIVRAISONS_TABLE = os.environ.get("AIRTABLE_LIVRAISONS_TABLE", "tbltyDn
 SUIVI_BASE_ID = "appxlOtjRVYqbW85l"
 SUIVI_TABLE_ID = "tblkYF6GxgsrdgBRc"
 
+# Mode de synchronisation: "classique" (lecture complète puis création/mise à jour
+# une à une) ou "upsert" (performUpsert Airtable par lots de 10, sans lecture préalable)
+SYNC_MODE = os.environ.get("SYNC_MODE", "classique")
+
+# Écriture des coordonnées géocodées dans CLIENTS: nécessite les champs nombre
+# "Latitude" et "Longitude" dans la table (sinon Airtable rejette les écritures)
+CLIENTS_COORDONNEES = os.environ.get("CLIENTS_COORDONNEES", "").lower() in ("1", "true", "yes")
+
+# Colonnes CLIENTS écrites par la synchro Suivi → CLIENTS (seules lues en mode upsert)
+SYNC_CLIENTS_FIELDS = [
+    "Nom", "Actif", "ID_Pennylane", "Adresse", "Persona", "Fréquence", "Nb_Bouquets", "Pref_Couleurs",
+    "Pref_Style", "Tailles_Demandées", "Créneau_Préféré", "Notes_Spéciales",
+] + (["Latitude", "Longitude"] if CLIENTS_COORDONNEES else [])
+
 # Pennylane API base URL
 PENNYLANE_API_URL = "https://app.pennylane.com/api/external/v2"
 
+# URL publique de l'app (fiches bouquets, QR codes) - URL fixe Railway par défaut
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "https://web-production-37db3.up.railway.app")
+
 def extract_customer_name_from_label(label, filename=None):
     """Extrait le nom du client depuis le label ou filename Pennylane"""
     # Try label first (factures): "Facture NOM CLIENT - F-2026-xxx (label généré)"
@@ -386,8 +427,8 @@ def get_airtable_headers():
     }
 
 
-def get_suivi_cards():
-    """Récupère toutes les cards de Suivi Facturation"""
+def get_suivi_cards(formula: str = None):
+    """Récupère les cards de Suivi Facturation (toutes, ou celles qui vérifient `formula`)"""
     url = f"https://api.airtable.com/v0/{SUIVI_BASE_ID}/{SUIVI_TABLE_ID}"
     headers = get_airtable_headers()
     
@@ -396,6 +437,8 @@ def get_suivi_cards():
     
     while True:
         params = {"pageSize": 100}
+        if formula:
+            params["filterByFormula"] = formula
         if offset:
             params["offset"] = offset
         
@@ -441,8 +484,12 @@ def update_suivi_card(record_id: str, fields: dict) -> dict:
         return {"success": False, "error": response.text}
 
 
-def get_existing_clients():
-    """Récupère tous les clients existants dans Maison Amarante DB"""
+def get_existing_clients(fields: list = None):
+    """Récupère tous les clients existants dans Maison Amarante DB
+
+    Args:
+        fields: colonnes à lire (toutes par défaut)
+    """
     url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_CLIENTS_TABLE}"
     headers = get_airtable_headers()
     
@@ -451,6 +498,8 @@ def get_existing_clients():
     
     while True:
         params = {"pageSize": 100}
+        if fields:
+            params["fields[]"] = fields
         if offset:
             params["offset"] = offset
         
@@ -487,6 +536,7 @@ def create_client(fields: dict) -> dict:
     
     response = req.post(url, headers=headers, json={"fields": fields})
     if response.status_code == 200:
+        invalidate_tour_plan()
         return {"success": True, "record": response.json()}
     else:
         print(f"[CLIENTS] Create error: {response.text}")
@@ -500,12 +550,92 @@ def update_client(record_id: str, fields: dict) -> dict:
     
     response = req.patch(url, headers=headers, json={"fields": fields})
     if response.status_code == 200:
+        invalidate_tour_plan()
         return {"success": True, "record": response.json()}
     else:
         print(f"[CLIENTS] Update error: {response.text}")
         return {"success": False, "error": response.text}
 
 
+UPSERT_RETRIES = 3
+
+
+def airtable_upsert(base_id: str, table_id: str, fields_list: list, merge_on: str,
+                    create_only: list = None) -> dict:
+    """Crée ou met à jour des enregistrements par lots de 10 (performUpsert sur `merge_on`).
+
+    `create_only` (un dict de champs par enregistrement, aligné sur `fields_list`)
+    n'est écrit que sur les enregistrements nouvellement créés, par un PATCH groupé
+    supplémentaire: un enregistrement existant garde par exemple son statut.
+    Ce PATCH est retenté (UPSERT_RETRIES essais); s'il échoue encore, les ids
+    concernés sont rapportés dans "incomplete_ids" et dans les erreurs.
+
+    Retourne {"records": [enregistrement ou None, aligné sur fields_list],
+              "created_ids": set(ids créés), "incomplete_ids": [...], "errors": [...]}
+    """
+    url = f"https://api.airtable.com/v0/{base_id}/{table_id}"
+    headers = get_airtable_headers()
+    results = {"records": [None] * len(fields_list), "created_ids": set(), "incomplete_ids": [], "errors": []}
+
+    for i in range(0, len(fields_list), 10):
+        response = req.patch(url, headers=headers, json={
+            "performUpsert": {"fieldsToMergeOn": [merge_on]},
+            "records": [{"fields": fields} for fields in fields_list[i:i + 10]]
+        })
+        if response.status_code != 200:
+            print(f"[UPSERT] Error ({table_id}): {response.text}")
+            results["errors"].append(response.text)
+            continue
+
+        data = response.json()
+        records = data.get("records", [])
+        results["records"][i:i + len(records)] = records
+        created = set(data.get("createdRecords", []))
+        results["created_ids"] |= created
+
+        extra = [{"id": record["id"], "fields": create_only[i + j]} for j, record in enumerate(records)
+                 if create_only and record["id"] in created and create_only[i + j]]
+        for attempt in range(UPSERT_RETRIES if extra else 0):
+            response = req.patch(url, headers=headers, json={"records": extra})
+            if response.status_code == 200:
+                break
+            print(f"[UPSERT] Create-only fields error ({table_id}, essai {attempt + 1}): {response.text}")
+            if attempt + 1 < UPSERT_RETRIES:
+                time.sleep(attempt + 1)
+        else:
+            if extra:
+                ids = [record["id"] for record in extra]
+                results["incomplete_ids"].extend(ids)
+                results["errors"].append(f"Champs de création non écrits pour {', '.join(ids)}: {response.text}")
+
+    return results
+
+
+def _formula_string(value: str) -> str:
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def airtable_update_batch(base_id: str, table_id: str, updates: list) -> dict:
+    """Met à jour des enregistrements par lots de 10. `updates`: [(record_id, champs), ...]
+
+    Retourne {"updated_ids": set(ids mis à jour), "errors": [...]}
+    """
+    url = f"https://api.airtable.com/v0/{base_id}/{table_id}"
+    headers = get_airtable_headers()
+    results = {"updated_ids": set(), "errors": []}
+
+    for i in range(0, len(updates), 10):
+        response = req.patch(url, headers=headers, json={
+            "records": [{"id": record_id, "fields": fields} for record_id, fields in updates[i:i + 10]]
+        })
+        if response.status_code == 200:
+            results["updated_ids"] |= {record["id"] for record in response.json().get("records", [])}
+        else:
+            print(f"[AIRTABLE] Batch update error ({table_id}): {response.text}")
+            results["errors"].append(response.text)
+    return results
+
+
 def get_livraisons():
     """Récupère toutes les livraisons"""
     url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_LIVRAISONS_TABLE}"
@@ -541,6 +671,7 @@ def create_livraison(fields: dict) -> dict:
     
     response = req.post(url, headers=headers, json={"fields": fields})
     if response.status_code == 200:
+        record_livraisons([response.json()])
         return {"success": True, "record": response.json()}
     else:
         print(f"[LIVRAISONS] Create error: {response.text}")
@@ -554,12 +685,314 @@ def update_livraison(record_id: str, fields: dict) -> dict:
     
     response = req.patch(url, headers=headers, json={"fields": fields})
     if response.status_code == 200:
+        record_livraisons([response.json()])
         return {"success": True, "record": response.json()}
     else:
         print(f"[LIVRAISONS] Update error: {response.text}")
         return {"success": False, "error": response.text}
 
 
+# ==================== ÉTAT LOCAL (SQLite) ====================
+
+# Base SQLite locale partagée par tous les workers gunicorn de la machine.
+# Pointer STATE_DB_PATH vers un volume persistant pour survivre aux redéploiements.
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "/tmp/maison_amarante_state.db")
+
+STATE_DB_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS sequences (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+]
+
+_state_db_ready = False
+
+
+def get_state_db():
+    """Ouvre une connexion sur la base d'état locale (autocommit, mode WAL)"""
+    global _state_db_ready
+    conn = sqlite3.connect(STATE_DB_PATH, timeout=30, isolation_level=None)
+    if not _state_db_ready:
+        conn.execute("PRAGMA journal_mode=WAL")
+        for statement in STATE_DB_SCHEMA:
+            conn.execute(statement)
+        _state_db_ready = True
+    return conn
+
+
+def reserve_sequence(name: str, count: int = 1, seed=None) -> int:
+    """Réserve `count` valeurs consécutives d'une séquence et retourne la première.
+
+    L'incrément se fait dans une transaction BEGIN IMMEDIATE : deux workers ne
+    peuvent jamais obtenir la même valeur. `seed` (optionnel) est appelé une seule
+    fois, quand la séquence n'existe pas encore, pour fournir sa valeur de départ.
+    """
+    conn = get_state_db()
+    try:
+        if seed and conn.execute("SELECT 1 FROM sequences WHERE name = ?", (name,)).fetchone() is None:
+            # Amorçage hors verrou (peut être lent), le premier worker qui écrit gagne
+            conn.execute("INSERT OR IGNORE INTO sequences (name, value) VALUES (?, ?)", (name, int(seed())))
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM sequences WHERE name = ?", (name,)).fetchone()
+            current = row[0] if row else 0
+            conn.execute("INSERT OR REPLACE INTO sequences (name, value) VALUES (?, ?)", (name, current + count))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+    return current + 1
+
+
+# ==================== COMPTEURS LIVRAISONS ====================
+
+# Compteurs matérialisés par mois (Date de la livraison, à défaut date de création),
+# type et statut. Mis à jour à chaque création / changement de statut passant par
+# l'API, réconciliés avec Airtable par la synchronisation complète.
+
+STATE_DB_SCHEMA.extend([
+    "CREATE TABLE IF NOT EXISTS livraisons_index ("
+    "id TEXT PRIMARY KEY, mois TEXT NOT NULL, type TEXT NOT NULL, statut TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS livraisons_compteurs ("
+    "mois TEXT NOT NULL, type TEXT NOT NULL, statut TEXT NOT NULL, nombre INTEGER NOT NULL, "
+    "PRIMARY KEY (mois, type, statut))",
+    "CREATE TABLE IF NOT EXISTS livraisons_reconciliation (id INTEGER PRIMARY KEY CHECK (id = 1), "
+    "livraisons INTEGER NOT NULL, reconciled_at TEXT NOT NULL)",
+])
+
+
+def livraison_counter_key(record: dict):
+    """(mois "YYYY-MM", type, statut) d'un enregistrement livraison, None sans date"""
+    fields = record.get("fields", {})
+    date = parse_livraison_date(fields.get("Date") or record.get("createdTime"))
+    if date is None:
+        return None
+    return date.strftime("%Y-%m"), fields.get("Type", ""), fields.get("Statut", "")
+
+
+def record_livraisons(records: list):
+    """Reporte dans les compteurs des livraisons créées ou modifiées (enregistrements Airtable).
+
+    L'index par livraison permet de retirer l'ancienne clé (mois, type, statut)
+    avant d'ajouter la nouvelle: un changement de statut déplace la livraison
+    d'un compteur à l'autre sans jamais la compter deux fois.
+    """
+    rows = [(record["id"], livraison_counter_key(record)) for record in records if record.get("id")]
+    if not rows:
+        return
+    conn = get_state_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for record_id, key in rows:
+                old = conn.execute(
+                    "SELECT mois, type, statut FROM livraisons_index WHERE id = ?", (record_id,)
+                ).fetchone()
+                if old == key:
+                    continue
+                if old:
+                    conn.execute(
+                        "UPDATE livraisons_compteurs SET nombre = nombre - 1 WHERE mois = ? AND type = ? AND statut = ?",
+                        old
+                    )
+                    conn.execute("DELETE FROM livraisons_index WHERE id = ?", (record_id,))
+                if key:
+                    conn.execute("INSERT INTO livraisons_index (id, mois, type, statut) VALUES (?, ?, ?, ?)",
+                                 (record_id, *key))
+                    conn.execute(
+                        "INSERT INTO livraisons_compteurs (mois, type, statut, nombre) VALUES (?, ?, ?, 1) "
+                        "ON CONFLICT (mois, type, statut) DO UPDATE SET nombre = nombre + 1",
+                        key
+                    )
+            conn.execute("DELETE FROM livraisons_compteurs WHERE nombre <= 0")
+            conn.execute("COMMIT")
+            invalidate_tour_plan()  # les clients dus dépendent des livraisons
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    except sqlite3.Error as e:
+        # Les compteurs seront corrigés à la prochaine réconciliation
+        print(f"[COMPTEURS] Erreur mise à jour: {e}")
+    finally:
+        conn.close()
+
+
+def reconcile_livraison_counters(livraisons: list = None) -> dict:
+    """Reconstruit index et compteurs à partir de toutes les livraisons Airtable"""
+    if livraisons is None:
+        livraisons = get_livraisons()
+    rows = [(liv["id"], *key) for liv in livraisons for key in [livraison_counter_key(liv)] if key]
+
+    conn = get_state_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM livraisons_index")
+            conn.execute("DELETE FROM livraisons_compteurs")
+            conn.executemany("INSERT INTO livraisons_index (id, mois, type, statut) VALUES (?, ?, ?, ?)", rows)
+            conn.execute(
+                "INSERT INTO livraisons_compteurs (mois, type, statut, nombre) "
+                "SELECT mois, type, statut, COUNT(*) FROM livraisons_index GROUP BY mois, type, statut"
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO livraisons_reconciliation (id, livraisons, reconciled_at) VALUES (1, ?, ?)",
+                (len(rows), datetime.now(timezone.utc).isoformat())
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        nb_mois = conn.execute("SELECT COUNT(DISTINCT mois) FROM livraisons_compteurs").fetchone()[0]
+    finally:
+        conn.close()
+
+    print(f"[COMPTEURS] Réconciliation: {len(rows)} livraisons sur {nb_mois} mois")
+    return {"livraisons": len(rows), "mois": nb_mois}
+
+
+def get_livraison_counts(depuis: str = None) -> dict:
+    """Compteurs par mois ("YYYY-MM" ≥ `depuis`): {mois: {"total", "par_type", "par_statut"}}
+
+    Au tout premier appel (base vide, jamais réconciliée), les compteurs sont
+    construits depuis Airtable.
+    """
+    conn = get_state_db()
+    try:
+        if conn.execute("SELECT 1 FROM livraisons_reconciliation").fetchone() is None:
+            conn.close()
+            reconcile_livraison_counters()
+            conn = get_state_db()
+        rows = conn.execute(
+            "SELECT mois, type, statut, nombre FROM livraisons_compteurs WHERE mois >= ? ORDER BY mois",
+            (depuis or "",)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    counts = {}
+    for mois, type_, statut, nombre in rows:
+        month = counts.setdefault(mois, {"total": 0, "par_type": defaultdict(int), "par_statut": defaultdict(int)})
+        month["total"] += nombre
+        month["par_type"][type_ or "Non renseigné"] += nombre
+        month["par_statut"][statut or "Non renseigné"] += nombre
+    return {
+        mois: {"total": c["total"], "par_type": dict(c["par_type"]), "par_statut": dict(c["par_statut"])}
+        for mois, c in counts.items()
+    }
+
+
+# ==================== CACHES MÉMOIRE ====================
+
+# Petits caches LRU en mémoire (OrderedDict) partagés par les threads d'un worker.
+# Les valeurs sont copiées à l'entrée et à la sortie: un appelant qui modifie
+# le résultat ne modifie pas le cache.
+_memo_lock = threading.Lock()
+
+
+def memo_get(cache: OrderedDict, key):
+    """(copie de la valeur, instant de mise en cache) ou None si absente"""
+    with _memo_lock:
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        cache.move_to_end(key)
+    return copy.deepcopy(entry[0]), entry[1]
+
+
+def memo_put(cache: OrderedDict, key, value, max_size: int):
+    """Mémorise une copie de `value` et évince les entrées les moins récemment utilisées"""
+    entry = (copy.deepcopy(value), time.time())
+    with _memo_lock:
+        cache[key] = entry
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+
+
+def memo_pop(cache: OrderedDict, key):
+    with _memo_lock:
+        cache.pop(key, None)
+
+
+# ==================== CALCULS DE PLANIFICATION ====================
+
+# Les calculs lourds (construction des tournées, assignation des bouquets,
+# greffes, mini-tournées) tournent dans un pool de processus dédié: le worker
+# web attend le résultat sans bloquer ses autres threads (santé, QR, photos).
+# PLANNING_WORKERS=0 exécute les calculs directement dans le worker.
+PLANNING_WORKERS = int(os.environ.get("PLANNING_WORKERS", 2))
+PLANNING_TIMEOUT = float(os.environ.get("PLANNING_TIMEOUT", 60))  # secondes
+PLANNING_CACHE_SIZE = 32
+
+_planning_pool = None
+_planning_pool_lock = threading.Lock()
+_planning_results = OrderedDict()  # (fonction, empreinte des arguments) → résultat
+
+
+def get_planning_pool():
+    """Pool de processus des calculs de planification (créé au premier usage)"""
+    global _planning_pool
+    with _planning_pool_lock:
+        if _planning_pool is None and PLANNING_WORKERS > 0:
+            _planning_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=PLANNING_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _planning_pool
+
+
+def _reset_planning_pool():
+    global _planning_pool
+    with _planning_pool_lock:
+        if _planning_pool is not None:
+            _planning_pool.shutdown(wait=False, cancel_futures=True)
+        _planning_pool = None
+
+
+def run_planning_task(fn, *args, timeout: float = None, **kwargs):
+    """Exécute `fn(*args, **kwargs)` dans le pool de planification et attend le résultat.
+
+    Les résultats sont mémorisés par empreinte des arguments (LRU de
+    PLANNING_CACHE_SIZE entrées, l'appelant reçoit toujours sa propre copie). Au-delà de `timeout` secondes (PLANNING_TIMEOUT par défaut), lève
+    TimeoutError. Si le pool est cassé (processus tué), il est recréé et le
+    calcul est fait sur place.
+    """
+    timeout = timeout or PLANNING_TIMEOUT
+    try:
+        key = (fn.__name__, hashlib.sha1(pickle.dumps((args, sorted(kwargs.items())))).hexdigest())
+    except (pickle.PicklingError, TypeError, AttributeError):
+        key = None
+    cached = memo_get(_planning_results, key) if key is not None else None
+    if cached is not None:
+        return cached[0]
+
+    pool = get_planning_pool()
+    start = time.monotonic()
+    if pool is None:
+        result = fn(*args, **kwargs)
+    else:
+        future = pool.submit(fn, *args, **kwargs)
+        try:
+            result = future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            # Un calcul déjà démarré ne peut pas être interrompu: il occupe son processus jusqu'au bout
+            if future.cancel():
+                print(f"[PLANNING] {fn.__name__} annulé (toujours en file après {timeout:g}s)")
+            else:
+                print(f"[PLANNING] {fn.__name__} abandonné après {timeout:g}s (le calcul continue dans le pool)")
+            raise TimeoutError(f"Calcul de planification trop long ({fn.__name__}, > {timeout:g}s)")
+        except concurrent.futures.process.BrokenProcessPool:
+            print(f"[PLANNING] Pool cassé, {fn.__name__} exécuté sur place")
+            _reset_planning_pool()
+            result = fn(*args, **kwargs)
+    print(f"[PLANNING] {fn.__name__} en {time.monotonic() - start:.2f}s")
+
+    if key is not None:
+        memo_put(_planning_results, key, result, PLANNING_CACHE_SIZE)
+    return result
+
+
 # ==================== CLAUDE HELPERS ====================
 
 def parse_all_clients_notes_with_claude(clients_data: list) -> dict:
@@ -686,20 +1119,30 @@ IMPORTANT: Utilise le NOM EXACT après ### comme clé JSON (ex: si "### FAKE Hô
 
 # ==================== SYNC LOGIC ====================
 
-def sync_pennylane_to_suivi():
-    """Synchronise Pennylane → Suivi Facturation"""
+def sync_pennylane_to_suivi(mode: str = None):
+    """Synchronise Pennylane → Suivi Facturation
+
+    Args:
+        mode: "classique" (lecture des cards existantes, création des manquantes)
+              ou "upsert" (performUpsert sur "ID Pennylane", sans lecture préalable;
+              les champs ne sont écrits qu'à la création, les cards existantes ne
+              sont pas modifiées, sauf celles restées sans Nom du Client ou Statut,
+              complétées). Défaut: SYNC_MODE
+    """
+    upsert = (mode or SYNC_MODE) == "upsert"
     results = {
         "quotes_synced": 0,
         "invoices_synced": 0,
         "subscriptions_synced": 0,
+        "cards_unchanged": 0,
         "errors": [],
         "details": []
     }
 
-    # Récupérer les cards existantes
-    existing_cards = get_suivi_cards()
+    # Récupérer les cards existantes (inutile en mode upsert)
     existing_by_pennylane_id = {}
-    for card in existing_cards:
+    pending = []  # mode upsert: (compteur, détail, champs)
+    for card in ([] if upsert else get_suivi_cards()):
         pid = card.get("fields", {}).get("ID Pennylane", "")
         if pid:
             existing_by_pennylane_id[str(pid)] = card
@@ -742,6 +1185,10 @@ def sync_pennylane_to_suivi():
             if customer_address:
                 card_fields["Adresse"] = customer_address
 
+            if upsert:
+                pending.append(("quotes_synced", f"📋 Devis ajouté: {customer_name}", card_fields))
+                continue
+
             result = create_suivi_card(card_fields)
             if result["success"]:
                 results["quotes_synced"] += 1
@@ -780,6 +1227,10 @@ def sync_pennylane_to_suivi():
             if customer_address:
                 card_fields["Adresse"] = customer_address
 
+            if upsert:
+                pending.append(("invoices_synced", f"🧾 Facture ajoutée: {customer_name}", card_fields))
+                continue
+
             result = create_suivi_card(card_fields)
             if result["success"]:
                 results["invoices_synced"] += 1
@@ -816,23 +1267,105 @@ def sync_pennylane_to_suivi():
             if customer_address:
                 card_fields["Adresse"] = customer_address
 
+            if upsert:
+                pending.append(("subscriptions_synced", f"🔄 Abonnement ajouté: {customer_name}", card_fields))
+                continue
+
             result = create_suivi_card(card_fields)
             if result["success"]:
                 results["subscriptions_synced"] += 1
                 results["details"].append(f"🔄 Abonnement ajouté: {customer_name}")
 
+    if pending:
+        # Une même ID Pennylane ne peut apparaître qu'une fois par requête d'upsert
+        seen = set()
+        pending = [p for p in pending if not (p[2]["ID Pennylane"] in seen or seen.add(p[2]["ID Pennylane"]))]
+
+        # Cards restées vides (écriture des champs de création échouée lors d'une
+        # synchro précédente): l'upsert les voit comme existantes, on les complète ici
+        fields_by_id = {fields["ID Pennylane"]: fields for _, _, fields in pending}
+        repairs = []
+        for card in get_suivi_cards(formula="AND({ID Pennylane} != '', OR({Nom du Client} = '', {Statut} = ''))"):
+            current = card.get("fields", {})
+            desired = fields_by_id.get(str(current.get("ID Pennylane", "")))
+            if desired:
+                repairs.append((card["id"], {k: v for k, v in desired.items()
+                                             if k != "ID Pennylane" and current.get(k) in (None, "")}))
+        if repairs:
+            outcome = airtable_update_batch(SUIVI_BASE_ID, SUIVI_TABLE_ID, repairs)
+            results["cards_completed"] = len(outcome["updated_ids"])
+            results["errors"].extend(outcome["errors"])
+            results["details"].extend(f"🩹 Card complétée: {fields['Nom du Client']}"
+                                      for record_id, fields in repairs
+                                      if record_id in outcome["updated_ids"] and fields.get("Nom du Client"))
+        # Seule la clé de fusion est envoyée: une card existante n'est jamais modifiée
+        # (comme en mode classique), tous les champs Pennylane sont réservés à la création
+        outcome = airtable_upsert(
+            SUIVI_BASE_ID, SUIVI_TABLE_ID,
+            [{"ID Pennylane": fields["ID Pennylane"]} for _, _, fields in pending],
+            "ID Pennylane",
+            create_only=[{k: v for k, v in fields.items() if k != "ID Pennylane"} for _, _, fields in pending]
+        )
+        for (counter, detail, _), record in zip(pending, outcome["records"]):
+            if record is None:
+                continue
+            if record["id"] in outcome["created_ids"]:
+                results[counter] += 1
+                results["details"].append(detail)
+            else:
+                results["cards_unchanged"] += 1
+        results["errors"].extend(outcome["errors"])
+        results.setdefault("incomplete_ids", []).extend(outcome["incomplete_ids"])
+
     return results
 
 
-def sync_suivi_to_clients(skip_parsing=False):
+def _same_field_value(current, desired) -> bool:
+    """Compare une valeur Airtable et la valeur voulue (Airtable omet les champs vides et les cases décochées)"""
+    if current in (None, "", False, []) and desired in (None, "", False, []):
+        return True
+    if isinstance(current, (int, float)) and isinstance(desired, (int, float)) \
+            and not isinstance(current, bool) and not isinstance(desired, bool):
+        return abs(current - desired) < 1e-6
+    if isinstance(current, bool) or isinstance(desired, bool):
+        return bool(current) == bool(desired)
+    return str(current).strip() == str(desired).strip()
+
+
+def diff_fields(current: dict, desired: dict) -> dict:
+    """Sous-ensemble de `desired` qui diffère des champs actuels d'un enregistrement"""
+    return {key: value for key, value in desired.items() if not _same_field_value(current.get(key), value)}
+
+
+def _create_first_livraison(record_id: str, statut: str, client_name: str, results: dict):
+    """Crée la première livraison d'un nouveau client (statut "À livrer" ou "Essai gratuit")"""
+    if statut in ["À livrer", "Essai gratuit"]:
+        livraison_type = "Essai gratuit" if statut == "Essai gratuit" else "One-shot"
+        liv_result = create_livraison({
+            "Client": [record_id],
+            "Statut": "À planifier",
+            "Type": livraison_type
+        })
+        if liv_result["success"]:
+            results["livraisons_created"] += 1
+            results["details"].append(f"📦 Livraison créée pour: {client_name}")
+
+
+def sync_suivi_to_clients(skip_parsing=False, mode: str = None):
     """Synchronise Suivi Facturation → Maison Amarante DB (CLIENTS)
 
     Args:
         skip_parsing: Si True, ne fait pas le parsing Claude (plus rapide)
+        mode: "classique" (lecture de tous les clients, envoi des seuls champs modifiés)
+              ou "upsert" (lecture des seules colonnes synchronisées, envoi des seuls
+              champs modifiés par lots de 10, création par performUpsert sur ID_Pennylane,
+              ou Nom à défaut). Défaut: SYNC_MODE
     """
+    upsert = (mode or SYNC_MODE) == "upsert"
     results = {
         "clients_created": 0,
         "clients_updated": 0,
+        "clients_unchanged": 0,
         "clients_deactivated": 0,
         "livraisons_created": 0,
         "notes_parsed": 0,
@@ -841,7 +1374,10 @@ def sync_suivi_to_clients(skip_parsing=False):
     }
 
     cards = get_suivi_cards()
-    clients_by_name, clients_by_pennylane, _ = get_existing_clients()
+    # Mode upsert: une seule lecture paginée, limitée aux colonnes comparées
+    clients_by_name, clients_by_pennylane, _ = get_existing_clients(fields=SYNC_CLIENTS_FIELDS if upsert else None)
+    pending = []  # mode upsert: (card_info, champs) des clients à créer
+    updates = []  # mode upsert: (card_info, record_id, champs modifiés)
 
     active_statuts = ["Factures", "Abonnements", "Essai gratuit", "À livrer"]
     inactive_statuts = ["Archives", "Abonnement arrêté", "Avoirs"]
@@ -901,9 +1437,13 @@ def sync_suivi_to_clients(skip_parsing=False):
         if pennylane_id:
             client_fields["ID_Pennylane"] = pennylane_id
 
-        # Copier l'adresse directement (pas de parsing)
+        # Copier l'adresse directement (pas de parsing) et la géocoder
         if adresse:
             client_fields["Adresse"] = adresse
+            geocode = geocode_address(adresse) if CLIENTS_COORDONNEES else None
+            if geocode:
+                client_fields["Latitude"] = geocode["lat"]
+                client_fields["Longitude"] = geocode["lon"]
 
         # Ajouter les infos parsées par Claude
         if parsed.get("persona"):
@@ -933,9 +1473,21 @@ def sync_suivi_to_clients(skip_parsing=False):
         if parsed.get("instructions_speciales"):
             client_fields["Notes_Spéciales"] = parsed["instructions_speciales"]
 
+        if upsert and not existing_client:
+            pending.append((card_info, client_fields))
+            continue
+
         if existing_client:
             record_id = existing_client["id"]
-            result = update_client(record_id, client_fields)
+            # N'envoyer que les champs modifiés (aucune requête si rien n'a changé)
+            changes = diff_fields(existing_client.get("fields", {}), client_fields)
+            if not changes:
+                results["clients_unchanged"] += 1
+                continue
+            if upsert:
+                updates.append((card_info, record_id, changes))
+                continue
+            result = update_client(record_id, changes)
             if result["success"]:
                 results["clients_updated"] += 1
                 results["details"].append(f"✏️ Client mis à jour: {client_name}")
@@ -955,16 +1507,52 @@ def sync_suivi_to_clients(skip_parsing=False):
                 continue
             
             # Créer une livraison si statut "À livrer" ou "Essai gratuit"
-            if statut in ["À livrer", "Essai gratuit"]:
-                livraison_type = "Essai gratuit" if statut == "Essai gratuit" else "One-shot"
-                liv_result = create_livraison({
-                    "Client": [record_id],
-                    "Statut": "À planifier",
-                    "Type": livraison_type
-                })
-                if liv_result["success"]:
-                    results["livraisons_created"] += 1
-                    results["details"].append(f"📦 Livraison créée pour: {client_name}")
+            _create_first_livraison(record_id, statut, client_name, results)
+
+    # 3 bis. Mode upsert: les clients existants ne reçoivent que leurs champs modifiés, par lots
+    # de 10; les nouveaux sont créés par upsert (fusion sur ID_Pennylane, sinon sur Nom)
+    if updates:
+        outcome = airtable_update_batch(AIRTABLE_BASE_ID, AIRTABLE_CLIENTS_TABLE,
+                                        [(record_id, changes) for _, record_id, changes in updates])
+        invalidate_tour_plan()
+        results["errors"].extend(outcome["errors"])
+        for card_info, record_id, _ in updates:
+            if record_id in outcome["updated_ids"]:
+                results["clients_updated"] += 1
+                results["details"].append(f"✏️ Client mis à jour: {card_info['client_name']}")
+
+    for merge_on in ("ID_Pennylane", "Nom"):
+        group, seen = [], set()
+        for card_info, client_fields in pending:
+            if ("ID_Pennylane" in client_fields) != (merge_on == "ID_Pennylane"):
+                continue
+            key = client_fields[merge_on]
+            if key in seen:
+                continue
+            seen.add(key)
+            group.append((card_info, client_fields))
+        if not group:
+            continue
+
+        outcome = airtable_upsert(
+            AIRTABLE_BASE_ID, AIRTABLE_CLIENTS_TABLE, [fields for _, fields in group], merge_on,
+            create_only=[{key: value for key, value in (("Fréquence", "Mensuel"), ("Nb_Bouquets", 1))
+                          if key not in fields} for _, fields in group]
+        )
+        invalidate_tour_plan()
+        results["errors"].extend(outcome["errors"])
+        results.setdefault("incomplete_ids", []).extend(outcome["incomplete_ids"])
+        for (card_info, _), record in zip(group, outcome["records"]):
+            client_name = card_info["client_name"]
+            if record is None:
+                results["errors"].append(f"Erreur upsert {client_name}")
+            elif record["id"] in outcome["created_ids"]:
+                results["clients_created"] += 1
+                results["details"].append(f"✅ Client créé: {client_name}")
+                _create_first_livraison(record["id"], card_info["statut"], client_name, results)
+            else:
+                results["clients_updated"] += 1
+                results["details"].append(f"✏️ Client mis à jour: {client_name}")
 
     # 4. Traiter les cartes inactives (désactiver les clients existants)
     for card in cards:
@@ -975,7 +1563,9 @@ def sync_suivi_to_clients(skip_parsing=False):
 
         if statut in inactive_statuts:
             existing_client = clients_by_pennylane.get(pennylane_id) or clients_by_name.get(client_name.upper())
-            if existing_client:
+            if existing_client and not existing_client.get("fields", {}).get("Actif", False):
+                results["clients_unchanged"] += 1
+            elif existing_client:
                 record_id = existing_client["id"]
                 result = update_client(record_id, {"Actif": False})
                 if result["success"]:
@@ -985,8 +1575,8 @@ def sync_suivi_to_clients(skip_parsing=False):
     return results
 
 
-def sync_all():
-    """Synchronisation complète"""
+def sync_all(mode: str = None):
+    """Synchronisation complète (mode: "classique" ou "upsert", défaut SYNC_MODE)"""
     results = {
         "pennylane": {},
         "clients": {},
@@ -994,283 +1584,1878 @@ def sync_all():
     }
     
     # 1. Sync Pennylane → Suivi Facturation
-    pennylane_results = sync_pennylane_to_suivi()
+    pennylane_results = sync_pennylane_to_suivi(mode)
     results["pennylane"] = pennylane_results
     results["total_details"].extend(pennylane_results.get("details", []))
     
     # 2. Sync Suivi Facturation → CLIENTS
-    clients_results = sync_suivi_to_clients()
+    clients_results = sync_suivi_to_clients(mode=mode)
     results["clients"] = clients_results
     results["total_details"].extend(clients_results.get("details", []))
+
+    # 3. Réconciliation des compteurs de livraisons (budget)
+    try:
+        results["livraisons"] = reconcile_livraison_counters()
+    except Exception as e:
+        print(f"[COMPTEURS] Erreur réconciliation: {e}")
+        results["livraisons"] = {"error": str(e)}
     
     return results
 
 
-# ==================== PLANNING TOURNÉES ====================
+# ==================== GÉOGRAPHIE & ROUTAGE ====================
 
-def extract_postal_code(address: str) -> str:
-    """Extrait le code postal d'une adresse"""
-    import re
-    match = re.search(r'\b(75\d{3}|92\d{3}|93\d{3}|94\d{3})\b', address)
-    return match.group(1) if match else ""
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 
+# Dépôt (point de départ des tournées)
+DEPOT = {
+    "nom": os.environ.get("DEPOT_NOM", "Atelier Maison Amarante"),
+    "adresse": os.environ.get("DEPOT_ADRESSE", ""),
+    "lat": float(os.environ.get("DEPOT_LAT", 48.8566)),
+    "lon": float(os.environ.get("DEPOT_LON", 2.3522)),
+}
 
-def get_zone_order(code_postal: str) -> int:
-    """Retourne un ordre de zone pour optimiser le parcours géographique.
-    Ordre: Paris centre → Paris périphérique → Banlieue proche → Banlieue loin
-    """
-    if not code_postal:
-        return 999
-
-    # Paris par arrondissement (spirale depuis le centre)
-    paris_order = {
-        "75001": 1, "75002": 2, "75003": 3, "75004": 4,  # Centre
-        "75005": 5, "75006": 6, "75007": 7, "75008": 8,  # Rive gauche + ouest
-        "75009": 9, "75010": 10, "75011": 11, "75012": 12,  # Est
-        "75013": 13, "75014": 14, "75015": 15, "75016": 16,  # Sud-ouest
-        "75017": 17, "75018": 18, "75019": 19, "75020": 20,  # Nord-est
-    }
+# Modèle de trajet en ville
+VITESSE_MOYENNE_KMH = 15   # vitesse moyenne d'un utilitaire dans Paris / petite couronne
+FACTEUR_DETOUR = 1.4       # distance routière ≈ distance à vol d'oiseau × facteur
+TEMPS_ARRET_MIN = 10       # stationnement + livraison d'un bouquet par arrêt
+TEMPS_PAR_BOUQUET_MIN = 2  # temps de service en plus par bouquet supplémentaire
+ROUTE_TIME_BUDGET = 0.2    # secondes d'optimisation max par tournée
 
-    if code_postal in paris_order:
-        return paris_order[code_postal]
+# Contraintes de construction des tournées (CVRPTW)
+CAPACITE_VEHICULE_BOUQUETS = int(os.environ.get("CAPACITE_VEHICULE_BOUQUETS", 40))
+DUREE_MAX_TOURNEE_MIN = int(os.environ.get("DUREE_MAX_TOURNEE_MIN", 420))  # 7h de tournée
+HEURE_DEPART_DEPOT = os.environ.get("HEURE_DEPART_DEPOT", "08:00")
+VRP_TIME_LIMIT = float(os.environ.get("VRP_TIME_LIMIT", 2.0))  # secondes de recherche locale
+COUT_FIXE_TOURNEE_MIN = 60  # coût (en minutes de trajet) d'une tournée supplémentaire
 
-    # Banlieue par département
-    if code_postal.startswith("92"):
-        return 30 + int(code_postal[2:]) if code_postal[2:].isdigit() else 35
-    if code_postal.startswith("93"):
-        return 50 + int(code_postal[2:]) if code_postal[2:].isdigit() else 55
-    if code_postal.startswith("94"):
-        return 70 + int(code_postal[2:]) if code_postal[2:].isdigit() else 75
+# Fenêtres horaires des créneaux (minutes depuis minuit)
+CRENEAU_MATIN = (7 * 60, 12 * 60)
+CRENEAU_APRES_MIDI = (13 * 60, 18 * 60)
+JOURS_SEMAINE = ["Lundi", "Mardi", "Mercredi", "Jeudi", "Vendredi", "Samedi", "Dimanche"]
 
-    return 999
 
+@functools.lru_cache(maxsize=1)
+def load_geodata() -> dict:
+    """Charge le référentiel local des centroïdes (codes postaux, départements)"""
+    with open(os.path.join(DATA_DIR, "geocodage_idf.json"), encoding="utf-8") as f:
+        return json.load(f)
 
-def optimize_route_order(clients: list) -> list:
-    """Optimise l'ordre des clients pour minimiser le temps de trajet.
-    Algorithme simple: tri par zone géographique (code postal).
-    """
-    # Trier par zone géographique
-    return sorted(clients, key=lambda c: (
-        get_zone_order(c.get("code_postal", "")),
-        c.get("code_postal", ""),
-        c.get("adresse", "")
-    ))
 
+def get_postal_code_coordinates(code_postal: str):
+    """Retourne (lat, lon) du centroïde d'un code postal, à défaut celui du département"""
+    if not code_postal:
+        return None
+    geodata = load_geodata()
+    coords = geodata["codes_postaux"].get(code_postal) or geodata["departements"].get(code_postal[:2])
+    return tuple(coords) if coords else None
+
+
+# ---------- Géocodage hors ligne ----------
+# Adresse → coordonnées à partir du référentiel embarqué (centroïdes de rues,
+# de codes postaux et de départements d'Île-de-France), sans appel réseau.
+# Deux niveaux de cache: LRU en mémoire par worker + table SQLite partagée.
+
+GEOCODE_CACHE_SIZE = 4096
+
+STATE_DB_SCHEMA.append(
+    "CREATE TABLE IF NOT EXISTS geocodes ("
+    "adresse TEXT PRIMARY KEY, lat REAL NOT NULL, lon REAL NOT NULL, "
+    "precision TEXT NOT NULL, version INTEGER NOT NULL, updated_at TEXT NOT NULL)"
+)
+
+_ADRESSE_ABREVIATIONS = {
+    "bd": "boulevard", "bld": "boulevard", "blvd": "boulevard",
+    "av": "avenue", "ave": "avenue", "r": "rue", "pl": "place",
+    "fg": "faubourg", "fbg": "faubourg", "st": "saint", "ste": "sainte",
+    "imp": "impasse", "sq": "square", "crs": "cours", "rte": "route",
+    "che": "chemin", "gal": "general", "pdt": "president",
+}
 
-def generate_google_maps_url(clients: list, start_address: str = None) -> str:
-    """Génère un lien Google Maps avec l'itinéraire optimisé.
 
-    Format: https://www.google.com/maps/dir/origin/stop1/stop2/.../destination
-    """
-    import urllib.parse
+def normalize_address(adresse: str) -> str:
+    """Normalise une adresse pour servir de clé de cache.
 
-    if not clients:
-        return ""
+    "12, Bd Saint-Germain 75006 Paris" → "12 boulevard saint germain 75006 paris"
+    """
+    text = unicodedata.normalize("NFKD", str(adresse or "").lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^a-z0-9]+", " ", text)
+    words = [_ADRESSE_ABREVIATIONS.get(word, word) for word in text.split() if word != "france"]
+    return " ".join(words)
 
-    addresses = []
 
-    # Point de départ (optionnel)
-    if start_address:
-        addresses.append(start_address)
+_VOIE_MOTS_VIDES = {"rue", "avenue", "boulevard", "place", "quai", "du", "de", "la", "le", "les", "des", "l", "d"}
 
-    # Ajouter toutes les adresses clients
-    for client in clients:
-        addr = client.get("adresse", "")
-        if addr:
-            addresses.append(addr)
 
-    if not addresses:
-        return ""
+def _street_core(text: str) -> str:
+    return " ".join(word for word in text.split() if word not in _VOIE_MOTS_VIDES)
 
-    # Encoder les adresses pour l'URL
-    encoded_addresses = [urllib.parse.quote(addr) for addr in addresses]
 
-    # Construire l'URL Google Maps
-    url = "https://www.google.com/maps/dir/" + "/".join(encoded_addresses)
+def _geocode_from_dataset(adresse_normalisee: str):
+    """Géocode une adresse normalisée: rue > code postal > département"""
+    match = load_zone_registry()["postal_code_re"].search(adresse_normalisee)
+    if not match:
+        return None
+    code_postal = match.group(1)
+    geodata = load_geodata()
 
-    return url
+    # Rue connue du référentiel (comparée sans type de voie ni article):
+    # on garde le nom le plus long qui correspond
+    rues = geodata.get("rues", {}).get(code_postal, {})
+    padded = f" {_street_core(adresse_normalisee)} "
+    best_rue = max((rue for rue in rues if f" {_street_core(rue)} " in padded),
+                   key=lambda rue: len(_street_core(rue)), default=None)
+    if best_rue:
+        lat, lon = rues[best_rue]
+        return (lat, lon, "rue")
 
+    if code_postal in geodata["codes_postaux"]:
+        lat, lon = geodata["codes_postaux"][code_postal]
+        return (lat, lon, "code_postal")
 
-def get_geographic_zone(code_postal: str) -> str:
-    """Retourne la zone géographique pour grouper les clients."""
-    if not code_postal:
-        return "Autre"
-
-    # Paris par zones
-    if code_postal in ["75001", "75002", "75003", "75004"]:
-        return "Paris Centre"
-    if code_postal in ["75005", "75006", "75007"]:
-        return "Paris Rive Gauche"
-    if code_postal in ["75008", "75009", "75010"]:
-        return "Paris Nord-Ouest"
-    if code_postal in ["75011", "75012", "75013"]:
-        return "Paris Est"
-    if code_postal in ["75014", "75015", "75016"]:
-        return "Paris Sud-Ouest"
-    if code_postal in ["75017", "75018", "75019", "75020"]:
-        return "Paris Nord-Est"
-
-    # Banlieue
-    if code_postal.startswith("92"):
-        return "Hauts-de-Seine (92)"
-    if code_postal.startswith("93"):
-        return "Seine-St-Denis (93)"
-    if code_postal.startswith("94"):
-        return "Val-de-Marne (94)"
-
-    return "Autre"
+    if code_postal[:2] in geodata["departements"]:
+        lat, lon = geodata["departements"][code_postal[:2]]
+        return (lat, lon, "departement")
+    return None
 
 
-def split_into_tournees(clients: list, max_clients_per_tournee: int = 12) -> list:
-    """Divise les clients en plusieurs tournées réalistes.
+@functools.lru_cache(maxsize=GEOCODE_CACHE_SIZE)
+def _geocode_normalized(adresse_normalisee: str):
+    version = load_geodata().get("version", 1)
+    conn = get_state_db()
+    try:
+        row = conn.execute(
+            "SELECT lat, lon, precision FROM geocodes WHERE adresse = ? AND version = ?",
+            (adresse_normalisee, version)
+        ).fetchone()
+        if row:
+            return tuple(row)
+
+        result = _geocode_from_dataset(adresse_normalisee)
+        if result:
+            conn.execute(
+                "INSERT OR REPLACE INTO geocodes (adresse, lat, lon, precision, version, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (adresse_normalisee, *result, version, datetime.now(timezone.utc).isoformat())
+            )
+        return result
+    finally:
+        conn.close()
+
+
+def geocode_address(adresse: str):
+    """Géocode une adresse d'Île-de-France sans appel externe.
 
-    Stratégie:
-    1. Grouper par zone géographique
-    2. Chaque zone devient une tournée si elle a assez de clients
-    3. Les petites zones sont fusionnées avec les zones adjacentes
-    4. Maximum 12-15 clients par tournée (réaliste pour une journée à Paris)
+    Returns:
+        {"lat", "lon", "precision": "rue"|"code_postal"|"departement"} ou None
     """
-    if not clients:
-        return []
-
-    # Grouper par zone géographique
-    zones = defaultdict(list)
-    for client in clients:
-        zone = get_geographic_zone(client.get("code_postal", ""))
-        zones[zone].append(client)
-
-    # Ordre logique des zones (parcours géographique)
-    zone_order = [
-        "Paris Centre",
-        "Paris Rive Gauche",
-        "Paris Nord-Ouest",
-        "Paris Sud-Ouest",
-        "Paris Est",
-        "Paris Nord-Est",
-        "Hauts-de-Seine (92)",
-        "Val-de-Marne (94)",
-        "Seine-St-Denis (93)",
-        "Autre"
-    ]
-
-    # Construire les tournées
-    tournees = []
-    current_tournee = []
-
-    for zone_name in zone_order:
-        zone_clients = zones.get(zone_name, [])
-        if not zone_clients:
-            continue
-
-        # Trier les clients de la zone par code postal
-        zone_clients = sorted(zone_clients, key=lambda c: (c.get("code_postal", ""), c.get("adresse", "")))
+    adresse_normalisee = normalize_address(adresse)
+    if not adresse_normalisee:
+        return None
+    result = _geocode_normalized(adresse_normalisee)
+    if not result:
+        return None
+    lat, lon, precision = result
+    return {"lat": lat, "lon": lon, "precision": precision}
+
+
+def get_client_coordinates(client: dict):
+    """Coordonnées d'un client: lat/lon connues, sinon géocodage de l'adresse,
+    sinon centroïde de son code postal"""
+    if client.get("lat") is not None and client.get("lon") is not None:
+        return (float(client["lat"]), float(client["lon"]))
+    if client.get("adresse"):
+        geocode = geocode_address(client["adresse"])
+        if geocode:
+            return (geocode["lat"], geocode["lon"])
+    return get_postal_code_coordinates(client.get("code_postal", ""))
+
+
+def save_client_coordinates(coordinates: dict) -> dict:
+    """Enregistre Latitude/Longitude sur les fiches CLIENTS (PATCH par lots de 10)
 
-        for client in zone_clients:
-            current_tournee.append(client)
-
-            # Si on atteint le max, créer une nouvelle tournée
-            if len(current_tournee) >= max_clients_per_tournee:
-                tournees.append(current_tournee)
-                current_tournee = []
+    Args:
+        coordinates: {record_id: (lat, lon)}
+    """
+    if not CLIENTS_COORDONNEES:
+        return {"updated": 0, "errors": ["CLIENTS_COORDONNEES désactivé: coordonnées non enregistrées"]}
 
-    # Ajouter la dernière tournée si elle n'est pas vide
-    if current_tournee:
-        # Si elle est trop petite et qu'on a d'autres tournées, fusionner avec la précédente si possible
-        if len(current_tournee) < 5 and tournees and len(tournees[-1]) + len(current_tournee) <= max_clients_per_tournee + 3:
-            tournees[-1].extend(current_tournee)
+    url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_CLIENTS_TABLE}"
+    headers = get_airtable_headers()
+    results = {"updated": 0, "errors": []}
+
+    items = list(coordinates.items())
+    for i in range(0, len(items), 10):
+        batch = items[i:i + 10]
+        payload = {"records": [
+            {"id": record_id, "fields": {"Latitude": lat, "Longitude": lon}}
+            for record_id, (lat, lon) in batch
+        ]}
+        response = req.patch(url, headers=headers, json=payload)
+        if response.status_code == 200:
+            results["updated"] += len(batch)
         else:
-            tournees.append(current_tournee)
+            print(f"[GEOCODE] Batch update error: {response.text}")
+            results["errors"].append(response.text)
 
-    return tournees
+    return results
 
 
-def prepare_tournees():
-    """Prépare PLUSIEURS tournées optimisées, réparties sur différents jours."""
+def geocode_clients(force: bool = False) -> dict:
+    """Géocode les clients avec adresse et stocke les coordonnées dans CLIENTS.
+
+    Seuls les clients sans Latitude/Longitude sont traités, sauf si `force`.
+    """
     _, _, all_clients = get_existing_clients()
+    results = {"geocoded": 0, "already_located": 0, "not_found": [], "precision": defaultdict(int)}
 
-    # Récupérer tous les clients actifs avec une adresse
-    clients_to_deliver = []
+    to_save = {}
     for client in all_clients:
         fields = client.get("fields", {})
-
-        if not fields.get("Actif", False):
-            continue
-
         adresse = fields.get("Adresse", "")
         if not adresse:
             continue
+        if not force and fields.get("Latitude") is not None and fields.get("Longitude") is not None:
+            results["already_located"] += 1
+            continue
 
-        clients_to_deliver.append({
-            "id": client["id"],
-            "nom": fields.get("Nom", ""),
-            "adresse": adresse,
-            "code_postal": extract_postal_code(adresse),
-            "zone": get_geographic_zone(extract_postal_code(adresse)),
-            "nb_bouquets": fields.get("Nb_Bouquets", 1),
-            "creneau": fields.get("Créneau_Préféré", ""),
-            "pref_couleurs": fields.get("Pref_Couleurs", ""),
-            "pref_style": fields.get("Pref_Style", ""),
-        })
+        geocode = geocode_address(adresse)
+        if not geocode:
+            results["not_found"].append(fields.get("Nom", client["id"]))
+            continue
+        results["precision"][geocode["precision"]] += 1
+        if (fields.get("Latitude"), fields.get("Longitude")) != (geocode["lat"], geocode["lon"]):
+            to_save[client["id"]] = (geocode["lat"], geocode["lon"])
+
+    saved = save_client_coordinates(to_save)
+    results["geocoded"] = saved["updated"]
+    results["errors"] = saved["errors"]
+    results["precision"] = dict(results["precision"])
+    print(f"[GEOCODE] {results['geocoded']} clients géocodés, {len(results['not_found'])} introuvables")
+    return results
 
-    if not clients_to_deliver:
-        return {
-            "total_clients": 0,
-            "total_bouquets": 0,
-            "tournees": [],
-            "message": "Aucun client actif avec adresse"
-        }
 
-    # Diviser en plusieurs tournées
-    tournees_clients = split_into_tournees(clients_to_deliver, max_clients_per_tournee=12)
+def temps_service(client: dict) -> float:
+    """Temps passé chez un client (minutes), selon son nombre de bouquets"""
+    try:
+        nb_bouquets = max(1, int(client.get("nb_bouquets", 1) or 1))
+    except (TypeError, ValueError):
+        nb_bouquets = 1
+    return TEMPS_ARRET_MIN + TEMPS_PAR_BOUQUET_MIN * (nb_bouquets - 1)
 
-    # Jours de livraison possibles (mardi et jeudi)
-    delivery_days = get_delivery_days(len(tournees_clients))
 
-    # Construire les tournées avec leurs infos
-    tournees = []
-    for i, clients in enumerate(tournees_clients):
-        # Optimiser l'ordre dans chaque tournée
-        optimized = optimize_route_order(clients)
+def parse_heure(text: str) -> int:
+    """Convertit "08:00" / "8h30" en minutes depuis minuit"""
+    match = re.match(r"\s*(\d{1,2})\s*[:h]\s*(\d{2})?", text or "")
+    if not match:
+        return 8 * 60
+    return int(match.group(1)) * 60 + int(match.group(2) or 0)
 
-        # Zones couvertes
-        zones_couvertes = list(set(c.get("zone", "Autre") for c in optimized))
 
-        tournees.append({
-            "numero": i + 1,
-            "jour": delivery_days[i] if i < len(delivery_days) else "À planifier",
-            "clients": optimized,
-            "nb_clients": len(optimized),
-            "nb_bouquets": sum(c.get("nb_bouquets", 1) for c in optimized),
-            "zones": zones_couvertes,
-            "google_maps_url": generate_google_maps_url(optimized),
-            "duree_estimee": f"{len(optimized) * 20}min"  # ~20min par client (trajet + livraison)
-        })
+_CRENEAU_HEURE_RE = re.compile(r"(avant|apres|a partir de|des)?\s*(\d{1,2})\s*h\s*(\d{2})?")
 
-    return {
-        "total_clients": len(clients_to_deliver),
-        "total_bouquets": sum(c.get("nb_bouquets", 1) for c in clients_to_deliver),
-        "nb_tournees": len(tournees),
-        "tournees": tournees,
-        "message": f"{len(tournees)} tournées générées pour {len(clients_to_deliver)} clients"
-    }
 
+def parse_creneau(creneau: str) -> dict:
+    """Interprète un Créneau_Préféré en jours autorisés et fenêtre horaire.
 
-def get_delivery_days(nb_tournees: int) -> list:
-    """Retourne une liste de jours de livraison pour N tournées.
+    Exemples: "Mardi matin", "Lundi 7h", "Jeudi après-midi", "Avant 11h".
 
-    Stratégie:
-    - Si 1 tournée: prochain mardi ou jeudi
-    - Si 2 tournées: mardi ET jeudi de la même semaine
-    - Si 3+ tournées: mardi/jeudi sur plusieurs semaines
+    Returns:
+        {"jours": [...], "debut": minutes ou None, "fin": minutes ou None}
     """
-    today = datetime.now().date()
-    days = []
-
-    # Calculer le prochain mardi et jeudi
-    days_until_tuesday = (1 - today.weekday()) % 7
-    days_until_thursday = (3 - today.weekday()) % 7
+    text = unicodedata.normalize("NFKD", str(creneau or "").lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+
+    jours = [jour for jour in JOURS_SEMAINE if jour.lower() in text]
+    debut, fin = None, None
+
+    if re.search(r"apres[- ]?midi|aprem", text):
+        debut, fin = CRENEAU_APRES_MIDI
+        text = re.sub(r"apres[- ]?midi|aprem", " ", text)
+    elif "matin" in text:
+        debut, fin = CRENEAU_MATIN
+
+    for mot, heures, minutes in _CRENEAU_HEURE_RE.findall(text):
+        heure = int(heures) * 60 + int(minutes or 0)
+        if mot == "avant":
+            fin = heure
+        elif mot:
+            debut = heure
+        else:
+            # Heure précise: on vise une fenêtre d'une heure autour
+            debut, fin = heure - 30, heure + 30
+
+    return {"jours": jours, "debut": debut, "fin": fin}
+
+
+def haversine_matrix(points_a, points_b=None):
+    """Distances à vol d'oiseau (km) entre deux listes de (lat, lon), calculées d'un bloc"""
+    a = np.radians(np.asarray(points_a, dtype=np.float64).reshape(-1, 2))
+    b = a if points_b is None else np.radians(np.asarray(points_b, dtype=np.float64).reshape(-1, 2))
+    dlat = b[None, :, 0] - a[:, None, 0]
+    dlon = b[None, :, 1] - a[:, None, 1]
+    h = np.sin(dlat / 2) ** 2 + np.cos(a[:, None, 0]) * np.cos(b[None, :, 0]) * np.sin(dlon / 2) ** 2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+# ---------- Matrice persistante des distances ----------
+# Distances (km) et durées (min) entre toutes les localisations déjà vues,
+# indexées par clé de localisation. Les nouvelles localisations sont ajoutées
+# au fil de l'eau (une ligne calculée d'un bloc contre l'existant), la matrice
+# est symétrique, en float32, et persistée sur disque pour les autres workers.
+
+DISTANCE_STORE_PATH = os.environ.get("DISTANCE_STORE_PATH", "/tmp/maison_amarante_distances.npz")
+
+_distance_store = {
+    "index": {},                                  # clé de localisation → ligne
+    "points": np.zeros((0, 2)),                   # (lat, lon) par ligne
+    "distance": np.zeros((0, 0), dtype=np.float32),
+    "duree": np.zeros((0, 0), dtype=np.float32),
+    "size": 0,                                    # lignes utilisées (≤ capacité)
+    "mtime": None,                                # version du fichier chargé
+    "dirty": False,                               # ajouts pas encore écrits sur disque
+    "saved_at": 0.0,
+}
+_distance_store_lock = threading.Lock()
+DISTANCE_STORE_SAVE_INTERVAL = 10  # secondes minimum entre deux réécritures du fichier par worker
+
+
+def location_key(coords) -> str:
+    """Clé d'une localisation géocodée (~1 m de précision)"""
+    return f"{coords[0]:.5f},{coords[1]:.5f}"
+
+
+def _distance_store_model():
+    # Paramètres du modèle de trajet: une matrice calculée avec d'autres valeurs est ignorée
+    return np.array([FACTEUR_DETOUR, VITESSE_MOYENNE_KMH], dtype=np.float64)
+
+
+def _distance_store_add(points: list):
+    """Ajoute des localisations et calcule leurs lignes (symétriques) d'un bloc"""
+    store = _distance_store
+    n, m = store["size"], len(points)
+    capacity = store["distance"].shape[0]
+    if n + m > capacity:
+        capacity = max(64, 2 * capacity, n + m)
+        for name in ("distance", "duree"):
+            grown = np.zeros((capacity, capacity), dtype=np.float32)
+            grown[:n, :n] = store[name][:n, :n]
+            store[name] = grown
+        grown_points = np.zeros((capacity, 2))
+        grown_points[:n] = store["points"][:n]
+        store["points"] = grown_points
+
+    new = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    store["points"][n:n + m] = new
+    block = haversine_matrix(new, store["points"][:n + m]) * FACTEUR_DETOUR  # (m, n+m)
+    store["distance"][n:n + m, :n + m] = block
+    store["distance"][:n + m, n:n + m] = block.T
+    duree = block / VITESSE_MOYENNE_KMH * 60
+    store["duree"][n:n + m, :n + m] = duree
+    store["duree"][:n + m, n:n + m] = duree.T
+
+    for k, coords in enumerate(new):
+        store["index"][location_key(coords)] = n + k
+    store["size"] = n + m
+
+
+def _distance_store_load():
+    """Recharge la matrice persistée si un autre worker l'a enrichie entre-temps"""
+    store = _distance_store
+    try:
+        mtime = os.path.getmtime(DISTANCE_STORE_PATH)
+    except OSError:
+        return
+    if mtime == store["mtime"]:
+        return
 
-    if days_until_tuesday == 0:
+    try:
+        with np.load(DISTANCE_STORE_PATH) as data:
+            if not np.array_equal(data["model"], _distance_store_model()):
+                store["mtime"] = mtime
+                return
+            points, distance, duree = data["points"], data["distance"], data["duree"]
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[DISTANCES] Lecture impossible: {e}")
+        return
+
+    # Localisations connues uniquement de ce worker: recalculées après chargement
+    file_keys = {location_key(coords) for coords in points}
+    own = [store["points"][i] for key, i in store["index"].items() if key not in file_keys]
+
+    store["points"], store["distance"], store["duree"] = points.copy(), distance.copy(), duree.copy()
+    store["index"] = {location_key(coords): i for i, coords in enumerate(points)}
+    store["size"] = len(points)
+    store["mtime"] = mtime
+    if own:
+        _distance_store_add(own)
+
+
+def _distance_store_save():
+    """Fusionne les ajouts des autres workers puis réécrit le fichier.
+
+    Le verrou fichier sérialise lecture + écriture entre processus: une
+    localisation ajoutée par un autre worker n'est jamais écrasée.
+    """
+    store = _distance_store
+    directory = os.path.dirname(DISTANCE_STORE_PATH) or "."
+    tmp_path = None
+    try:
+        with open(f"{DISTANCE_STORE_PATH}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            _distance_store_load()
+            n = store["size"]
+            with tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False) as f:
+                tmp_path = f.name
+                np.savez(f, model=_distance_store_model(), points=store["points"][:n],
+                         distance=store["distance"][:n, :n], duree=store["duree"][:n, :n])
+            os.replace(tmp_path, DISTANCE_STORE_PATH)
+            tmp_path = None
+            store["mtime"] = os.path.getmtime(DISTANCE_STORE_PATH)
+        store["dirty"] = False
+    except OSError as e:
+        print(f"[DISTANCES] Sauvegarde impossible: {e}")
+    finally:
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    store["saved_at"] = time.monotonic()
+
+
+@atexit.register
+def _distance_store_flush():
+    with _distance_store_lock:
+        if _distance_store["dirty"]:
+            _distance_store_save()
+
+
+def distance_store_snapshot(points):
+    """Lignes de la matrice pour une liste de (lat, lon) (les inconnues sont ajoutées),
+    avec les matrices distance / durée correspondantes, lues sous le même verrou.
+
+    Un rechargement ultérieur remplace les matrices du store sans modifier celles
+    renvoyées, et un ajout n'écrit que des lignes nouvelles: les indices restent
+    valables pour ces matrices.
+
+    Returns:
+        (rows, distance, duree)
+    """
+    with _distance_store_lock:
+        _distance_store_load()
+        index = _distance_store["index"]
+        keys = [location_key(coords) for coords in points]
+
+        missing, seen = [], set()
+        for key, coords in zip(keys, points):
+            if key not in index and key not in seen:
+                seen.add(key)
+                missing.append(coords)
+        if missing:
+            _distance_store_add(missing)
+            _distance_store["dirty"] = True
+        if _distance_store["dirty"] and time.monotonic() - _distance_store["saved_at"] >= DISTANCE_STORE_SAVE_INTERVAL:
+            _distance_store_save()
+
+        index = _distance_store["index"]
+        rows = np.fromiter((index[key] for key in keys), dtype=np.intp, count=len(keys))
+        return rows, _distance_store["distance"], _distance_store["duree"]
+
+
+def distance_store_query(points_a, points_b=None):
+    """Distances (km) et durées (min) entre deux listes de points, lues d'un bloc.
+
+    Returns:
+        (distances, durees): matrices float32 de forme (len(points_a), len(points_b))
+    """
+    if points_b is None:
+        rows, distance, duree = distance_store_snapshot(points_a)
+        cols = rows
+    else:
+        rows_cols, distance, duree = distance_store_snapshot(list(points_a) + list(points_b))
+        rows, cols = rows_cols[:len(points_a)], rows_cols[len(points_a):]
+    block = np.ix_(rows, cols)
+    return distance[block], duree[block]
+
+
+def road_distance_matrix(points):
+    """Distances routières estimées (km) entre tous les points"""
+    return distance_store_query(points)[0].astype(np.float64)
+
+
+def travel_time_matrix(points):
+    """Temps de trajet estimés (minutes) entre tous les points"""
+    return distance_store_query(points)[1].astype(np.float64)
+
+
+def _path_length(path: list, dist) -> float:
+    return float(sum(dist[path[k], path[k + 1]] for k in range(len(path) - 1)))
+
+
+def tsp_nearest_neighbour(dist, start: int, nodes: list) -> list:
+    """Construction: part de `start` et va toujours au plus proche non visité"""
+    route, remaining, current = [], set(nodes), start
+    while remaining:
+        current = min(remaining, key=lambda n: (dist[current, n], n))
+        route.append(current)
+        remaining.discard(current)
+    return route
+
+
+def tsp_two_opt(path: list, dist, deadline: float) -> list:
+    """Amélioration 2-opt (inverse des segments), extrémités du chemin fixes"""
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(1, len(path) - 2):
+            for j in range(i + 1, len(path) - 1):
+                delta = (dist[path[i - 1], path[j]] + dist[path[i], path[j + 1]]
+                         - dist[path[i - 1], path[i]] - dist[path[j], path[j + 1]])
+                if delta < -1e-9:
+                    path[i:j + 1] = path[i:j + 1][::-1]
+                    improved = True
+            if time.monotonic() >= deadline:
+                break
+    return path
+
+
+def tsp_or_opt(path: list, dist, deadline: float) -> list:
+    """Amélioration or-opt: déplace des segments de 1 à 3 arrêts (éventuellement inversés)"""
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for length in (1, 2, 3):
+            for i in range(1, len(path) - length):
+                first, last = path[i], path[i + length - 1]
+                prev, nxt = path[i - 1], path[i + length]
+                gain = dist[prev, first] + dist[last, nxt] - dist[prev, nxt]
+
+                best = None
+                for k in range(len(path) - 1):
+                    if i - 1 <= k <= i + length - 1:
+                        continue
+                    a, b = path[k], path[k + 1]
+                    cost = dist[a, first] + dist[last, b] - dist[a, b]
+                    cost_reversed = dist[a, last] + dist[first, b] - dist[a, b]
+                    for c, reverse in ((cost, False), (cost_reversed, True)):
+                        if c - gain < -1e-9 and (best is None or c < best[0]):
+                            best = (c, k, reverse)
+
+                if best:
+                    _, k, reverse = best
+                    segment = path[i:i + length]
+                    if reverse:
+                        segment = segment[::-1]
+                    rest = path[:i] + path[i + length:]
+                    insert_at = k + 1 if k < i else k + 1 - length
+                    path = rest[:insert_at] + segment + rest[insert_at:]
+                    improved = True
+                    break
+            if improved or time.monotonic() >= deadline:
+                break
+    return path
+
+
+def optimize_route(clients: list, depot: dict = None, time_budget: float = ROUTE_TIME_BUDGET, retour_depot: bool = True) -> dict:
+    """Optimise l'ordre de passage d'une tournée (TSP heuristique).
+
+    Plus proche voisin depuis le dépôt, puis 2-opt et or-opt tant que le budget
+    de temps le permet. Les clients sans coordonnées sont ajoutés en fin de
+    tournée, dans l'ordre des zones.
+
+    Returns:
+        dict avec clients (ordonnés), distance_km, duree_trajet_min, duree_min
+    """
+    depot = depot or DEPOT
+    located, unlocated = [], []
+    for client in clients:
+        coords = get_client_coordinates(client)
+        (located if coords else unlocated).append((client, coords))
+
+    unlocated_sorted = sorted((c for c, _ in unlocated), key=lambda c: (
+        get_zone_order(c.get("code_postal", "")),
+        c.get("code_postal", ""),
+        c.get("adresse", "")
+    ))
+
+    distance_km = 0.0
+    ordered = []
+    if located:
+        # Nœud 0 = dépôt, 1..n = clients; n+1 = fin de tournée (dépôt, ou nœud fictif à distance nulle)
+        points = [(depot["lat"], depot["lon"])] + [coords for _, coords in located]
+        n = len(points)
+        dist = np.zeros((n + 1, n + 1))
+        dist[:n, :n] = road_distance_matrix(points)
+        if retour_depot:
+            dist[n, :n] = dist[0, :n]
+            dist[:n, n] = dist[:n, 0]
+
+        deadline = time.monotonic() + time_budget
+        path = [0] + tsp_nearest_neighbour(dist, 0, list(range(1, n))) + [n]
+        path = tsp_two_opt(path, dist, deadline)
+        path = tsp_or_opt(path, dist, deadline)
+
+        distance_km = _path_length(path, dist)
+        ordered = [located[node - 1][0] for node in path[1:-1]]
+
+    duree_trajet = distance_km / VITESSE_MOYENNE_KMH * 60
+    return {
+        "clients": ordered + unlocated_sorted,
+        "distance_km": round(distance_km, 1),
+        "duree_trajet_min": round(duree_trajet),
+        "duree_min": round(duree_trajet + sum(temps_service(c) for c in clients)),
+    }
+
+
+def format_heure(minutes: float) -> str:
+    """Minutes depuis minuit → HH:MM"""
+    minutes = int(round(minutes))
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def compute_tour_etas(tournees: list, depots: list = None) -> list:
+    """Horaires de passage de toutes les tournées, calculés d'un bloc.
+
+    Modèle: départ du dépôt à HEURE_DEPART_DEPOT, trajets lus dans la matrice
+    des durées, attente jusqu'au début du créneau si on arrive trop tôt, puis
+    temps de service selon nb_bouquets. Un arrêt dont le service commence après
+    la fin de son créneau est signalé "creneau_manque". Un arrêt dont le
+    solveur a relâché le créneau ("creneau_relache") est servi sans attente et
+    compté comme manqué. Un client sans coordonnées est supposé au même
+    endroit que l'arrêt précédent.
+
+    Les tournées sont alignées dans des matrices (tournées × arrêts): la
+    récurrence horaire avance d'un arrêt à la fois pour toutes les tournées.
+
+    Returns:
+        liste alignée sur `tournees` de {"distance_km", "duree_min", "heure_retour",
+        "creneaux_manques", "etas": [{"arrivee", "debut_service", "attente_min",
+        "creneau_manque"}, ...]}
+    """
+    if not tournees:
+        return []
+    depots = depots or [DEPOT] * len(tournees)
+    depart = parse_heure(HEURE_DEPART_DEPOT)
+    nb, width = len(tournees), max(len(t) for t in tournees)
+
+    # Chemins dépôt → arrêts → dépôt, complétés par le dépôt (trajets nuls)
+    points = []
+    service = np.zeros((nb, width))
+    open_ = np.zeros((nb, width))
+    close = np.full((nb, width), np.inf)
+    relache = np.zeros((nb, width), dtype=bool)
+    for r, (clients, depot) in enumerate(zip(tournees, depots)):
+        position = (depot["lat"], depot["lon"])
+        path = [position]
+        for k, client in enumerate(clients):
+            position = get_client_coordinates(client) or position
+            path.append(position)
+            fenetre = parse_creneau(client.get("creneau", ""))
+            service[r, k] = temps_service(client)
+            if client.get("creneau_relache"):
+                relache[r, k] = True
+                continue
+            if fenetre["debut"] is not None:
+                open_[r, k] = fenetre["debut"]
+            if fenetre["fin"] is not None:
+                close[r, k] = fenetre["fin"]
+        path.extend([(depot["lat"], depot["lon"])] * (width + 2 - len(path)))
+        points.extend(path)
+
+    rows, distance, duree = distance_store_snapshot(points)
+    rows = rows.reshape(nb, width + 2)
+    legs_km = distance[rows[:, :-1], rows[:, 1:]].astype(np.float64)
+    legs_min = duree[rows[:, :-1], rows[:, 1:]].astype(np.float64)
+
+    arrivee = np.zeros((nb, width))
+    debut = np.zeros((nb, width))
+    t = np.full(nb, float(depart))
+    for k in range(width):
+        arrivee[:, k] = t + legs_min[:, k]
+        debut[:, k] = np.maximum(arrivee[:, k], open_[:, k])
+        t = debut[:, k] + service[:, k]
+    retour = t + legs_min[:, width]
+    manque = (debut > close) | relache
+
+    results = []
+    for r, clients in enumerate(tournees):
+        n = len(clients)
+        results.append({
+            "distance_km": round(float(legs_km[r].sum()), 1),
+            "duree_min": round(float(retour[r] - depart)),
+            "heure_retour": format_heure(retour[r]),
+            "creneaux_manques": int(manque[r, :n].sum()),
+            "etas": [{
+                "arrivee": format_heure(arrivee[r, k]),
+                "debut_service": format_heure(debut[r, k]),
+                "attente_min": round(float(debut[r, k] - arrivee[r, k])),
+                "creneau_manque": bool(manque[r, k]),
+            } for k in range(n)],
+        })
+    return results
+
+
+def route_metrics(clients: list, depot: dict = None) -> dict:
+    """Distance, durée et horaires d'une tournée dans l'ordre donné (voir compute_tour_etas)"""
+    return compute_tour_etas([clients], [depot or DEPOT])[0]
+
+
+def build_spatial_grid(points: list, cell_km: float) -> dict:
+    """Index spatial: répartit les points (lat, lon) dans des cases d'environ `cell_km` de côté"""
+    grid = defaultdict(list)
+    for i, (lat, lon) in enumerate(points):
+        grid[_grid_cell(lat, lon, cell_km)].append(i)
+    return grid
+
+
+def _grid_cell(lat: float, lon: float, cell_km: float) -> tuple:
+    # 1° de latitude ≈ 111 km; 1° de longitude ≈ 111 km × cos(latitude) (≈ 73 km en IDF)
+    return (int(np.floor(lat * 111.0 / cell_km)),
+            int(np.floor(lon * 111.0 * np.cos(np.radians(48.85)) / cell_km)))
+
+
+def dbscan_clusters(points: list, radius_km: float, min_size: int) -> list:
+    """Regroupe les points proches (DBSCAN sur grille de cases de `radius_km`).
+
+    Un point est "cœur" s'il a au moins `min_size` points (lui compris) à moins
+    de `radius_km`; un groupe est l'ensemble des points atteignables de proche
+    en proche depuis un cœur. Seules les 9 cases voisines sont examinées.
+
+    Returns:
+        liste de groupes (listes d'indices dans `points`), les points isolés exclus
+    """
+    if not points:
+        return []
+    grid = build_spatial_grid(points, radius_km)
+    coords = np.asarray(points, dtype=np.float64)
+
+    def neighbours(i):
+        cx, cy = _grid_cell(coords[i, 0], coords[i, 1], radius_km)
+        candidates = [j for dx in (-1, 0, 1) for dy in (-1, 0, 1) for j in grid.get((cx + dx, cy + dy), ())]
+        distances = haversine_matrix(coords[i:i + 1], coords[candidates])[0]
+        return [j for j, d in zip(candidates, distances) if d <= radius_km]
+
+    labels = [None] * len(points)  # None = non visité, -1 = isolé
+    clusters = []
+    for i in range(len(points)):
+        if labels[i] is not None:
+            continue
+        voisins = neighbours(i)
+        if len(voisins) < min_size:
+            labels[i] = -1
+            continue
+
+        cluster_id = len(clusters)
+        cluster = []
+        labels[i] = cluster_id
+        queue = list(voisins)
+        cluster.append(i)
+        while queue:
+            j = queue.pop()
+            if labels[j] == -1:
+                labels[j] = cluster_id  # point de bordure
+                cluster.append(j)
+            if labels[j] is not None:
+                continue
+            labels[j] = cluster_id
+            cluster.append(j)
+            voisins_j = neighbours(j)
+            if len(voisins_j) >= min_size:
+                queue.extend(voisins_j)
+        clusters.append(sorted(cluster))
+
+    return clusters
+
+
+def _vrp_refresh(route: dict, data: dict):
+    """Recalcule charge, débuts au plus tôt (b) et au plus tard (L) d'une route"""
+    tt, service, open_, close = data["tt"], data["service"], data["open"], data["close"]
+    nodes = route["nodes"]
+
+    b, t, prev = [], data["depart"], 0
+    for node in nodes:
+        t = max(t + tt[prev][node], open_[node])
+        b.append(t)
+        t += service[node]
+        prev = node
+
+    latest = [0.0] * len(nodes)
+    next_latest, next_node = data["depart"] + data["duree_max"], 0
+    for k in range(len(nodes) - 1, -1, -1):
+        node = nodes[k]
+        latest[k] = min(close[node], next_latest - tt[node][next_node] - service[node])
+        next_latest, next_node = latest[k], node
+
+    route["b"], route["L"] = b, latest
+    route["end"] = t + tt[prev][0]
+    route["load"] = sum(data["demand"][n] for n in nodes)
+
+
+def _vrp_route_feasible(nodes: list, data: dict) -> bool:
+    route = {"nodes": nodes}
+    _vrp_refresh(route, data)
+    return (route["end"] <= data["depart"] + data["duree_max"] + 1e-9
+            and all(b <= data["close"][n] + 1e-9 for n, b in zip(nodes, route["b"])))
+
+
+def _vrp_best_insertion(u: int, routes: list, data: dict, skip=None):
+    """Meilleure position faisable pour insérer u: (delta_trajet, index_route, position) ou None"""
+    tt, service, open_, close = data["tt"], data["service"], data["open"], data["close"]
+    best = None
+    for r, route in enumerate(routes):
+        if route is skip:
+            continue
+        nodes = route["nodes"]
+        if len(nodes) >= data["max_arrets"] or route["load"] + data["demand"][u] > data["capacite"]:
+            continue
+        if route.get("weekday") is not None and data["jours"][u] and route["weekday"] not in data["jours"][u]:
+            continue  # client épinglé sur un autre jour
+        for p in range(len(nodes) + 1):
+            prev = nodes[p - 1] if p > 0 else 0
+            nxt = nodes[p] if p < len(nodes) else 0
+            delta = tt[prev][u] + tt[u][nxt] - tt[prev][nxt]
+            if best is not None and delta >= best[0]:
+                continue
+
+            ready = route["b"][p - 1] + service[prev] if p > 0 else data["depart"]
+            b_u = max(ready + tt[prev][u], open_[u])
+            if b_u > close[u]:
+                continue
+            arrival = b_u + service[u] + tt[u][nxt]
+            if p < len(nodes):
+                if max(arrival, open_[nxt]) > route["L"][p]:
+                    continue
+            elif arrival > data["depart"] + data["duree_max"]:
+                continue
+            best = (delta, r, p)
+    return best
+
+
+def _vrp_improve_route(route: dict, data: dict, deadline: float) -> bool:
+    """2-opt intra-tournée en gardant les créneaux et la durée max respectés"""
+    tt = data["tt"]
+    improved_any = False
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        path = [0] + route["nodes"] + [0]
+        for i in range(1, len(path) - 2):
+            for j in range(i + 1, len(path) - 1):
+                delta = (tt[path[i - 1]][path[j]] + tt[path[i]][path[j + 1]]
+                         - tt[path[i - 1]][path[i]] - tt[path[j]][path[j + 1]])
+                if delta < -1e-9:
+                    candidate = path[1:i] + path[i:j + 1][::-1] + path[j + 1:-1]
+                    if _vrp_route_feasible(candidate, data):
+                        route["nodes"] = candidate
+                        _vrp_refresh(route, data)
+                        improved = improved_any = True
+                        break
+            if improved:
+                break
+    return improved_any
+
+
+def _vrp_build_data(located: list, depot: dict, capacite: int, duree_max: int, max_arrets: int) -> dict:
+    """Données du problème: nœud 0 = dépôt, nœuds 1..n = clients localisés [(client, coords)]"""
+    points = [(depot["lat"], depot["lon"])] + [coords for _, coords in located]
+    data = {
+        "tt": travel_time_matrix(points).tolist(),
+        "depart": parse_heure(HEURE_DEPART_DEPOT),
+        "duree_max": duree_max, "capacite": capacite, "max_arrets": max_arrets,
+        "service": [0.0], "demand": [0], "open": [0.0], "close": [float("inf")], "jours": [None],
+    }
+    for client, _ in located:
+        fenetre = parse_creneau(client.get("creneau", ""))
+        data["service"].append(temps_service(client))
+        data["demand"].append(max(1, int(client.get("nb_bouquets", 1) or 1)))
+        data["open"].append(float(fenetre["debut"]) if fenetre["debut"] is not None else 0.0)
+        data["close"].append(float(fenetre["fin"]) if fenetre["fin"] is not None else float("inf"))
+        data["jours"].append({JOURS_SEMAINE.index(jour) for jour in fenetre["jours"]} or None)
+    return data
+
+
+def solve_cvrptw(clients: list, depot: dict = None, capacite: int = None, duree_max: int = None,
+                 max_arrets: int = 12, time_limit: float = None) -> list:
+    """Construit des tournées sous contraintes (CVRPTW).
+
+    - capacité du véhicule en bouquets (nb_bouquets cumulés)
+    - durée max d'une tournée, départ du dépôt à HEURE_DEPART_DEPOT, retour compris
+    - fenêtres horaires issues du Créneau_Préféré (parse_creneau)
+    - au plus `max_arrets` clients par tournée
+
+    Construction par insertion au moindre coût (clients aux créneaux serrés
+    d'abord), puis recherche locale (relocalisation entre tournées, suppression
+    des petites tournées, 2-opt intra-tournée) jusqu'à `time_limit` secondes.
+    Un client dont le créneau est inatteignable même seul voit sa fenêtre
+    relâchée (marqué "creneau_relache").
+
+    Returns:
+        liste de tournées, chacune = liste ordonnée de clients
+    """
+    depot = depot or DEPOT
+    capacite = capacite or CAPACITE_VEHICULE_BOUQUETS
+    duree_max = duree_max or DUREE_MAX_TOURNEE_MIN
+    deadline = time.monotonic() + (VRP_TIME_LIMIT if time_limit is None else time_limit)
+
+    located, unlocated = [], []
+    for client in clients:
+        coords = get_client_coordinates(client)
+        (located if coords else unlocated).append((client, coords))
+
+    tournees = []
+    if located:
+        data = _vrp_build_data(located, depot, capacite, duree_max, max_arrets)
+        tt = data["tt"]
+
+        relaxed = set()
+        routes = []
+
+        # 1. Construction: créneaux serrés d'abord, puis les plus éloignés du dépôt
+        order = sorted(range(1, len(located) + 1), key=lambda u: (data["close"][u] - data["open"][u], -tt[0][u]))
+        for u in order:
+            if not _vrp_route_feasible([u], data):
+                data["open"][u], data["close"][u] = 0.0, float("inf")
+                relaxed.add(u)
+
+            best = _vrp_best_insertion(u, routes, data)
+            cost_new_route = tt[0][u] + tt[u][0] + COUT_FIXE_TOURNEE_MIN
+            if best and best[0] <= cost_new_route:
+                _, r, p = best
+                routes[r]["nodes"].insert(p, u)
+                _vrp_refresh(routes[r], data)
+            else:
+                route = {"nodes": [u]}
+                _vrp_refresh(route, data)
+                routes.append(route)
+
+        # 2. Recherche locale jusqu'à la limite de temps
+        improved = True
+        while improved and time.monotonic() < deadline:
+            improved = False
+
+            # Relocalisation d'un client vers une autre tournée si le trajet total baisse
+            for route in list(routes):
+                k = 0
+                while k < len(route["nodes"]) and time.monotonic() < deadline:
+                    nodes = route["nodes"]
+                    u = nodes[k]
+                    prev = nodes[k - 1] if k > 0 else 0
+                    nxt = nodes[k + 1] if k + 1 < len(nodes) else 0
+                    gain = tt[prev][u] + tt[u][nxt] - tt[prev][nxt]
+                    if len(nodes) == 1:
+                        gain += COUT_FIXE_TOURNEE_MIN
+
+                    best = _vrp_best_insertion(u, routes, data, skip=route)
+                    if best and best[0] < gain - 1e-6:
+                        _, r, p = best
+                        target = routes[r]
+                        nodes.pop(k)
+                        target["nodes"].insert(p, u)
+                        _vrp_refresh(target, data)
+                        _vrp_refresh(route, data)
+                        improved = True
+                    else:
+                        k += 1
+                if not route["nodes"]:
+                    routes.remove(route)
+
+            # Tentative de suppression de la plus petite tournée
+            if len(routes) > 1 and time.monotonic() < deadline:
+                smallest = min(routes, key=lambda r: len(r["nodes"]))
+                others = [r for r in routes if r is not smallest]
+                snapshot = [(r, list(r["nodes"])) for r in others]
+                placed_all = True
+                for u in list(smallest["nodes"]):
+                    best = _vrp_best_insertion(u, others, data)
+                    if not best:
+                        placed_all = False
+                        break
+                    _, r, p = best
+                    others[r]["nodes"].insert(p, u)
+                    _vrp_refresh(others[r], data)
+                if placed_all:
+                    routes.remove(smallest)
+                    improved = True
+                else:
+                    for r, nodes in snapshot:
+                        r["nodes"] = nodes
+                        _vrp_refresh(r, data)
+
+            for route in routes:
+                if _vrp_improve_route(route, data, deadline):
+                    improved = True
+
+        for route in routes:
+            tournee = []
+            for node in route["nodes"]:
+                client = located[node - 1][0]
+                if node in relaxed:
+                    client = dict(client, creneau_relache=True)
+                tournee.append(client)
+            tournees.append(tournee)
+
+    # Clients sans coordonnées: regroupés par zone, comme avant
+    unlocated_sorted = sorted((c for c, _ in unlocated), key=lambda c: (
+        get_zone_order(c.get("code_postal", "")),
+        c.get("code_postal", ""),
+        c.get("adresse", "")
+    ))
+    for i in range(0, len(unlocated_sorted), max_arrets):
+        tournees.append(unlocated_sorted[i:i + max_arrets])
+
+    # Numérotation dans l'ordre géographique des zones
+    tournees.sort(key=lambda t: min(get_zone_order(c.get("code_postal", "")) for c in t))
+    return tournees
+
+
+# ---------- Planification de la semaine (livreurs × jours) ----------
+# Chaque créneau de travail = un livreur un jour donné, avec une tournée au plus.
+# Les clients épinglés sur un jour (Créneau_Préféré "Mardi matin"…) n'en sortent
+# pas; les autres sont répartis pour équilibrer durée et volume de bouquets.
+
+NB_LIVREURS = int(os.environ.get("NB_LIVREURS", 1))
+POIDS_EQUILIBRAGE_MIN = 120  # coût (minutes) d'une charge² de créneau: arbitre trajet vs équilibre
+PLAN_INCREMENTAL_MAX = 5     # au-delà de N clients ajoutés/retirés/modifiés, on replanifie tout
+
+
+def _slot_charge(route: dict, data: dict) -> float:
+    """Charge normalisée d'un créneau: durée / durée max + bouquets / capacité"""
+    if not route["nodes"]:
+        return 0.0
+    return (route["end"] - data["depart"]) / data["duree_max"] + route["load"] / data["capacite"]
+
+
+def _vrp_balanced_insertion(u: int, routes: list, data: dict, skip=None):
+    """Meilleure insertion de u en comptant l'équilibre de charge: (coût, index_route, position)"""
+    best = None
+    for r, route in enumerate(routes):
+        if route is skip:
+            continue
+        found = _vrp_best_insertion(u, [route], data)
+        if not found:
+            continue
+        delta = found[0]
+        before = _slot_charge(route, data)
+        after = (before + (delta + data["service"][u]) / data["duree_max"]
+                 + data["demand"][u] / data["capacite"])
+        cost = delta + POIDS_EQUILIBRAGE_MIN * (after ** 2 - before ** 2)
+        if best is None or cost < best[0]:
+            best = (cost, r, found[2])
+    return best
+
+
+def get_week_slots(clients: list, nb_livreurs: int = None, today=None) -> list:
+    """Créneaux de travail des 7 prochains jours: jours de livraison (mardi, jeudi)
+    plus les jours imposés par les clients, × livreurs, × dépôts"""
+    today = today or datetime.now().date()
+    nb_livreurs = nb_livreurs or NB_LIVREURS
+
+    weekdays = set(JOURS_LIVRAISON)
+    depots = set()
+    for client in clients:
+        weekdays |= {JOURS_SEMAINE.index(jour) for jour in parse_creneau(client.get("creneau", ""))["jours"]}
+        depots.add(get_zone_depot_key(client.get("code_postal", "")))
+
+    slots = []
+    for depot_key in sorted(depots, key=str):
+        for offset in range(1, 8):
+            day = today + timedelta(days=offset)
+            if day.weekday() not in weekdays:
+                continue
+            for livreur in range(1, nb_livreurs + 1):
+                slots.append({
+                    "jour": JOURS_SEMAINE[day.weekday()],
+                    "weekday": day.weekday(),
+                    "date": day.isoformat(),
+                    "livreur": livreur,
+                    "depot": depot_key,
+                })
+    return slots
+
+
+def plan_week_tours(clients: list, slots: list, depot: dict = None, max_arrets: int = 12,
+                    time_limit: float = None, initial: list = None):
+    """Répartit les clients sur les créneaux (un livreur, un jour) de la semaine.
+
+    Mêmes contraintes que solve_cvrptw (capacité, durée max, créneaux horaires,
+    `max_arrets`), plus le jour imposé. L'objectif ajoute au trajet total une
+    pénalité quadratique sur la charge de chaque créneau (durée et bouquets),
+    ce qui étale le travail entre jours et livreurs.
+
+    - sans `initial`: construction par insertion équilibrée puis recherche
+      locale (relocalisation, 2-opt) jusqu'à `time_limit`
+    - avec `initial` (liste d'ids de clients par créneau, plan précédent): les
+      tournées existantes sont gardées telles quelles et seuls les clients
+      absents de `initial` sont insérés au meilleur endroit
+
+    Returns:
+        (tournées alignées sur `slots` (listes de clients, éventuellement vides),
+         clients non placés)
+    """
+    depot = depot or DEPOT
+    deadline = time.monotonic() + (VRP_TIME_LIMIT if time_limit is None else time_limit)
+
+    located, overflow = [], []
+    for client in clients:
+        coords = get_client_coordinates(client)
+        if coords:
+            located.append((client, coords))
+        else:
+            overflow.append(client)
+    if not located or not slots:
+        return [[] for _ in slots], overflow + [c for c, _ in located]
+
+    data = _vrp_build_data(located, depot, CAPACITE_VEHICULE_BOUQUETS, DUREE_MAX_TOURNEE_MIN, max_arrets)
+    tt = data["tt"]
+    routes = [{"nodes": [], "weekday": slot["weekday"]} for slot in slots]
+
+    node_by_id = {client.get("id"): u for u, (client, _) in enumerate(located, start=1)}
+    if initial:
+        for route, ids in zip(routes, initial):
+            route["nodes"] = [node_by_id[i] for i in ids if i in node_by_id]
+    relaxed = set()
+    for route in routes:
+        _vrp_refresh(route, data)
+        # Tournée reprise du plan précédent: ses créneaux relâchés le restent
+        late = [u for u, b in zip(route["nodes"], route["b"]) if b > data["close"][u] + 1e-9]
+        while late:
+            data["open"][late[0]], data["close"][late[0]] = 0.0, float("inf")
+            relaxed.add(late[0])
+            _vrp_refresh(route, data)
+            late = [u for u, b in zip(route["nodes"], route["b"]) if b > data["close"][u] + 1e-9]
+
+    placed = {u for route in routes for u in route["nodes"]}
+
+    # Construction: jours imposés d'abord, puis créneaux serrés, puis les plus éloignés
+    order = sorted((u for u in range(1, len(located) + 1) if u not in placed), key=lambda u: (
+        len(data["jours"][u]) if data["jours"][u] else 99,
+        data["close"][u] - data["open"][u],
+        -tt[0][u],
+    ))
+    for u in order:
+        if not _vrp_route_feasible([u], data):
+            data["open"][u], data["close"][u] = 0.0, float("inf")
+            relaxed.add(u)
+        best = _vrp_balanced_insertion(u, routes, data)
+        if best is None:
+            overflow.append(located[u - 1][0])
+            continue
+        _, r, p = best
+        routes[r]["nodes"].insert(p, u)
+        _vrp_refresh(routes[r], data)
+
+    # Recherche locale (replanification complète uniquement)
+    improved = not initial
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for route in routes:
+            k = 0
+            while k < len(route["nodes"]) and time.monotonic() < deadline:
+                nodes = route["nodes"]
+                u = nodes[k]
+                prev = nodes[k - 1] if k > 0 else 0
+                nxt = nodes[k + 1] if k + 1 < len(nodes) else 0
+                gain = tt[prev][u] + tt[u][nxt] - tt[prev][nxt]
+                before = _slot_charge(route, data)
+                after = 0.0 if len(nodes) == 1 else max(
+                    0.0, before - (gain + data["service"][u]) / data["duree_max"] - data["demand"][u] / data["capacite"])
+                removal = gain + POIDS_EQUILIBRAGE_MIN * (before ** 2 - after ** 2)
+
+                best = _vrp_balanced_insertion(u, routes, data, skip=route)
+                if best and best[0] < removal - 1e-6:
+                    _, r, p = best
+                    nodes.pop(k)
+                    routes[r]["nodes"].insert(p, u)
+                    _vrp_refresh(routes[r], data)
+                    _vrp_refresh(route, data)
+                    improved = True
+                else:
+                    k += 1
+            if _vrp_improve_route(route, data, deadline):
+                improved = True
+
+    tournees = []
+    for route in routes:
+        tournee = []
+        for u in route["nodes"]:
+            client = located[u - 1][0]
+            if u in relaxed:
+                client = dict(client, creneau_relache=True)
+            tournee.append(client)
+        tournees.append(tournee)
+    return tournees, overflow
+
+
+def plan_week(clients: list, slots: list, initial: list = None, time_limit: float = None):
+    """plan_week_tours par dépôt (chaque dépôt a ses propres créneaux/livreurs)
+
+    Returns:
+        (tournées alignées sur `slots`, clients non placés)
+    """
+    tournees = [[] for _ in slots]
+    overflow = []
+
+    clients_par_depot = defaultdict(list)
+    for client in clients:
+        clients_par_depot[get_zone_depot_key(client.get("code_postal", ""))].append(client)
+
+    for depot_key, depot_clients in clients_par_depot.items():
+        indices = [i for i, slot in enumerate(slots) if slot["depot"] == depot_key]
+        depot = get_zone_depot(depot_clients[0].get("code_postal", ""))
+        depot_tours, depot_overflow = plan_week_tours(
+            depot_clients, [slots[i] for i in indices], depot=depot,
+            initial=[initial[i] for i in indices] if initial else None, time_limit=time_limit
+        )
+        for i, tournee in zip(indices, depot_tours):
+            tournees[i] = tournee
+        overflow.extend(depot_overflow)
+
+    return tournees, overflow
+
+
+# ==================== PLANNING TOURNÉES ====================
+
+# Référentiel des zones (data/zones.json): code postal → zone, ordre de passage
+# et dépôt. Une zone liste ses codes ("codes") ou des préfixes ("prefixes");
+# les codes explicites priment, puis le préfixe le plus long. Étendre la
+# couverture = éditer le fichier, sans toucher au code.
+ZONES_PATH = os.environ.get("ZONES_PATH", os.path.join(DATA_DIR, "zones.json"))
+ZONE_AUTRE = {"nom": "Autre", "ordre": 999, "depot": None}
+
+
+@functools.lru_cache(maxsize=1)
+def load_zone_registry() -> dict:
+    """Charge data/zones.json et construit les tables de recherche en O(1)"""
+    with open(ZONES_PATH, encoding="utf-8") as f:
+        config = json.load(f)
+
+    by_code, by_prefix = {}, {}
+    for zone in config.get("zones", []):
+        base = {"nom": zone["nom"], "ordre": zone["ordre"], "depot": zone.get("depot")}
+        for rank, code in enumerate(zone.get("codes", [])):
+            # L'ordre de la liste sert d'ordre de passage à l'intérieur de la zone
+            by_code[code] = dict(base, ordre=zone["ordre"] + rank)
+        for prefix in zone.get("prefixes", []):
+            by_prefix[prefix] = base
+
+    departements = sorted({code[:2] for code in by_code} | {prefix[:2] for prefix in by_prefix})
+    return {
+        "by_code": by_code,
+        "by_prefix": by_prefix,
+        "prefix_lengths": sorted({len(p) for p in by_prefix}, reverse=True),
+        "depots": config.get("depots", {}),
+        "postal_code_re": re.compile(r"\b((?:%s)\d{3})\b" % "|".join(departements)),
+    }
+
+
+def lookup_zone(code_postal: str) -> dict:
+    """Zone d'un code postal: {"nom", "ordre", "depot"} (ZONE_AUTRE si inconnu)"""
+    if not code_postal:
+        return ZONE_AUTRE
+    registry = load_zone_registry()
+    zone = registry["by_code"].get(code_postal)
+    if zone:
+        return zone
+    for length in registry["prefix_lengths"]:
+        zone = registry["by_prefix"].get(code_postal[:length])
+        if zone:
+            return zone
+    return ZONE_AUTRE
+
+
+def extract_postal_code(address: str) -> str:
+    """Extrait le code postal d'une adresse (départements couverts par le référentiel)"""
+    match = load_zone_registry()["postal_code_re"].search(address or "")
+    return match.group(1) if match else ""
+
+
+def get_zone_order(code_postal: str) -> int:
+    """Retourne un ordre de zone pour optimiser le parcours géographique.
+    Ordre: Paris centre → Paris périphérique → Banlieue proche → Banlieue loin
+    """
+    return lookup_zone(code_postal)["ordre"]
+
+
+def get_zone_depot_key(code_postal: str):
+    """Clé du dépôt d'une zone, normalisée pour grouper les problèmes de tournées.
+
+    Une zone sans dépôt (ZONE_AUTRE) ou rattachée à un dépôt sans coordonnées
+    ("atelier": null) part de DEPOT: toutes ces zones partagent la clé None.
+    """
+    key = lookup_zone(code_postal)["depot"]
+    return key if load_zone_registry()["depots"].get(key) else None
+
+
+def get_zone_depot(code_postal: str) -> dict:
+    """Dépôt de départ des tournées pour une zone (DEPOT par défaut)"""
+    return load_zone_registry()["depots"].get(get_zone_depot_key(code_postal)) or DEPOT
+
+
+def classify_clients(clients: list) -> list:
+    """Renseigne code_postal, zone et zone_ordre de chaque client, en une passe"""
+    postal_code_re = load_zone_registry()["postal_code_re"]
+    for client in clients:
+        code_postal = client.get("code_postal")
+        if not code_postal:
+            match = postal_code_re.search(client.get("adresse") or "")
+            code_postal = match.group(1) if match else ""
+        zone = lookup_zone(code_postal)
+        client["code_postal"] = code_postal
+        client["zone"] = zone["nom"]
+        client["zone_ordre"] = zone["ordre"]
+    return clients
+
+
+def generate_google_maps_url(clients: list, start_address: str = None) -> str:
+    """Génère un lien Google Maps avec l'itinéraire optimisé.
+
+    Format: https://www.google.com/maps/dir/origin/stop1/stop2/.../destination
+    """
+    import urllib.parse
+
+    if not clients:
+        return ""
+
+    addresses = []
+
+    # Point de départ (optionnel)
+    if start_address:
+        addresses.append(start_address)
+
+    # Ajouter toutes les adresses clients
+    for client in clients:
+        addr = client.get("adresse", "")
+        if addr:
+            addresses.append(addr)
+
+    if not addresses:
+        return ""
+
+    # Encoder les adresses pour l'URL
+    encoded_addresses = [urllib.parse.quote(addr) for addr in addresses]
+
+    # Construire l'URL Google Maps
+    url = "https://www.google.com/maps/dir/" + "/".join(encoded_addresses)
+
+    return url
+
+
+def get_geographic_zone(code_postal: str) -> str:
+    """Retourne la zone géographique pour grouper les clients."""
+    return lookup_zone(code_postal)["nom"]
+
+
+def split_into_tournees(clients: list, max_clients_per_tournee: int = 12) -> list:
+    """Divise les clients en plusieurs tournées réalistes.
+
+    Les tournées sont construites par solve_cvrptw: capacité du véhicule,
+    durée max d'une journée, créneaux préférés et temps de trajet réels,
+    avec au plus `max_clients_per_tournee` arrêts par tournée.
+    """
+    if not clients:
+        return []
+
+    # Un problème par dépôt (zones rattachées à des dépôts différents)
+    clients_par_depot = defaultdict(list)
+    for client in clients:
+        clients_par_depot[get_zone_depot_key(client.get("code_postal", ""))].append(client)
+
+    tournees = []
+    for depot_clients in clients_par_depot.values():
+        depot = get_zone_depot(depot_clients[0].get("code_postal", ""))
+        tournees.extend(solve_cvrptw(depot_clients, depot=depot, max_arrets=max_clients_per_tournee))
+
+    if len(clients_par_depot) > 1:
+        tournees.sort(key=lambda t: min(get_zone_order(c.get("code_postal", "")) for c in t))
+    return tournees
+
+
+# Plan de tournées mémoïsé: recalculé seulement quand les clients actifs changent.
+# Le dernier plan est partagé entre workers via la base d'état, et les numéros de
+# tournée sont conservés d'un plan à l'autre (table tournee_numeros).
+STATE_DB_SCHEMA.append(
+    "CREATE TABLE IF NOT EXISTS tour_plans (fingerprint TEXT PRIMARY KEY, plan TEXT NOT NULL, created_at TEXT NOT NULL)"
+)
+STATE_DB_SCHEMA.append(
+    "CREATE TABLE IF NOT EXISTS tournee_numeros (client_id TEXT PRIMARY KEY, numero INTEGER NOT NULL, updated_at TEXT NOT NULL)"
+)
+
+# Sans changement signalé (génération "tour_plan", incrémentée par chaque écriture
+# client / livraison passant par l'API, dans n'importe quel worker), le plan en
+# mémoire est réutilisé sans rien télécharger pendant TOUR_PLAN_REUSE_SECONDS.
+# Au-delà, clients et livraisons sont relus pour voir les modifications faites
+# directement dans Airtable, et l'empreinte décide s'il faut recalculer.
+TOUR_PLAN_REUSE_SECONDS = int(os.environ.get("TOUR_PLAN_REUSE_SECONDS", 300))
+
+_tour_plan_cache = {"fingerprint": None, "plan": None, "generation": None, "checked_at": 0.0, "date": None}
+_tour_plan_lock = threading.Lock()
+
+
+def tour_plan_fingerprint(clients_to_deliver: list) -> str:
+    """Empreinte des clients actifs (tous les champs utilisés par le plan) et du jour"""
+    payload = json.dumps([datetime.now().date().isoformat(), clients_to_deliver], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def invalidate_tour_plan():
+    """Oublie le plan mémoïsé en mémoire (à appeler quand une fiche client change).
+
+    Le dernier plan reste en base: il sert de point de départ à la
+    replanification incrémentale.
+    """
+    with _tour_plan_lock:
+        _tour_plan_cache["fingerprint"], _tour_plan_cache["plan"] = None, None
+    try:
+        conn = get_state_db()
+        try:
+            conn.execute("INSERT INTO sequences (name, value) VALUES ('tour_plan', 1) "
+                         "ON CONFLICT (name) DO UPDATE SET value = value + 1")
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"[PLANNING] Invalidation non partagée: {e}")
+
+
+def _tour_plan_generation() -> int:
+    conn = get_state_db()
+    try:
+        row = conn.execute("SELECT value FROM sequences WHERE name = 'tour_plan'").fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else 0
+
+
+def _remember_tour_plan(fingerprint: str, plan: dict, generation: int):
+    """Garde une copie du plan en mémoire (l'appelant peut modifier le sien)"""
+    plan = copy.deepcopy(plan)
+    with _tour_plan_lock:
+        _tour_plan_cache.update({
+            "fingerprint": fingerprint,
+            "plan": plan,
+            "generation": generation,
+            "checked_at": time.monotonic(),
+            "date": datetime.now().date(),
+        })
+
+
+_PLAN_CLIENT_COMPUTED_KEYS = ("eta", "creneau_manque", "creneau_relache")
+
+
+def _replan_incremental(previous: dict, clients_to_deliver: list, slots: list):
+    """Reprend le plan précédent en ne traitant que les clients ajoutés/retirés/modifiés.
+
+    Returns:
+        (tournées par créneau, tournées hors créneaux) ou None s'il faut tout replanifier
+    """
+    if not previous or previous.get("slots") != slots:
+        return None
+
+    new_by_id = {c["id"]: c for c in clients_to_deliver}
+    kept_ids = set()
+    initial = [[] for _ in slots]
+    hors_creneaux = []
+    for tournee in previous.get("tournees", []):
+        kept = []
+        for client in tournee.get("clients", []):
+            raw = {k: v for k, v in client.items() if k not in _PLAN_CLIENT_COMPUTED_KEYS}
+            if new_by_id.get(raw.get("id")) == raw:
+                kept.append(raw["id"])
+        kept_ids.update(kept)
+        if tournee.get("slot") is not None:
+            initial[tournee["slot"]] = kept
+        elif kept:
+            hors_creneaux.append([new_by_id[i] for i in kept])
+
+    previous_ids = {c.get("id") for t in previous.get("tournees", []) for c in t.get("clients", [])}
+    changes = len(set(new_by_id) - kept_ids) + len(previous_ids - kept_ids)
+    if changes > PLAN_INCREMENTAL_MAX:
+        return None
+
+    hors_creneaux_ids = {c["id"] for t in hors_creneaux for c in t}
+    slot_clients = [c for c in clients_to_deliver if c["id"] not in hors_creneaux_ids]
+    slot_tours, overflow = plan_week(slot_clients, slots, initial=initial)
+    if overflow:
+        return None
+    print(f"[PLANNING] Plan repris de façon incrémentale ({changes} changements)")
+    return slot_tours, hors_creneaux
+
+
+def assign_stable_tour_numbers(tournees_clients: list) -> list:
+    """Attribue à chaque tournée le numéro qu'avaient la plupart de ses clients.
+
+    Les tournées sont appariées aux numéros précédents par nombre de clients
+    en commun (les plus forts recouvrements d'abord); les nouvelles tournées
+    prennent les plus petits numéros libres.
+
+    Returns:
+        liste des numéros, alignée sur `tournees_clients`
+    """
+    conn = get_state_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            previous = dict(conn.execute("SELECT client_id, numero FROM tournee_numeros").fetchall())
+
+            overlaps = []
+            for t, clients in enumerate(tournees_clients):
+                votes = defaultdict(int)
+                for client in clients:
+                    if client.get("id") in previous:
+                        votes[previous[client["id"]]] += 1
+                overlaps.extend((-count, t, numero) for numero, count in votes.items())
+
+            numeros = [None] * len(tournees_clients)
+            used = set()
+            for _, t, numero in sorted(overlaps):
+                if numeros[t] is None and numero not in used:
+                    numeros[t] = numero
+                    used.add(numero)
+
+            next_numero = 1
+            for t in range(len(numeros)):
+                if numeros[t] is None:
+                    while next_numero in used:
+                        next_numero += 1
+                    numeros[t] = next_numero
+                    used.add(next_numero)
+
+            now = datetime.now(timezone.utc).isoformat()
+            conn.execute("DELETE FROM tournee_numeros")
+            conn.executemany(
+                "INSERT INTO tournee_numeros (client_id, numero, updated_at) VALUES (?, ?, ?)",
+                [(c["id"], numeros[t], now) for t, clients in enumerate(tournees_clients) for c in clients if c.get("id")]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+    return numeros
+
+
+def prepare_tournees():
+    """Prépare PLUSIEURS tournées optimisées, réparties sur différents jours.
+
+    Le plan est mémoïsé par empreinte des clients actifs: tant qu'aucun client
+    ne change, inbox, dispatch et résumé réutilisent le même plan (et donc les
+    mêmes numéros de tournée). Chaque appel reçoit sa propre copie du plan.
+    """
+    # Le plan mémoïsé n'est jamais modifié en place (remplacé ou oublié d'un bloc):
+    # une fois lu sous le verrou, il peut être copié sans le tenir
+    generation = _tour_plan_generation()
+    with _tour_plan_lock:
+        cached = dict(_tour_plan_cache)
+    if (cached["plan"] is not None and cached["generation"] == generation
+            and cached["date"] == datetime.now().date()
+            and time.monotonic() - cached["checked_at"] < TOUR_PLAN_REUSE_SECONDS):
+        return copy.deepcopy(cached["plan"])
+
+    _, _, all_clients = get_existing_clients()
+
+    # Seuls les clients dus cette semaine (Fréquence + historique des livraisons)
+    due_ids = get_due_client_ids(all_clients, get_livraisons())
+
+    # Récupérer tous les clients actifs avec une adresse
+    clients_to_deliver = []
+    clients_non_dus = 0
+    for client in all_clients:
+        fields = client.get("fields", {})
+
+        if not fields.get("Actif", False):
+            continue
+
+        if client["id"] not in due_ids:
+            clients_non_dus += 1
+            continue
+
+        adresse = fields.get("Adresse", "")
+        if not adresse:
+            continue
+
+        clients_to_deliver.append({
+            "id": client["id"],
+            "nom": fields.get("Nom", ""),
+            "adresse": adresse,
+            "lat": fields.get("Latitude"),
+            "lon": fields.get("Longitude"),
+            "nb_bouquets": fields.get("Nb_Bouquets", 1),
+            "creneau": fields.get("Créneau_Préféré", ""),
+            "pref_couleurs": fields.get("Pref_Couleurs", ""),
+            "pref_style": fields.get("Pref_Style", ""),
+        })
+
+    classify_clients(clients_to_deliver)
+
+    if not clients_to_deliver:
+        return {
+            "total_clients": 0,
+            "total_bouquets": 0,
+            "clients_non_dus": clients_non_dus,
+            "tournees": [],
+            "message": "Aucun client actif à livrer cette semaine"
+        }
+
+    fingerprint = tour_plan_fingerprint(clients_to_deliver)
+    with _tour_plan_lock:
+        plan = _tour_plan_cache["plan"] if _tour_plan_cache["fingerprint"] == fingerprint else None
+        if plan is not None:
+            _tour_plan_cache.update({"generation": generation, "checked_at": time.monotonic()})
+    if plan is not None:
+        return copy.deepcopy(plan)
+
+    conn = get_state_db()
+    try:
+        row = conn.execute("SELECT plan FROM tour_plans WHERE fingerprint = ?", (fingerprint,)).fetchone()
+        latest = conn.execute("SELECT plan FROM tour_plans ORDER BY created_at DESC LIMIT 1").fetchone()
+    finally:
+        conn.close()
+    if row:
+        plan = json.loads(row[0])
+        _remember_tour_plan(fingerprint, plan, generation)
+        return plan
+
+    # Répartir sur les créneaux de la semaine (jours × livreurs), en reprenant
+    # le plan précédent quand seuls quelques clients ont changé
+    slots = get_week_slots(clients_to_deliver)
+    incremental = _replan_incremental(json.loads(latest[0]) if latest else None, clients_to_deliver, slots)
+    if incremental:
+        slot_tours, hors_creneaux = incremental
+    else:
+        slot_tours, overflow = run_planning_task(plan_week, clients_to_deliver, slots)
+        # Ce qui ne tient pas dans la semaine part en tournées supplémentaires à planifier
+        hors_creneaux = run_planning_task(split_into_tournees, overflow, max_clients_per_tournee=12)
+
+    tour_slots = [i for i, clients in enumerate(slot_tours) if clients] + [None] * len(hors_creneaux)
+    tournees_clients = [clients for clients in slot_tours if clients] + hors_creneaux
+    numeros = assign_stable_tour_numbers(tournees_clients)
+
+    # Horaires de passage de toutes les tournées, en une passe
+    depots = [get_zone_depot(clients[0].get("code_postal", "")) for clients in tournees_clients]
+    timings = compute_tour_etas(tournees_clients, depots)
+
+    # Construire les tournées avec leurs infos
+    tournees = []
+    for numero, slot_index, clients, depot, route in sorted(
+            zip(numeros, tour_slots, tournees_clients, depots, timings), key=lambda x: x[0]):
+        slot = slots[slot_index] if slot_index is not None else None
+        # L'ordre de passage vient du solveur (créneaux respectés)
+        optimized = [
+            dict(client, eta=eta["arrivee"], creneau_manque=eta["creneau_manque"])
+            for client, eta in zip(clients, route["etas"])
+        ]
+
+        # Zones couvertes
+        zones_couvertes = list(set(c.get("zone", "Autre") for c in optimized))
+
+        if slot:
+            jour = f"{slot['jour']} {datetime.strptime(slot['date'], '%Y-%m-%d').strftime('%d/%m/%Y')}"
+        else:
+            jour = "À planifier"
+
+        tournees.append({
+            "numero": numero,
+            "jour": jour,
+            "date": slot["date"] if slot else None,
+            "livreur": slot["livreur"] if slot else None,
+            "slot": slot_index,
+            "clients": optimized,
+            "nb_clients": len(optimized),
+            "nb_bouquets": sum(c.get("nb_bouquets", 1) for c in optimized),
+            "zones": zones_couvertes,
+            "google_maps_url": generate_google_maps_url(optimized, depot["adresse"] or None),
+            "depot": depot["nom"],
+            "distance_km": route["distance_km"],
+            "duree_estimee": f"{route['duree_min']}min",  # trajet + service + attentes de créneau
+            "duree_min": route["duree_min"],
+            "heure_depart": HEURE_DEPART_DEPOT,
+            "heure_retour": route["heure_retour"],
+            "creneaux_manques": route["creneaux_manques"],
+        })
+
+    plan = {
+        "total_clients": len(clients_to_deliver),
+        "total_bouquets": sum(c.get("nb_bouquets", 1) for c in clients_to_deliver),
+        "clients_non_dus": clients_non_dus,
+        "nb_tournees": len(tournees),
+        "tournees": tournees,
+        "slots": slots,
+        "charge_par_jour": [
+            {
+                "jour": t["jour"],
+                "livreur": t["livreur"],
+                "duree_min": t["duree_min"],
+                "nb_bouquets": t["nb_bouquets"],
+            }
+            for t in sorted((t for t in tournees if t["slot"] is not None), key=lambda t: t["slot"])
+        ],
+        "message": f"{len(tournees)} tournées générées pour {len(clients_to_deliver)} clients"
+    }
+
+    conn = get_state_db()
+    try:
+        conn.execute("DELETE FROM tour_plans WHERE fingerprint != ?", (fingerprint,))
+        conn.execute(
+            "INSERT OR REPLACE INTO tour_plans (fingerprint, plan, created_at) VALUES (?, ?, ?)",
+            (fingerprint, json.dumps(plan, default=str), datetime.now(timezone.utc).isoformat())
+        )
+    finally:
+        conn.close()
+    _remember_tour_plan(fingerprint, plan, generation)
+    return plan
+
+
+GREFFE_TOP_K = 3  # options de greffe proposées par client
+
+
+def compute_greffe_options(clients: list, tournees: list, k: int = GREFFE_TOP_K) -> list:
+    """Meilleures insertions ("greffes") des clients en attente dans les tournées prévues.
+
+    Pour une tournée dépôt → a → b → … → dépôt, insérer u entre a et b coûte
+    d(a,u) + d(u,b) - d(a,b). Le surcoût est évalué d'un bloc (NumPy) pour
+    tous les clients et toutes les positions de chaque tournée, puis on garde
+    la meilleure position par tournée et les k meilleures tournées par client.
+    Les tournées pleines (arrêts ou capacité du véhicule) sont exclues.
+
+    Returns:
+        liste alignée sur `clients`: options triées par minutes ajoutées
+    """
+    options = [[] for _ in clients]
+    client_coords = [get_client_coordinates(c) for c in clients]
+    located = [i for i, coords in enumerate(client_coords) if coords]
+    if not located or not tournees:
+        return options
+
+    # Chemins dépôt → arrêts localisés → dépôt, concaténés pour une seule lecture de la matrice
+    paths, all_points = [], []
+    for tournee in tournees:
+        tournee_depot = get_zone_depot(tournee["clients"][0].get("code_postal", "")) if tournee["clients"] else DEPOT
+        depot = (tournee_depot["lat"], tournee_depot["lon"])
+        stops = [(pos, coords) for pos, coords in
+                 enumerate(get_client_coordinates(c) for c in tournee["clients"]) if coords]
+        points = [depot] + [coords for _, coords in stops] + [depot]
+        legs_km, legs_min = distance_store_query(points)
+        paths.append({
+            "offset": len(all_points),
+            "size": len(points),
+            "positions": [pos for pos, _ in stops],
+            "legs_km": np.diagonal(legs_km, offset=1),
+            "legs_min": np.diagonal(legs_min, offset=1),
+        })
+        all_points.extend(points)
+
+    distances, durees = distance_store_query([client_coords[i] for i in located], all_points)
+
+    n, nb_tournees = len(located), len(tournees)
+    added_min = np.full((n, nb_tournees), np.inf)
+    added_km = np.zeros((n, nb_tournees))
+    best_pos = np.zeros((n, nb_tournees), dtype=np.intp)
+    rows = np.arange(n)
+    for j, path in enumerate(paths):
+        block = slice(path["offset"], path["offset"] + path["size"])
+        d, t = distances[:, block], durees[:, block]
+        delta_min = t[:, :-1] + t[:, 1:] - path["legs_min"][None, :]
+        delta_km = d[:, :-1] + d[:, 1:] - path["legs_km"][None, :]
+        best = delta_min.argmin(axis=1)
+        added_min[:, j] = delta_min[rows, best]
+        added_km[:, j] = delta_km[rows, best]
+        best_pos[:, j] = best
+
+    # Temps de service du client greffé + exclusion des tournées pleines
+    service = np.array([temps_service(clients[i]) for i in located])
+    demand = np.array([max(1, int(clients[i].get("nb_bouquets", 1) or 1)) for i in located])
+    added_min += service[:, None]
+    nb_clients = np.array([t.get("nb_clients", 0) for t in tournees])
+    nb_bouquets = np.array([t.get("nb_bouquets", 0) for t in tournees])
+    full = (nb_clients >= 12)[None, :] | (nb_bouquets[None, :] + demand[:, None] > CAPACITE_VEHICULE_BOUQUETS)
+    added_min[full] = np.inf
+
+    k = min(k, nb_tournees)
+    top = np.argsort(added_min, axis=1, kind="stable")[:, :k]
+    for row, i in enumerate(located):
+        for j in top[row]:
+            if not np.isfinite(added_min[row, j]):
+                break
+            tournee, path = tournees[j], paths[j]
+            p = int(best_pos[row, j])  # insertion après le p-ième nœud du chemin (0 = dépôt)
+            apres = tournee["clients"][path["positions"][p - 1]].get("nom", "") if p > 0 else "Départ dépôt"
+            temps_ajoute = int(round(added_min[row, j]))
+            options[i].append({
+                "type": "greffe",
+                "tournee_id": tournee.get("numero"),
+                "tournee_nom": f"Tournée {tournee.get('numero')} - {tournee.get('jour', 'À planifier')}",
+                "tournee_jour": tournee.get("jour", "À planifier"),
+                "temps_ajoute": temps_ajoute,
+                "km_ajoutes": round(float(added_km[row, j]), 1),
+                "position": path["positions"][p - 1] + 1 if p > 0 else 0,
+                "apres_client": apres,
+                "depasse_duree_max": tournee.get("duree_min", 0) + temps_ajoute > DUREE_MAX_TOURNEE_MIN,
+                "nb_clients_tournee": tournee.get("nb_clients", 0)
+            })
+
+    return options
+
+
+MINI_TOURNEE_RAYON_KM = 2.0   # distance max entre deux voisins d'une mini-tournée
+MINI_TOURNEE_MIN_CLIENTS = 3  # taille minimale d'une mini-tournée
+
+
+def propose_mini_tournees(clients: list) -> list:
+    """Propose des mini-tournées concrètes à partir des clients en attente.
+
+    Les clients localisés sont regroupés par proximité (dbscan_clusters), puis
+    chaque groupe (12 arrêts max) est ordonné par optimize_route.
+
+    Returns:
+        liste de {"id", "indices", "clients", "nb_bouquets", "distance_km", "duree_min"}
+        où `indices` renvoie aux positions dans `clients`, dans l'ordre de passage
+    """
+    located = [(i, coords) for i, coords in enumerate(get_client_coordinates(c) for c in clients) if coords]
+    groups = dbscan_clusters([coords for _, coords in located], MINI_TOURNEE_RAYON_KM, MINI_TOURNEE_MIN_CLIENTS)
+
+    mini_tournees = []
+    for group in groups:
+        indices = [located[k][0] for k in group]
+        route = optimize_route([dict(clients[i], _inbox_index=i) for i in indices])
+        ordered = [c["_inbox_index"] for c in route["clients"]]
+        for start in range(0, len(ordered), 12):
+            chunk = ordered[start:start + 12]
+            if len(chunk) < MINI_TOURNEE_MIN_CLIENTS:
+                continue
+            if len(ordered) > 12:
+                route = optimize_route([dict(clients[i], _inbox_index=i) for i in chunk])
+                chunk = [c["_inbox_index"] for c in route["clients"]]
+            mini_tournees.append({
+                "id": len(mini_tournees) + 1,
+                "indices": chunk,
+                "clients": [{"nom": clients[i].get("nom", ""), "adresse": clients[i].get("adresse", "")} for i in chunk],
+                "nb_bouquets": sum(clients[i].get("nb_bouquets", 1) or 1 for i in chunk),
+                "distance_km": route["distance_km"],
+                "duree_min": route["duree_min"],
+            })
+
+    return mini_tournees
+
+
+def get_delivery_days(nb_tournees: int) -> list:
+    """Retourne une liste de jours de livraison pour N tournées.
+
+    Stratégie:
+    - Si 1 tournée: prochain mardi ou jeudi
+    - Si 2 tournées: mardi ET jeudi de la même semaine
+    - Si 3+ tournées: mardi/jeudi sur plusieurs semaines
+    """
+    today = datetime.now().date()
+    days = []
+
+    # Calculer le prochain mardi et jeudi
+    days_until_tuesday = (1 - today.weekday()) % 7
+    days_until_thursday = (3 - today.weekday()) % 7
+
+    if days_until_tuesday == 0:
         days_until_tuesday = 7
     if days_until_thursday == 0:
         days_until_thursday = 7
@@ -1304,9 +3489,391 @@ def get_suggested_delivery_day() -> str:
     return days[0] if days else "À planifier"
 
 
+# ==================== LIVRAISONS RÉCURRENTES ====================
+
+# Intervalle entre deux livraisons selon la Fréquence du client, en semaines
+# entières pour retomber sur le même jour de livraison (mardi/jeudi).
+FREQUENCE_JOURS = {
+    "Hebdomadaire": 7,
+    "Bimensuel": 14,
+    "Mensuel": 28,
+    "Bimestriel": 56,
+    "Trimestriel": 84,
+    "Semestriel": 182,
+}
+JOURS_LIVRAISON = (1, 3)  # mardi, jeudi (date.weekday())
+HORIZON_PLANIFICATION_JOURS = int(os.environ.get("HORIZON_PLANIFICATION_JOURS", 14))
+LIVRAISON_STATUTS_A_FAIRE = ("À planifier", "Planifiée")
+LIVRAISON_STATUTS_ANNULES = ("Annulée",)
+
+
+def parse_livraison_date(value):
+    """Date d'une livraison ("2026-01-20" ou ISO 8601), None si absente/invalide"""
+    if not value:
+        return None
+    try:
+        if "T" in str(value):
+            return datetime.fromisoformat(str(value).replace("Z", "+00:00")).date()
+        return datetime.strptime(str(value), "%Y-%m-%d").date()
+    except (ValueError, TypeError):
+        return None
+
+
+def next_delivery_slot(day):
+    """Premier jour de livraison (mardi ou jeudi) à partir de `day` inclus"""
+    return min(day + timedelta(days=(weekday - day.weekday()) % 7) for weekday in JOURS_LIVRAISON)
+
+
+def get_delivery_history(livraisons: list) -> dict:
+    """Historique par client: dernière livraison datée et livraisons encore à faire
+
+    Returns:
+        {client_id: {"derniere": date | None, "a_faire": [date | None, ...]}}
+    """
+    history = defaultdict(lambda: {"derniere": None, "a_faire": []})
+    for liv in livraisons:
+        fields = liv.get("fields", {})
+        statut = fields.get("Statut", "")
+        if statut in LIVRAISON_STATUTS_ANNULES:
+            continue
+        date_liv = parse_livraison_date(fields.get("Date"))
+        for client_id in fields.get("Client", []):
+            entry = history[client_id]
+            if date_liv and (entry["derniere"] is None or date_liv > entry["derniere"]):
+                entry["derniere"] = date_liv
+            if statut in LIVRAISON_STATUTS_A_FAIRE:
+                entry["a_faire"].append(date_liv)
+    return history
+
+
+def next_due_date(frequence: str, derniere, today):
+    """Prochaine échéance d'un client récurrent (aujourd'hui s'il n'a jamais été livré)"""
+    periode = FREQUENCE_JOURS.get(frequence)
+    if not periode:
+        return None
+    if derniere is None:
+        return today
+    return derniere + timedelta(days=periode)
+
+
+def compute_delivery_schedule(all_clients: list, livraisons: list, horizon_jours: int = None, today=None) -> list:
+    """Livraisons récurrentes dues dans l'horizon, d'après Fréquence et historique.
+
+    Chaque client actif avec adresse et Fréquence récurrente reçoit une
+    occurrence par échéance: dernière livraison (passée ou déjà planifiée)
+    + période, ramenée au prochain mardi/jeudi, puis de période en période.
+    Une livraison à faire encore sans date (créée par la synchro ou l'inbox)
+    tient lieu de prochaine occurrence: le client est ignoré.
+
+    Returns:
+        liste de {"client_id", "nom", "frequence", "date"} triée par date
+    """
+    today = today or datetime.now().date()
+    horizon_jours = HORIZON_PLANIFICATION_JOURS if horizon_jours is None else horizon_jours
+    fin = today + timedelta(days=horizon_jours)
+    history = get_delivery_history(livraisons)
+
+    schedule = []
+    for client in all_clients:
+        fields = client.get("fields", {})
+        if not fields.get("Actif", False) or not fields.get("Adresse"):
+            continue
+        frequence = fields.get("Fréquence", "")
+        entry = history.get(client["id"], {"derniere": None, "a_faire": []})
+        if None in entry["a_faire"]:
+            continue
+        due = next_due_date(frequence, entry["derniere"], today)
+        if due is None:
+            continue
+
+        periode = timedelta(days=FREQUENCE_JOURS[frequence])
+        slot = next_delivery_slot(max(due, today))
+        while slot <= fin:
+            schedule.append({
+                "client_id": client["id"],
+                "nom": fields.get("Nom", ""),
+                "frequence": frequence,
+                "date": slot,
+            })
+            slot = next_delivery_slot(slot + periode)
+
+    schedule.sort(key=lambda occ: (occ["date"], occ["nom"]))
+    return schedule
+
+
+def get_due_client_ids(all_clients: list, livraisons: list, horizon_jours: int = 7, today=None) -> set:
+    """Clients à livrer dans les `horizon_jours` prochains jours.
+
+    - livraison à faire (À planifier / Planifiée) non datée ou datée dans l'horizon
+    - échéance récurrente (Fréquence) tombant dans l'horizon
+    - client sans Fréquence renseignée: toujours dû
+    """
+    today = today or datetime.now().date()
+    fin = today + timedelta(days=horizon_jours)
+    history = get_delivery_history(livraisons)
+
+    due = {occ["client_id"] for occ in compute_delivery_schedule(all_clients, livraisons, horizon_jours, today)}
+    for client_id, entry in history.items():
+        if any(d is None or d <= fin for d in entry["a_faire"]):
+            due.add(client_id)
+    for client in all_clients:
+        frequence = client.get("fields", {}).get("Fréquence", "")
+        if not frequence:
+            due.add(client["id"])
+    return due
+
+
+def create_livraisons_batch(fields_list: list) -> dict:
+    """Crée des livraisons par lots de 10 (limite Airtable par requête)"""
+    url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_LIVRAISONS_TABLE}"
+    headers = get_airtable_headers()
+    results = {"created": [], "errors": []}
+
+    for i in range(0, len(fields_list), 10):
+        batch = fields_list[i:i + 10]
+        response = req.post(url, headers=headers, json={
+            "records": [{"fields": fields} for fields in batch]
+        })
+        if response.status_code == 200:
+            records = response.json().get("records", [])
+            record_livraisons(records)
+            results["created"].extend(records)
+        else:
+            print(f"[LIVRAISONS] Batch create error: {response.text}")
+            results["errors"].append(response.text)
+
+    return results
+
+
+def generate_recurring_livraisons(horizon_jours: int = None, dry_run: bool = False) -> dict:
+    """Génère en masse les livraisons récurrentes dues dans l'horizon"""
+    _, _, all_clients = get_existing_clients()
+    schedule = compute_delivery_schedule(all_clients, get_livraisons(), horizon_jours)
+
+    results = {
+        "horizon_jours": HORIZON_PLANIFICATION_JOURS if horizon_jours is None else horizon_jours,
+        "livraisons_prevues": len(schedule),
+        "livraisons_created": 0,
+        "dry_run": dry_run,
+        "echeances": [dict(occ, date=occ["date"].isoformat()) for occ in schedule],
+        "errors": []
+    }
+    if dry_run or not schedule:
+        return results
+
+    created = create_livraisons_batch([{
+        "Client": [occ["client_id"]],
+        "Statut": "À planifier",
+        "Type": "Récurrente",
+        "Date": occ["date"].isoformat(),
+        "Notes": f"Livraison {occ['frequence'].lower()} générée automatiquement"
+    } for occ in schedule])
+    results["livraisons_created"] = len(created["created"])
+    results["errors"] = created["errors"]
+    if created["created"]:
+        invalidate_tour_plan()
+    print(f"[PLANNING] {results['livraisons_created']}/{len(schedule)} livraisons récurrentes créées")
+    return results
+
+
+# ==================== SIMULATION DE CHARGE ====================
+
+SIMULATION_MAX_SEMAINES = 26
+
+
+def _premier_jour_possible(day, jours_imposes: set):
+    """Premier jour ≥ `day` parmi les jours imposés, sinon prochain mardi/jeudi"""
+    if jours_imposes:
+        return min(day + timedelta(days=(weekday - day.weekday()) % 7) for weekday in jours_imposes)
+    return next_delivery_slot(day)
+
+
+def simulate_capacity(all_clients: list, livraisons: list, nb_semaines: int = 12, stock_initial: int = 0,
+                      production_hebdo: int = 0, ca_mensuel: float = None, budget_percent: float = None,
+                      cout_livraison: float = None, nb_livreurs: int = None, today=None) -> dict:
+    """Rejoue les `nb_semaines` prochaines semaines de livraisons récurrentes.
+
+    Chaque client actif reçoit ses occurrences (Fréquence, dernière livraison,
+    jour imposé); les clients sans Fréquence comptent comme hebdomadaires (ils
+    sont toujours dus dans prepare_tournees), les Ponctuel sont ignorés. Les
+    livraisons déjà datées dans la fenêtre (non annulées, p. ex. générées par
+    /api/planning/generer) sont reprises telles quelles, les occurrences
+    récurrentes reprenant après elles.
+    Occurrences, charges journalières, stock et budget sont calculés d'un bloc
+    (NumPy); chaque journée distincte est découpée en tournées par le
+    constructeur de tournées (sans recherche locale), puis toutes les tournées
+    sont chronométrées en une passe (compute_tour_etas).
+    """
+    today = today or datetime.now().date()
+    nb_livreurs = nb_livreurs or NB_LIVREURS
+    start = today + timedelta(days=1)
+    horizon = nb_semaines * 7
+    history = get_delivery_history(livraisons)
+
+    # 1. Livraisons déjà datées dans la fenêtre (jour depuis `start`)
+    client_ids = {client["id"] for client in all_clients}
+    planned = set()
+    for liv in livraisons:
+        fields = liv.get("fields", {})
+        date_liv = parse_livraison_date(fields.get("Date"))
+        if fields.get("Statut", "") in LIVRAISON_STATUTS_ANNULES or not date_liv:
+            continue
+        if 0 <= (date_liv - start).days < horizon:
+            planned |= {(cid, (date_liv - start).days) for cid in fields.get("Client", []) if cid in client_ids}
+    planned_ids = {cid for cid, _ in planned}
+
+    # 2. Clients simulés: première occurrence récurrente (en jours depuis `start`) et période
+    sim_clients, sim_index, first, period = [], {}, [], []
+    for client in all_clients:
+        fields = client.get("fields", {})
+        frequence = fields.get("Fréquence", "")
+        periode = FREQUENCE_JOURS.get(frequence) or (7 if not frequence else None)
+        recurrent = bool(fields.get("Actif", False)) and periode is not None
+        if not fields.get("Adresse") or not (recurrent or client["id"] in planned_ids):
+            continue
+        creneau = fields.get("Créneau_Préféré", "")
+        if recurrent:
+            derniere = history[client["id"]]["derniere"] if client["id"] in history else None
+            due = max(start, derniere + timedelta(days=periode)) if derniere else start
+            jours = {JOURS_SEMAINE.index(jour) for jour in parse_creneau(creneau)["jours"]}
+            first.append((_premier_jour_possible(due, jours) - start).days)
+            period.append(periode)
+        else:
+            first.append(horizon)  # aucune occurrence récurrente
+            period.append(horizon)
+
+        sim_index[client["id"]] = len(sim_clients)
+        sim_clients.append({
+            "id": client["id"],
+            "nom": fields.get("Nom", ""),
+            "adresse": fields["Adresse"],
+            "lat": fields.get("Latitude"),
+            "lon": fields.get("Longitude"),
+            "nb_bouquets": fields.get("Nb_Bouquets", 1) or 1,
+            "creneau": creneau,
+        })
+    classify_clients(sim_clients)
+
+    # 3. Occurrences: matrice clients × répétitions masquée à l'horizon, plus les livraisons déjà datées
+    first, period = np.array(first, dtype=np.int64), np.array(period, dtype=np.int64)
+    bouquets = np.array([int(c["nb_bouquets"]) for c in sim_clients], dtype=np.int64)
+    deja_planifiees = np.array([(sim_index[cid], day) for cid, day in planned if cid in sim_index],
+                               dtype=np.int64).reshape(-1, 2)
+    if len(sim_clients):
+        repetitions = horizon // int(period.min()) + 1
+        occurrences = first[:, None] + period[:, None] * np.arange(repetitions)[None, :]
+        client_idx, _ = np.nonzero(occurrences < horizon)
+        pairs = np.unique(np.concatenate([
+            np.stack([client_idx, occurrences[occurrences < horizon]], axis=1), deja_planifiees
+        ]), axis=0)
+        client_idx, day_idx = pairs[:, 0], pairs[:, 1]
+    else:
+        client_idx = day_idx = np.zeros(0, dtype=np.int64)
+
+    livraisons_jour = np.bincount(day_idx, minlength=horizon)
+    bouquets_jour = np.bincount(day_idx, weights=bouquets[client_idx], minlength=horizon).astype(np.int64)
+    livraisons_semaine = livraisons_jour.reshape(nb_semaines, 7).sum(axis=1)
+    bouquets_semaine = bouquets_jour.reshape(nb_semaines, 7).sum(axis=1)
+    stock_fin_semaine = stock_initial + production_hebdo * np.arange(1, nb_semaines + 1) - np.cumsum(bouquets_semaine)
+
+    # 4. Tournées de chaque journée (les compositions identiques ne sont construites qu'une fois)
+    order = np.argsort(day_idx, kind="stable")
+    days_sorted, clients_sorted = day_idx[order], client_idx[order]
+    bounds = np.flatnonzero(np.diff(days_sorted)) + 1
+    plans, day_tours = {}, []
+    for day, members in zip(np.split(days_sorted, bounds), np.split(clients_sorted, bounds)):
+        if not len(day):
+            continue
+        date = start + timedelta(days=int(day[0]))
+        key = (date.weekday(), tuple(sorted(members.tolist())))
+        if key not in plans:
+            day_clients = [sim_clients[i] for i in key[1]]
+            slots = [{"jour": JOURS_SEMAINE[date.weekday()], "weekday": date.weekday(), "date": date.isoformat(),
+                      "livreur": livreur, "depot": depot_key}
+                     for depot_key in sorted({get_zone_depot_key(c["code_postal"]) for c in day_clients}, key=str)
+                     for livreur in range(1, nb_livreurs + 1)]
+            tours, overflow = plan_week(day_clients, slots, time_limit=0)
+            plans[key] = ([t for t in tours if t], len(overflow))
+        day_tours.append((int(day[0]), date, key))
+
+    unique_keys = list(plans)
+    all_tours = [t for key in unique_keys for t in plans[key][0]]
+    timings = iter(compute_tour_etas(all_tours))
+    durations = {key: [next(timings)["duree_min"] for _ in plans[key][0]] for key in unique_keys}
+
+    jours = []
+    for day, date, key in day_tours:
+        tours, non_places = plans[key]
+        jours.append({
+            "date": date.isoformat(),
+            "jour": JOURS_SEMAINE[date.weekday()],
+            "livraisons": int(livraisons_jour[day]),
+            "bouquets": int(bouquets_jour[day]),
+            "tournees": len(tours),
+            "duree_totale_min": int(sum(durations[key])),
+            "duree_max_min": int(max(durations[key], default=0)),
+            "non_places": non_places,
+        })
+
+    # 5. Budget par mois calendaire (livraisons non annulées déjà passées du mois en cours comprises)
+    months = np.array([(start + timedelta(days=d)).strftime("%Y-%m") for d in range(horizon)])
+    month_keys, month_idx = np.unique(months, return_inverse=True)
+    livraisons_mois = np.bincount(month_idx, weights=livraisons_jour, minlength=len(month_keys))
+    deja = defaultdict(int)
+    for liv in livraisons:
+        if liv.get("fields", {}).get("Statut", "") in LIVRAISON_STATUTS_ANNULES:
+            continue
+        date_liv = parse_livraison_date(liv.get("fields", {}).get("Date"))
+        if date_liv and date_liv < start and date_liv.strftime("%Y-%m") in month_keys:
+            deja[date_liv.strftime("%Y-%m")] += 1
+
+    settings = get_settings()
+    ca_mensuel = settings["ca_mensuel"] if ca_mensuel is None else ca_mensuel
+    cout_livraison = settings["cout_livraison"] if cout_livraison is None else cout_livraison
+    budget_percent = settings["budget_percent"] if budget_percent is None else budget_percent
+    budget_max = ca_mensuel * budget_percent / 100
+    budget = []
+    for month, count in zip(month_keys, livraisons_mois):
+        total = int(count) + deja[month]
+        cout = total * cout_livraison
+        budget.append({
+            "mois": str(month),
+            "livraisons": total,
+            "cout": cout,
+            "budget_max": budget_max,
+            "pourcentage": round(cout / budget_max * 100, 1) if budget_max > 0 else 0,
+            "depassement": cout > budget_max,
+        })
+
+    return {
+        "debut": start.isoformat(),
+        "nb_semaines": nb_semaines,
+        "nb_clients": len(sim_clients),
+        "livraisons_deja_planifiees": len(deja_planifiees),
+        "nb_livreurs": nb_livreurs,
+        "semaines": [{
+            "debut": (start + timedelta(days=7 * w)).isoformat(),
+            "livraisons": int(livraisons_semaine[w]),
+            "bouquets": int(bouquets_semaine[w]),
+            "stock_fin_semaine": int(stock_fin_semaine[w]),
+            "rupture": bool(stock_fin_semaine[w] < 0),
+        } for w in range(nb_semaines)],
+        "jours": jours,
+        "budget": budget,
+        "stock": {
+            "initial": stock_initial,
+            "production_hebdo": production_hebdo,
+            "demande_totale": int(bouquets_semaine.sum()),
+            "premiere_rupture": next(((start + timedelta(days=7 * w)).isoformat()
+                                      for w in range(nb_semaines) if stock_fin_semaine[w] < 0), None),
+        },
+        "jours_surcharges": sum(1 for j in jours if j["non_places"] or j["duree_max_min"] > DUREE_MAX_TOURNEE_MIN),
+    }
+
+
 # ==================== DISPATCH BOUQUETS ====================
 
-def get_available_bouquets():
+def fetch_available_bouquets():
     """Récupère tous les bouquets disponibles depuis Airtable"""
     url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_BOUQUETS_TABLE}"
     headers = get_airtable_headers()
@@ -1335,6 +3902,137 @@ def get_available_bouquets():
     return all_records
 
 
+# Index inversé du catalogue disponible (en mémoire, par worker):
+# (attribut, valeur) -> record_ids. Chargé une fois, puis tenu à jour à chaque
+# création / assignation (voir index_bouquet), rechargé complètement après le TTL.
+# Partagé entre les threads du worker: toute lecture ou écriture passe par _catalogue_lock.
+# Les écritures de bouquets incrémentent la génération "catalogue" de la base d'état:
+# un autre worker qui la voit changer recharge son index avant de le servir.
+CATALOGUE_INDEX_TTL = 900  # secondes
+_catalogue = {"records": {}, "postings": defaultdict(set), "keys": {}, "loaded_at": 0, "generation": None}
+_catalogue_lock = threading.Lock()
+
+
+def _catalogue_generation() -> int:
+    conn = get_state_db()
+    try:
+        row = conn.execute("SELECT value FROM sequences WHERE name = 'catalogue'").fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else 0
+
+
+def bump_catalogue_generation():
+    """Signale aux autres workers qu'un bouquet a été créé, assigné ou supprimé.
+
+    L'index de ce worker est déjà à jour (index_bouquet / forget_bouquet): il
+    adopte la nouvelle génération s'il était à jour de la précédente.
+    """
+    try:
+        generation = reserve_sequence("catalogue")
+    except sqlite3.Error as e:
+        print(f"[BOUQUETS] Génération du catalogue non partagée: {e}")
+        return
+    with _catalogue_lock:
+        if _catalogue["generation"] == generation - 1:
+            _catalogue["generation"] = generation
+
+
+def _bouquet_attribute_keys(fields: dict) -> set:
+    """Clés d'index d'un bouquet: couleurs, style, taille et saison normalisés"""
+    colors = fields.get("Couleurs", [])
+    tokens = normalize_text(colors) if isinstance(colors, str) else [c.lower() for c in colors]
+    keys = {("couleur", t) for t in tokens}
+    keys.add(("style", fields.get("Style", "").lower()))
+    keys.add(("taille", fields.get("Taille", "").lower()))
+    keys.add(("saison", str(fields.get("Saison", "")).lower()))
+    return keys
+
+
+def _catalogue_remove(catalogue: dict, record_id: str):
+    for key in catalogue["keys"].pop(record_id, ()):
+        catalogue["postings"][key].discard(record_id)
+        if not catalogue["postings"][key]:
+            del catalogue["postings"][key]
+    catalogue["records"].pop(record_id, None)
+
+
+def _catalogue_add(catalogue: dict, record: dict):
+    fields = record.get("fields", {})
+    if fields.get("Statut") != "Disponible":
+        return
+    keys = _bouquet_attribute_keys(fields)
+    catalogue["records"][record["id"]] = record
+    catalogue["keys"][record["id"]] = keys
+    for key in keys:
+        catalogue["postings"][key].add(record["id"])
+
+
+def catalogue_update(record: dict):
+    """Met à jour l'index pour un record bouquet (retiré s'il n'est plus disponible)"""
+    record_id = record.get("id")
+    if not record_id:
+        return
+    with _catalogue_lock:
+        if not _catalogue["loaded_at"]:
+            return
+        _catalogue_remove(_catalogue, record_id)
+        _catalogue_add(_catalogue, record)
+
+
+def catalogue_forget(record_id: str):
+    """Retire un bouquet de l'index (supprimé dans Airtable)"""
+    with _catalogue_lock:
+        _catalogue_remove(_catalogue, record_id)
+
+
+def get_available_bouquets():
+    """Retourne les bouquets disponibles depuis l'index (rechargé depuis Airtable si
+    périmé ou si un autre worker a modifié des bouquets).
+
+    Le nouvel index est construit à part puis échangé d'un bloc: les autres
+    threads voient l'ancien catalogue ou le nouveau, jamais un index partiel.
+    """
+    generation = _catalogue_generation()
+    with _catalogue_lock:
+        if (time.time() - _catalogue["loaded_at"] <= CATALOGUE_INDEX_TTL
+                and _catalogue["generation"] == generation):
+            return list(_catalogue["records"].values())
+
+    catalogue = {"records": {}, "postings": defaultdict(set), "keys": {}}
+    for record in fetch_available_bouquets():
+        _catalogue_add(catalogue, record)
+    catalogue["loaded_at"] = time.time()
+    catalogue["generation"] = generation
+
+    with _catalogue_lock:
+        _catalogue.update(catalogue)
+        return list(_catalogue["records"].values())
+
+
+def catalogue_candidates(client_prefs: dict) -> set:
+    """Bouquets disponibles qui matchent au moins une préférence (couleur, style ou taille).
+
+    Les autres ne peuvent obtenir que les points "pas incompatible" sur chaque critère.
+    """
+    candidates = set()
+    client_styles = normalize_text(client_prefs.get("pref_style", ""))
+    client_tailles = [TAILLE_MAP.get(t, t) for t in normalize_text(client_prefs.get("tailles", ""))]
+
+    with _catalogue_lock:
+        postings = _catalogue["postings"]
+        for token in normalize_text(client_prefs.get("pref_couleurs", "")):
+            candidates |= postings.get(("couleur", token), set())
+
+        for (attribute, value), record_ids in postings.items():
+            if attribute == "style" and any(s in value or value in s for s in client_styles):
+                candidates |= record_ids
+            elif attribute == "taille" and client_tailles and (value in client_tailles or any(t in value for t in client_tailles)):
+                candidates |= record_ids
+
+    return candidates
+
+
 def normalize_text(text: str) -> list:
     """Normalise un texte en liste de mots-clés pour la comparaison"""
     if not text:
@@ -1399,15 +4097,12 @@ def calculate_match_score(bouquet: dict, client_prefs: dict) -> dict:
     bouquet_taille = bouquet_fields.get("Taille", "").lower()
     client_tailles = normalize_text(client_prefs.get("tailles", ""))
 
-    # Mapping des tailles
-    taille_map = {"s": "petit", "m": "moyen", "l": "grand", "xl": "masterpiece"}
-
     if client_tailles:
         max_score += 25
         # Normaliser les tailles
         normalized_client = []
         for t in client_tailles:
-            normalized_client.append(taille_map.get(t, t))
+            normalized_client.append(TAILLE_MAP.get(t, t))
 
         if bouquet_taille in normalized_client or any(t in bouquet_taille for t in normalized_client):
             score += 25
@@ -1435,11 +4130,246 @@ def calculate_match_score(bouquet: dict, client_prefs: dict) -> dict:
     }
 
 
-def dispatch_for_tournee(tournee_num: int):
+# Mapping des tailles client (S/M/L/XL) vers les tailles bouquets
+TAILLE_MAP = {"s": "petit", "m": "moyen", "l": "grand", "xl": "masterpiece"}
+
+
+def _popcount_rows(masks):
+    """Nombre de bits à 1 par ligne d'un tableau uint64 (..., n_words)"""
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    as_bytes = np.ascontiguousarray(masks).view(np.uint8)
+    return table[as_bytes].sum(axis=-1, dtype=np.int64)
+
+
+def build_score_matrix(bouquets: list, clients_prefs: list):
+    """Calcule la matrice des scores (clients × bouquets) en une passe NumPy.
+
+    Même pondération et mêmes règles que calculate_match_score (couleurs 40,
+    style 35, taille 25), mais chaque texte n'est normalisé qu'une seule fois:
+    - couleurs: bitsets sur le vocabulaire commun, intersections par ET binaire
+    - style et taille: codes entiers, score lu dans une petite table par couple
+      (valeur client distincte, valeur bouquet distincte)
+
+    Returns:
+        np.ndarray int64 de forme (len(clients_prefs), len(bouquets))
+    """
+    n_clients, n_bouquets = len(clients_prefs), len(bouquets)
+    if not n_clients or not n_bouquets:
+        return np.zeros((n_clients, n_bouquets), dtype=np.int64)
+
+    bouquets_fields = [b.get("fields", {}) for b in bouquets]
+
+    # 1. Couleurs (poids: 40 points)
+    bouquet_colors = []
+    for fields in bouquets_fields:
+        colors = fields.get("Couleurs", [])
+        bouquet_colors.append(set(normalize_text(colors)) if isinstance(colors, str) else {c.lower() for c in colors})
+    client_colors = [set(normalize_text(p.get("pref_couleurs", ""))) for p in clients_prefs]
+
+    vocabulary = {}
+    for tokens in bouquet_colors + client_colors:
+        for token in tokens:
+            vocabulary.setdefault(token, len(vocabulary))
+    n_words = max(1, (len(vocabulary) + 63) // 64)
+
+    def encode_colors(token_sets):
+        masks = np.zeros((len(token_sets), n_words), dtype=np.uint64)
+        for row, tokens in enumerate(token_sets):
+            for token in tokens:
+                bit = vocabulary[token]
+                masks[row, bit // 64] |= np.uint64(1) << np.uint64(bit % 64)
+        return masks
+
+    bouquet_masks = encode_colors(bouquet_colors)
+    client_masks = encode_colors(client_colors)
+    nb_matching = _popcount_rows(client_masks[:, None, :] & bouquet_masks[None, :, :])
+    has_color_pref = np.array([bool(c) for c in client_colors])
+    color_scores = np.where(has_color_pref[:, None], np.minimum(40, nb_matching * 20), 20)
+
+    # 2. Style (poids: 35 points) et 3. Taille (poids: 25 points)
+    def style_score(client_styles, bouquet_style):
+        if not client_styles:
+            return 17
+        if any(s in bouquet_style or bouquet_style in s for s in client_styles):
+            return 35
+        return 10 if bouquet_style else 0
+
+    def taille_score(client_tailles, bouquet_taille):
+        if not client_tailles:
+            return 12
+        if bouquet_taille in client_tailles or any(t in bouquet_taille for t in client_tailles):
+            return 25
+        return 10
+
+    def lookup_scores(client_values, bouquet_values, score_fn):
+        client_codes, bouquet_codes = {}, {}
+        c_idx = np.array([client_codes.setdefault(v, len(client_codes)) for v in client_values])
+        b_idx = np.array([bouquet_codes.setdefault(v, len(bouquet_codes)) for v in bouquet_values])
+        table = np.array([[score_fn(c, b) for b in bouquet_codes] for c in client_codes], dtype=np.int64)
+        return table[c_idx[:, None], b_idx[None, :]]
+
+    style_scores = lookup_scores(
+        [tuple(normalize_text(p.get("pref_style", ""))) for p in clients_prefs],
+        [f.get("Style", "").lower() for f in bouquets_fields],
+        style_score
+    )
+    taille_scores = lookup_scores(
+        [tuple(TAILLE_MAP.get(t, t) for t in normalize_text(p.get("tailles", ""))) for p in clients_prefs],
+        [f.get("Taille", "").lower() for f in bouquets_fields],
+        taille_score
+    )
+
+    # Pourcentage (max_score vaut toujours 100), même arrondi que int() en Python
+    total = (color_scores + style_scores + taille_scores).astype(np.float64)
+    return (total / 100 * 100).astype(np.int64)
+
+
+def _client_prefs(client: dict) -> dict:
+    return {
+        "pref_couleurs": client.get("pref_couleurs", ""),
+        "pref_style": client.get("pref_style", ""),
+        "tailles": client.get("tailles", "")
+    }
+
+
+def _top_k(scores_row, candidates, k: int) -> list:
+    """Les k meilleurs candidats par score décroissant (tas; à égalité, l'ordre d'origine)"""
+    return heapq.nlargest(k, candidates, key=lambda j: (scores_row[j], -j))
+
+
+def assign_bouquets_greedy(scores, nb_needed: list) -> list:
+    """Assignation gloutonne: chaque client (dans l'ordre) prend ses meilleurs bouquets restants"""
+    remaining = set(range(scores.shape[1]))
+    assignment = []
+    for row, needed in enumerate(nb_needed):
+        chosen = _top_k(scores[row], remaining, needed)
+        remaining.difference_update(chosen)
+        assignment.append(chosen)
+    return assignment
+
+
+def assign_bouquets_optimal(scores, nb_needed: list) -> list:
+    """Assignation optimale: maximise la somme des scores sur toute la tournée (ou semaine).
+
+    Chaque client est dupliqué en nb_bouquets "places", puis on résout
+    l'affectation places × bouquets (algorithme hongrois, scipy). S'il y a
+    moins de bouquets que de places, les bouquets vont là où ils rapportent le plus.
+
+    Returns:
+        liste (par client) des indices de bouquets assignés, meilleur score d'abord
+    """
+    from scipy.optimize import linear_sum_assignment
+
+    slots = np.repeat(np.arange(len(nb_needed)), nb_needed)
+    assignment = [[] for _ in nb_needed]
+    if not len(slots) or not scores.shape[1]:
+        return assignment
+
+    slot_rows, bouquet_cols = linear_sum_assignment(scores[slots], maximize=True)
+    for slot, col in zip(slot_rows, bouquet_cols):
+        assignment[slots[slot]].append(col)
+
+    for row, chosen in enumerate(assignment):
+        chosen.sort(key=lambda j: -scores[row, j])
+    return assignment
+
+
+# Modes d'assignation disponibles pour le dispatch
+DISPATCH_MODES = {
+    "optimal": assign_bouquets_optimal,
+    "greedy": assign_bouquets_greedy,
+}
+
+# Derniers dispatchs calculés: empreinte (clients, bouquets, mode) -> résultats
+_dispatch_cache = OrderedDict()
+DISPATCH_CACHE_SIZE = 8
+
+
+def dispatch_clients(clients: list, bouquets: list, mode: str = "optimal") -> list:
+    """Calcule les suggestions de bouquets (+ 2 alternatives) pour une liste de clients.
+
+    Le résultat est mémorisé: rappeler avec les mêmes clients et le même stock
+    ne refait pas le calcul.
+    """
+    fingerprint = hashlib.sha1(json.dumps([
+        mode,
+        [[c.get("id", ""), c.get("nb_bouquets", 1), _client_prefs(c)] for c in clients],
+        [[b["id"], b.get("fields", {})] for b in bouquets]
+    ], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    cached = memo_get(_dispatch_cache, fingerprint)
+    if cached is not None:
+        return cached[0]
+
+    clients_prefs = [_client_prefs(c) for c in clients]
+    nb_needed = [int(c.get("nb_bouquets", 1) or 1) for c in clients]
+
+    # Génération de candidats via l'index: les bouquets qui matchent au moins une
+    # préférence sont tous gardés; parmi les autres, chaque client garde ses
+    # `places + 2` meilleurs par score. Chaque client conserve ainsi ses
+    # meilleurs bouquets toutes catégories confondues: l'assignation optimale et
+    # les alternatives sont les mêmes que sur le catalogue complet.
+    if _catalogue["loaded_at"]:
+        candidate_ids = set()
+        for prefs in clients_prefs:
+            candidate_ids |= catalogue_candidates(prefs)
+        others = [b for b in bouquets if b["id"] not in candidate_ids]
+        keep = sum(nb_needed) + 2
+        if len(others) > keep:
+            other_scores = build_score_matrix(others, clients_prefs)
+            best = np.argpartition(-other_scores, keep - 1, axis=1)[:, :keep]
+            candidate_ids.update(others[j]["id"] for j in np.unique(best))
+        else:
+            candidate_ids.update(b["id"] for b in others)
+        bouquets = [b for b in bouquets if b["id"] in candidate_ids]
+
+    # Scores de tous les couples (client, bouquet) en une seule passe vectorisée
+    scores = build_score_matrix(bouquets, clients_prefs)
+    assignment = run_planning_task(DISPATCH_MODES.get(mode, assign_bouquets_optimal), scores, nb_needed)
+
+    # Alternatives: meilleurs bouquets que l'assignation n'a donnés à personne
+    unassigned = np.ones(len(bouquets), dtype=bool)
+    for chosen in assignment:
+        unassigned[chosen] = False
+    free = list(np.flatnonzero(unassigned))
+
+    dispatch_results = []
+    for row, client in enumerate(clients):
+        nb_demandes = client.get("nb_bouquets", 1)
+        alternatives_idx = _top_k(scores[row], free, 2)
+
+        # Détails du match calculés uniquement pour les bouquets affichés
+        suggested = [calculate_match_score(bouquets[j], clients_prefs[row]) for j in assignment[row]]
+        alternatives = [calculate_match_score(bouquets[j], clients_prefs[row]) for j in alternatives_idx]
+
+        dispatch_results.append({
+            "client_id": client.get("id", ""),
+            "client_nom": client.get("nom", ""),
+            "client_adresse": client.get("adresse", ""),
+            "nb_demandes": nb_demandes,
+            "nb_suggeres": len(suggested),
+            "preferences": {
+                "couleurs": client.get("pref_couleurs", ""),
+                "style": client.get("pref_style", ""),
+                "tailles": client.get("tailles", ""),
+            },
+            "bouquets_suggeres": suggested,
+            "alternatives": alternatives,
+            "complet": len(suggested) >= nb_needed[row],
+            "valide": False  # À valider par l'utilisateur
+        })
+
+    memo_put(_dispatch_cache, fingerprint, dispatch_results, DISPATCH_CACHE_SIZE)
+    return dispatch_results
+
+
+def dispatch_for_tournee(tournee_num: int, mode: str = "optimal", scope: str = "tournee"):
     """Génère des suggestions de dispatch pour UNE tournée spécifique.
 
     Args:
         tournee_num: numéro de la tournée (1, 2, 3...)
+        mode: "optimal" (maximise le score total) ou "greedy" (clients servis dans l'ordre de passage)
+        scope: "tournee" (stock réparti sur cette tournée seule) ou "semaine"
+               (assignation calculée sur toutes les tournées, puis extraite)
 
     Returns:
         Suggestions pour les clients de cette tournée uniquement
@@ -1451,11 +4381,13 @@ def dispatch_for_tournee(tournee_num: int):
     if not tournees:
         return {"success": False, "message": "Aucune tournée disponible"}
 
-    if tournee_num < 1 or tournee_num > len(tournees):
-        return {"success": False, "message": f"Tournée {tournee_num} inexistante (1-{len(tournees)})"}
+    # Récupérer la tournée demandée (numéros stables, pas forcément contigus)
+    position = next((i for i, t in enumerate(tournees) if t.get("numero") == tournee_num), None)
+    if position is None:
+        numeros = ", ".join(str(t.get("numero")) for t in tournees)
+        return {"success": False, "message": f"Tournée {tournee_num} inexistante ({numeros})"}
 
-    # Récupérer la tournée demandée
-    tournee = tournees[tournee_num - 1]
+    tournee = tournees[position]
     clients_in_tournee = tournee.get("clients", [])
 
     if not clients_in_tournee:
@@ -1463,61 +4395,21 @@ def dispatch_for_tournee(tournee_num: int):
 
     # Récupérer les bouquets disponibles
     bouquets = get_available_bouquets()
-    if not bouquets:
-        return {
-            "success": False,
-            "message": "Aucun bouquet disponible",
-            "tournee": tournee,
-            "dispatch": []
-        }
-
-    # Pour chaque client de la tournée, calculer les suggestions
-    dispatch_results = []
-    assigned_bouquets = set()
-
-    for client in clients_in_tournee:
-        nb_needed = client.get("nb_bouquets", 1)
-
-        # Calculer le score de chaque bouquet disponible
-        scored_bouquets = []
-        for bouquet in bouquets:
-            if bouquet["id"] in assigned_bouquets:
-                continue
-
-            match = calculate_match_score(bouquet, {
-                "pref_couleurs": client.get("pref_couleurs", ""),
-                "pref_style": client.get("pref_style", ""),
-                "tailles": client.get("tailles", "")
-            })
-            scored_bouquets.append(match)
-
-        # Trier par score décroissant
-        scored_bouquets.sort(key=lambda x: x["score"], reverse=True)
-
-        # Prendre les N meilleurs + 2 alternatives
-        suggested = scored_bouquets[:nb_needed]
-        alternatives = scored_bouquets[nb_needed:nb_needed + 2]
-
-        # Marquer les suggestions principales comme "réservées" (pas les alternatives)
-        for s in suggested:
-            assigned_bouquets.add(s["record_id"])
+    if not bouquets:
+        return {
+            "success": False,
+            "message": "Aucun bouquet disponible",
+            "tournee": tournee,
+            "dispatch": []
+        }
 
-        dispatch_results.append({
-            "client_id": client.get("id", ""),
-            "client_nom": client.get("nom", ""),
-            "client_adresse": client.get("adresse", ""),
-            "nb_demandes": nb_needed,
-            "nb_suggeres": len(suggested),
-            "preferences": {
-                "couleurs": client.get("pref_couleurs", ""),
-                "style": client.get("pref_style", ""),
-                "tailles": client.get("tailles", ""),
-            },
-            "bouquets_suggeres": suggested,
-            "alternatives": alternatives,
-            "complet": len(suggested) >= nb_needed,
-            "valide": False  # À valider par l'utilisateur
-        })
+    if scope == "semaine":
+        # Une seule assignation pour toute la semaine: les tournées ne se disputent plus les bouquets
+        all_clients = [c for t in tournees for c in t.get("clients", [])]
+        offset = sum(len(t.get("clients", [])) for t in tournees[:position])
+        dispatch_results = dispatch_clients(all_clients, bouquets, mode)[offset:offset + len(clients_in_tournee)]
+    else:
+        dispatch_results = dispatch_clients(clients_in_tournee, bouquets, mode)
 
     # Stats pour cette tournée
     total_needed = sum(c.get("nb_bouquets", 1) for c in clients_in_tournee)
@@ -1525,6 +4417,8 @@ def dispatch_for_tournee(tournee_num: int):
 
     return {
         "success": True,
+        "mode": mode,
+        "scope": scope,
         "tournee": {
             "numero": tournee.get("numero"),
             "jour": tournee.get("jour"),
@@ -1536,6 +4430,7 @@ def dispatch_for_tournee(tournee_num: int):
             "bouquets_disponibles": len(bouquets),
             "bouquets_demandes": total_needed,
             "bouquets_suggeres": total_suggested,
+            "score_total": sum(b["score"] for d in dispatch_results for b in d["bouquets_suggeres"]),
         },
         "dispatch": dispatch_results
     }
@@ -1544,11 +4439,20 @@ def dispatch_for_tournee(tournee_num: int):
 def valider_dispatch(client_id: str, bouquet_record_id: str) -> dict:
     """Valide l'assignation d'un bouquet à un client.
 
-    Met à jour le statut du bouquet dans Airtable.
+    Met à jour le statut du bouquet dans Airtable, après avoir vérifié qu'il
+    est toujours disponible (l'index peut être en retard sur un autre worker).
     """
     url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_BOUQUETS_TABLE}/{bouquet_record_id}"
     headers = get_airtable_headers()
 
+    response = req.get(url, headers=headers)
+    if response.status_code != 200:
+        return {"success": False, "error": response.text}
+    current = response.json()
+    if current.get("fields", {}).get("Statut") != "Disponible":
+        index_bouquet(current)
+        return {"success": False, "error": f"Bouquet plus disponible ({current.get('fields', {}).get('Statut', 'sans statut')})"}
+
     # Mettre à jour le statut du bouquet
     response = req.patch(url, headers=headers, json={
         "fields": {
@@ -1558,6 +4462,8 @@ def valider_dispatch(client_id: str, bouquet_record_id: str) -> dict:
     })
 
     if response.status_code == 200:
+        index_bouquet(response.json())
+        bump_catalogue_generation()
         return {"success": True, "message": "Bouquet assigné"}
     else:
         return {"success": False, "error": response.text}
@@ -1579,6 +4485,7 @@ def get_tournees_summary():
                 "nb_clients": t.get("nb_clients"),
                 "nb_bouquets": t.get("nb_bouquets"),
                 "zones": t.get("zones"),
+                "distance_km": t.get("distance_km"),
                 "duree_estimee": t.get("duree_estimee"),
             }
             for t in tournees
@@ -1655,10 +4562,86 @@ def upload_to_imgbb(image_base64: str) -> dict:
     return {"error": response.text}
 
 
-def analyze_image_with_claude(image_base64: str, media_type: str = "image/jpeg") -> dict:
-    prompt = """Analyse cette photo de bouquet de fleurs en soie.
-Réponds UNIQUEMENT en JSON valide avec ces champs (utilise EXACTEMENT les valeurs proposées):
-{
+# Extensions de fichier par type MIME accepté
+PHOTO_EXTENSIONS = {"image/jpeg": "jpg", "image/jpg": "jpg", "image/png": "png", "image/webp": "webp", "image/gif": "gif"}
+PHOTO_FILENAME_RE = re.compile(r"^[0-9a-f]{64}\.(jpg|png|webp|gif)$")
+THUMBNAIL_WIDTHS = [160, 320, 640]
+
+
+def store_image_locally(image_base64: str, media_type: str = "image/jpeg") -> dict:
+    """Stocke une photo sur disque, adressée par son SHA-256.
+
+    Deux uploads identiques donnent le même fichier (écrit une seule fois).
+    """
+    ext = PHOTO_EXTENSIONS.get(media_type)
+    if not ext:
+        return {"error": f"Type d'image non supporté: {media_type}"}
+
+    try:
+        content = base64.b64decode(image_base64, validate=True)
+    except ValueError:
+        return {"error": "image_base64 invalide"}
+
+    digest = hashlib.sha256(content).hexdigest()
+    filename = f"{digest}.{ext}"
+    path = os.path.join(PHOTOS_DIR, digest[:2], filename)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Écriture atomique: fichier temporaire unique (threads et workers) puis rename
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+            f.write(content)
+        os.replace(f.name, path)
+        print(f"[PHOTOS] Stored {filename} ({len(content)} bytes)")
+    else:
+        print(f"[PHOTOS] Duplicate upload, reusing {filename}")
+
+    return {"url": f"{PUBLIC_BASE_URL}/photos/{filename}", "digest": digest}
+
+
+# Backends de stockage: fonction (image_base64, media_type) -> {"url": ...} ou {"error": ...}
+IMAGE_STORAGE_BACKENDS = {
+    "local": store_image_locally,
+    "imgbb": lambda image_base64, media_type: upload_to_imgbb(image_base64),
+}
+
+
+def store_image(image_base64: str, media_type: str = "image/jpeg") -> dict:
+    """Stocke une photo avec le backend configuré (IMAGE_STORAGE), repli sur le disque local"""
+    backend = IMAGE_STORAGE_BACKENDS.get(IMAGE_STORAGE, store_image_locally)
+    result = backend(image_base64, media_type)
+    if "url" not in result and backend is not store_image_locally:
+        print(f"[PHOTOS] {IMAGE_STORAGE} failed ({result.get('error', '')[:100]}), fallback local")
+        result = store_image_locally(image_base64, media_type)
+    return result
+
+
+def get_photo_thumbnail(filename: str, width: int) -> str:
+    """Retourne le chemin d'une miniature JPEG (générée une fois, puis servie depuis le disque).
+
+    Lève UnidentifiedImageError/OSError si la photo source est illisible.
+    """
+    source = os.path.join(PHOTOS_DIR, filename[:2], filename)
+    thumb_path = os.path.join(PHOTOS_DIR, "thumbs", str(width), filename.rsplit(".", 1)[0] + ".jpg")
+
+    if not os.path.exists(thumb_path):
+        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(thumb_path), suffix=".tmp", delete=False) as f:
+            tmp_path = f.name
+        try:
+            with Image.open(source) as img:
+                img.thumbnail((width, width * 4))
+                img.convert("RGB").save(tmp_path, "JPEG", quality=82)
+            os.replace(tmp_path, thumb_path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    return thumb_path
+
+
+# Champs demandés à Claude pour l'analyse d'une photo de bouquet
+BOUQUET_ANALYSIS_FIELDS = """{
   "couleurs": ["Rouge", "Blanc", "Rose", "Vert", "Jaune", "Orange", "Violet", "Bleu", "Noir"],
   "style": "Bucolique | Zen | Moderne | Coloré | Classique",
   "taille_suggeree": "Petit | Moyen | Grand | Masterpiece",
@@ -1668,8 +4651,25 @@ Réponds UNIQUEMENT en JSON valide avec ces champs (utilise EXACTEMENT les valeu
   "fleurs": ["Amarante", "Anthurium", "Anémone", "Astilbe", "Chrysanthème", "Dahlia", "Hortensia", "Pivoine", "Rose"],
   "feuillages": ["Asparagus", "Eucalyptus", "Fougère", "Pittosporum", "Ruscus"],
   "description": "courte description du bouquet"
-}
-IMPORTANT: Pour fleurs, feuillages, personas et ambiance, utilise UNIQUEMENT les valeurs listées ci-dessus."""
+}"""
+BOUQUET_ANALYSIS_RULES = "IMPORTANT: Pour fleurs, feuillages, personas et ambiance, utilise UNIQUEMENT les valeurs listées ci-dessus."
+
+# Analyse groupée: nombre de photos par requête et budget de tokens par photo.
+# Chaque photo garde le budget d'une analyse individuelle (1024 tokens): un lot
+# tronqué repartirait en analyses individuelles, plus chères que sans lot.
+# 4 photos × 1024 = 4096, le maximum de sortie du modèle.
+VISION_BATCH_SIZE = 4
+VISION_TOKENS_PER_IMAGE = 1024
+VISION_REQUEST_TIMEOUT = 60  # secondes par requête Claude
+VISION_DEADLINE = 90         # secondes pour toute l'analyse d'une série (timeout gunicorn: 120)
+
+
+def analyze_image_with_claude(image_base64: str, media_type: str = "image/jpeg",
+                              timeout: float = VISION_REQUEST_TIMEOUT) -> dict:
+    prompt = f"""Analyse cette photo de bouquet de fleurs en soie.
+Réponds UNIQUEMENT en JSON valide avec ces champs (utilise EXACTEMENT les valeurs proposées):
+{BOUQUET_ANALYSIS_FIELDS}
+{BOUQUET_ANALYSIS_RULES}"""
 
     response = req.post(
         "https://api.anthropic.com/v1/messages",
@@ -1680,7 +4680,7 @@ IMPORTANT: Pour fleurs, feuillages, personas et ambiance, utilise UNIQUEMENT les
         },
         json={
             "model": "claude-3-haiku-20240307",
-            "max_tokens": 1024,
+            "max_tokens": VISION_TOKENS_PER_IMAGE,
             "messages": [{
                 "role": "user",
                 "content": [
@@ -1688,7 +4688,8 @@ IMPORTANT: Pour fleurs, feuillages, personas et ambiance, utilise UNIQUEMENT les
                     {"type": "text", "text": prompt}
                 ]
             }]
-        }
+        },
+        timeout=timeout
     )
     
     if response.status_code != 200:
@@ -1704,15 +4705,207 @@ IMPORTANT: Pour fleurs, feuillages, personas et ambiance, utilise UNIQUEMENT les
         return {"error": "JSON parse failed", "raw": text}
 
 
-def get_next_bouquet_id():
+def is_valid_bouquet_analysis(analysis) -> bool:
+    """Vérifie qu'une analyse contient au minimum couleurs, style et taille exploitables"""
+    if not isinstance(analysis, dict) or "error" in analysis:
+        return False
+    couleurs = analysis.get("couleurs")
+    if isinstance(couleurs, str):
+        couleurs = [c.strip() for c in couleurs.split(",")]
+    if not isinstance(couleurs, list) or not any(c in COULEURS_VALIDES for c in couleurs):
+        return False
+    return bool(analysis.get("style")) and bool(analysis.get("taille_suggeree"))
+
+
+def _analyze_images_chunk_with_claude(images: list, timeout: float = VISION_REQUEST_TIMEOUT) -> dict:
+    """Analyse plusieurs photos en UNE requête Claude.
+
+    Returns:
+        dict index (1..n) -> analyse, uniquement pour les images présentes dans la réponse
+    """
+    content = []
+    for i, image in enumerate(images, start=1):
+        content.append({"type": "text", "text": f"Image {i}:"})
+        content.append({"type": "image", "source": {"type": "base64", "media_type": image.get("media_type", "image/jpeg"), "data": image["image_base64"]}})
+
+    content.append({"type": "text", "text": f"""Analyse ces {len(images)} photos de bouquets de fleurs en soie, indépendamment les unes des autres.
+Réponds UNIQUEMENT avec un tableau JSON valide contenant un objet par image, dans l'ordre.
+Chaque objet a un champ "index" (numéro de l'image, de 1 à {len(images)}) et ces champs (utilise EXACTEMENT les valeurs proposées):
+{BOUQUET_ANALYSIS_FIELDS}
+{BOUQUET_ANALYSIS_RULES}"""})
+
+    response = req.post(
+        "https://api.anthropic.com/v1/messages",
+        headers={
+            "x-api-key": ANTHROPIC_API_KEY,
+            "anthropic-version": "2023-06-01",
+            "content-type": "application/json"
+        },
+        json={
+            "model": "claude-3-haiku-20240307",
+            "max_tokens": min(4096, VISION_TOKENS_PER_IMAGE * len(images)),
+            "messages": [{"role": "user", "content": content}]
+        },
+        timeout=timeout
+    )
+
+    if response.status_code != 200:
+        print(f"[VISION] Batch error: {response.status_code} - {response.text[:200]}")
+        return {}
+
+    try:
+        text = response.json()["content"][0]["text"].strip()
+        if "```" in text:
+            text = text.split("```")[1]
+            if text.startswith("json"):
+                text = text[4:]
+        items = json.loads(text.strip())
+    except Exception as e:
+        print(f"[VISION] Batch parse failed: {e}")
+        return {}
+
+    by_index = {}
+    for item in items if isinstance(items, list) else []:
+        if isinstance(item, dict) and str(item.get("index", "")).isdigit():
+            by_index[int(item.pop("index"))] = item
+    return by_index
+
+
+def analyze_images_batch_with_claude(images: list) -> list:
+    """Analyse une série de photos par lots de VISION_BATCH_SIZE images par requête.
+
+    Chaque analyse est validée; les images absentes ou invalides dans la réponse
+    groupée sont ré-analysées individuellement avec analyze_image_with_claude.
+    Toutes les requêtes partagent une échéance de VISION_DEADLINE secondes: les
+    images non analysées à temps reçoivent une erreur (à renvoyer plus tard).
+
+    Args:
+        images: liste de {"image_base64": "...", "media_type": "image/jpeg"}
+
+    Returns:
+        liste d'analyses, dans le même ordre que `images`
+    """
+    deadline = time.monotonic() + VISION_DEADLINE
+    analyses = []
+
+    def remaining():
+        return min(VISION_REQUEST_TIMEOUT, deadline - time.monotonic())
+
+    for start in range(0, len(images), VISION_BATCH_SIZE):
+        chunk = images[start:start + VISION_BATCH_SIZE]
+        batch_result = {}
+        if len(chunk) > 1 and remaining() > 1:
+            try:
+                batch_result = _analyze_images_chunk_with_claude(chunk, timeout=remaining())
+            except req.exceptions.RequestException as e:
+                print(f"[VISION] Batch error: {e}")
+
+        for i, image in enumerate(chunk, start=1):
+            analysis = batch_result.get(i)
+            if not is_valid_bouquet_analysis(analysis):
+                if remaining() <= 1:
+                    analyses.append({"error": "Délai d'analyse dépassé, image à renvoyer"})
+                    continue
+                if len(chunk) > 1:
+                    print(f"[VISION] Image {start + i} invalide dans le lot, analyse individuelle")
+                try:
+                    analysis = analyze_image_with_claude(image["image_base64"], image.get("media_type", "image/jpeg"),
+                                                         timeout=remaining())
+                except req.exceptions.RequestException as e:
+                    analysis = {"error": f"Analyse impossible: {e}"}
+            analyses.append(analysis)
+
+    return analyses
+
+
+def _get_max_bouquet_number(year: int) -> int:
+    """Retourne le plus grand numéro MA-<year>-NNNNN présent dans Airtable.
+
+    Utilisé uniquement pour amorcer la séquence locale de l'année.
+    """
     url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_BOUQUETS_TABLE}"
     headers = get_airtable_headers()
-    response = req.get(url, headers=headers, params={"pageSize": 100})
-    count = len(response.json().get("records", [])) if response.status_code == 200 else 0
-    return f"MA-{datetime.now().year}-{count + 1:05d}"
+    prefix = f"MA-{year}-"
+
+    max_number = 0
+    offset = None
+
+    while True:
+        params = {
+            "pageSize": 100,
+            "fields[]": "Bouquet_ID",
+            "filterByFormula": f"FIND('{prefix}', {{Bouquet_ID}}) = 1"
+        }
+        if offset:
+            params["offset"] = offset
+
+        response = req.get(url, headers=headers, params=params)
+        if response.status_code != 200:
+            raise RuntimeError(f"Impossible d'amorcer la séquence des bouquets: {response.text[:200]}")
+
+        data = response.json()
+        for record in data.get("records", []):
+            suffix = record.get("fields", {}).get("Bouquet_ID", "")[len(prefix):]
+            if suffix.isdigit():
+                max_number = max(max_number, int(suffix))
+
+        offset = data.get("offset")
+        if not offset:
+            break
+
+    print(f"[BOUQUET] Séquence {year} amorcée à {max_number}")
+    return max_number
+
+
+def reserve_bouquet_ids(count: int, year: int = None) -> list:
+    """Réserve `count` Bouquet_ID consécutifs (MA-YYYY-NNNNN), sans appel Airtable.
+
+    Pour la création en masse: une seule réservation pour toute la plage.
+    """
+    year = year or datetime.now().year
+    first = reserve_sequence(f"bouquet_id_{year}", count, seed=lambda: _get_max_bouquet_number(year))
+    return [f"MA-{year}-{number:05d}" for number in range(first, first + count)]
+
+
+def get_next_bouquet_id():
+    return reserve_bouquet_ids(1)[0]
+
+
+# Index Bouquet_ID → record Airtable (en mémoire, par worker).
+# Alimenté par les créations et mises à jour, revalidé auprès d'Airtable après le TTL.
+BOUQUET_INDEX_TTL = 600  # secondes
+BOUQUET_INDEX_SIZE = 2048  # entrées (LRU)
+_bouquet_index = OrderedDict()  # bouquet_id -> (record, indexed_at)
+
+
+def index_bouquet(record: dict):
+    """Ajoute ou rafraîchit un record dans l'index (invalide la page rendue si le bouquet a changé)"""
+    catalogue_update(record)
+
+    bouquet_id = record.get("fields", {}).get("Bouquet_ID", "")
+    if not bouquet_id:
+        return
+
+    previous = memo_get(_bouquet_index, bouquet_id)
+    if not previous or previous[0].get("fields") != record.get("fields"):
+        memo_pop(_bouquet_page_cache, bouquet_id)
+    memo_put(_bouquet_index, bouquet_id, record, BOUQUET_INDEX_SIZE)
+
+
+def forget_bouquet(record: dict):
+    """Retire un bouquet supprimé du catalogue, de l'index et des pages rendues"""
+    catalogue_forget(record.get("id", ""))
+    bouquet_id = record.get("fields", {}).get("Bouquet_ID", "")
+    if bouquet_id:
+        memo_pop(_bouquet_index, bouquet_id)
+        memo_pop(_bouquet_page_cache, bouquet_id)
 
 
 def get_bouquet_by_id(bouquet_id: str) -> dict:
+    cached = memo_get(_bouquet_index, bouquet_id)
+    if cached and time.time() - cached[1] < BOUQUET_INDEX_TTL:
+        return cached[0]
+
     url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_BOUQUETS_TABLE}"
     headers = get_airtable_headers()
     params = {"filterByFormula": f"{{Bouquet_ID}} = '{bouquet_id}'"}
@@ -1721,7 +4914,13 @@ def get_bouquet_by_id(bouquet_id: str) -> dict:
     if response.status_code == 200:
         records = response.json().get("records", [])
         if records:
+            index_bouquet(records[0])
             return records[0]
+        memo_pop(_bouquet_index, bouquet_id)
+        memo_pop(_bouquet_page_cache, bouquet_id)
+    elif cached:
+        # Airtable indisponible: on sert la dernière version connue
+        return cached[0]
     return None
 
 
@@ -1767,15 +4966,20 @@ def normalize_style(style: str) -> str:
     return "Classique"  # Défaut
 
 
-def create_bouquet_in_airtable(data: dict, image_url: str = None) -> dict:
+def create_bouquet_in_airtable(data: dict, image_url: str = None, bouquet_id: str = None) -> dict:
     url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_BOUQUETS_TABLE}"
     headers = get_airtable_headers()
 
-    bouquet_id = get_next_bouquet_id()
-    # URL fixe (Railway ne change pas)
-    base_url = "https://web-production-37db3.up.railway.app"
-    public_url = f"{base_url}/b/{bouquet_id}"
-    qr_image_url = f"https://api.qrserver.com/v1/create-qr-code/?size=300x300&data={public_url}"
+    # bouquet_id déjà réservé par l'appelant (création en masse), sinon on en alloue un
+    if not bouquet_id:
+        try:
+            bouquet_id = get_next_bouquet_id()
+        except RuntimeError as e:
+            print(f"[BOUQUET] {e}")
+            return {"success": False, "error": str(e), "bouquet_id": "ERREUR", "public_url": "#"}
+    public_url = f"{PUBLIC_BASE_URL}/b/{bouquet_id}"
+    # QR généré par l'app elle-même (voir /qr/<bouquet_id>.png), aucun service tiers
+    qr_image_url = f"{PUBLIC_BASE_URL}/qr/{bouquet_id}.png"
 
     # Options valides Airtable (Multiple Select)
     VALID_FLEURS = ["Amarante", "Anthurium", "Anémone", "Astilbe", "Chrysanthème", "Dahlia", "Hortensia", "Pivoine", "Rose"]
@@ -1853,6 +5057,8 @@ def create_bouquet_in_airtable(data: dict, image_url: str = None) -> dict:
     print(f"[BOUQUET] Response body: {response.text[:500]}")
 
     if response.status_code in [200, 201]:
+        index_bouquet(response.json())
+        bump_catalogue_generation()
         return {"success": True, "bouquet_id": bouquet_id, "public_url": public_url, "qr_image": qr_image_url}
 
     # Fallback: si erreur de select option, réessayer sans les champs multiple select
@@ -1867,6 +5073,8 @@ def create_bouquet_in_airtable(data: dict, image_url: str = None) -> dict:
         print(f"[BOUQUET] Retry response body: {response.text[:500]}")
 
         if response.status_code in [200, 201]:
+            index_bouquet(response.json())
+            bump_catalogue_generation()
             return {"success": True, "bouquet_id": bouquet_id, "public_url": public_url, "qr_image": qr_image_url, "warning": "Créé sans fleurs/feuillages (options manquantes dans Airtable)"}
 
     # Parse error message
@@ -1899,12 +5107,14 @@ def manifest():
 def service_worker():
     return send_from_directory('static', 'sw.js')
 
-@app.route("/b/<bouquet_id>")
-def bouquet_page(bouquet_id):
-    bouquet = get_bouquet_by_id(bouquet_id)
-    if not bouquet:
-        return f"<h1>Bouquet {bouquet_id} non trouvé</h1>", 404
-    
+# Pages publiques déjà rendues: bouquet_id -> {"html", "etag", "last_modified"}
+BOUQUET_PAGE_MAX_AGE = 300  # secondes de cache côté navigateur
+BOUQUET_PAGE_CACHE_SIZE = 512  # pages gardées en mémoire (LRU)
+_bouquet_page_cache = OrderedDict()
+
+
+def render_bouquet_page(bouquet_id: str, bouquet: dict) -> str:
+    """Construit le HTML de la fiche publique d'un bouquet"""
     fields = bouquet.get("fields", {})
     nom = fields.get("Nom", bouquet_id)
     photo_url = fields["Photo"][0].get("url", "") if fields.get("Photo") else ""
@@ -1930,63 +5140,234 @@ def bouquet_page(bouquet_id):
     """
 
 
+@app.route("/b/<bouquet_id>")
+def bouquet_page(bouquet_id):
+    bouquet = get_bouquet_by_id(bouquet_id)
+    if not bouquet:
+        return f"<h1>Bouquet {bouquet_id} non trouvé</h1>", 404
+
+    cached = memo_get(_bouquet_page_cache, bouquet_id)
+    page = cached[0] if cached else None
+    if not page:
+        html = render_bouquet_page(bouquet_id, bouquet)
+        page = {
+            "html": html,
+            "etag": hashlib.sha1(html.encode("utf-8")).hexdigest(),
+            "last_modified": datetime.now(timezone.utc).replace(microsecond=0)
+        }
+        memo_put(_bouquet_page_cache, bouquet_id, page, BOUQUET_PAGE_CACHE_SIZE)
+
+    response = make_response(page["html"])
+    response.set_etag(page["etag"])
+    response.last_modified = page["last_modified"]
+    response.cache_control.public = True
+    response.cache_control.max_age = BOUQUET_PAGE_MAX_AGE
+    # 304 si le navigateur a déjà cette version (If-None-Match / If-Modified-Since)
+    return response.make_conditional(request)
+
+
+# QR codes générés localement, mis en cache par contenu (URL encodée + format)
+QR_MAX_AGE = 31536000  # 1 an: le contenu d'un QR ne change jamais pour une URL donnée
+QR_FORMATS = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+@functools.lru_cache(maxsize=2048)
+def render_qr_code(data: str, fmt: str = "png", scale: int = 8) -> bytes:
+    """Rend un QR code (PNG ou SVG) pour `data`"""
+    buffer = io.BytesIO()
+    segno.make(data, error="m").save(buffer, kind=fmt, scale=scale, border=4)
+    return buffer.getvalue()
+
+
+@app.route("/qr/<bouquet_id>.<fmt>")
+def bouquet_qr_code(bouquet_id, fmt):
+    if fmt not in QR_FORMATS:
+        return jsonify({"error": "Format QR inconnu (png ou svg)"}), 404
+    if not get_bouquet_by_id(bouquet_id):
+        return jsonify({"error": f"Bouquet {bouquet_id} non trouvé"}), 404
+
+    public_url = f"{PUBLIC_BASE_URL}/b/{bouquet_id}"
+    content = render_qr_code(public_url, fmt)
+
+    response = make_response(content)
+    response.mimetype = QR_FORMATS[fmt]
+    response.set_etag(hashlib.sha1(f"{fmt}:{public_url}".encode("utf-8")).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = QR_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+
+@app.route("/photos/<filename>")
+def photo_file(filename):
+    """Sert une photo du stockage local (Range, ETag et cache longue durée: le nom est le hash du contenu)"""
+    if not PHOTO_FILENAME_RE.match(filename):
+        return jsonify({"error": "Photo inconnue"}), 404
+
+    path = os.path.join(PHOTOS_DIR, filename[:2], filename)
+    if not os.path.exists(path):
+        return jsonify({"error": "Photo inconnue"}), 404
+
+    response = send_file(path, conditional=True, max_age=QR_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route("/photos/thumb/<int:width>/<filename>")
+def photo_thumbnail(width, filename):
+    """Sert une miniature JPEG d'une photo locale (largeurs autorisées: THUMBNAIL_WIDTHS)"""
+    if width not in THUMBNAIL_WIDTHS or not PHOTO_FILENAME_RE.match(filename):
+        return jsonify({"error": "Miniature inconnue"}), 404
+
+    if not os.path.exists(os.path.join(PHOTOS_DIR, filename[:2], filename)):
+        return jsonify({"error": "Photo inconnue"}), 404
+
+    try:
+        thumb_path = get_photo_thumbnail(filename, width)
+    except (UnidentifiedImageError, OSError) as e:
+        print(f"[PHOTOS] Thumbnail failed for {filename}: {e}")
+        return jsonify({"error": "Photo illisible"}), 415
+
+    response = send_file(thumb_path, mimetype="image/jpeg", conditional=True, max_age=QR_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 # API Routes
 @app.route("/api/health", methods=["GET"])
 def health():
     return jsonify({"status": "ok", "service": "Maison Amarante API v4"})
 
 
-# Config budget (stockage simple en fichier)
-BUDGET_CONFIG_FILE = "/tmp/budget_config.json"
-BUDGET_PERCENT = 8  # 8% du CA
-COUT_LIVRAISON = 15  # 15€ par livraison
+# ==================== RÉGLAGES ====================
 
-def get_ca_mensuel():
-    """Récupère le CA mensuel depuis le fichier config"""
+# Réglages modifiables à chaud (budget livraisons, etc.), partagés par tous les
+# workers via la base d'état SQLite. Chaque écriture incrémente la séquence
+# "settings": les workers relisent la table seulement quand cette version change,
+# et au plus une fois toutes les SETTINGS_CHECK_INTERVAL secondes.
+SETTINGS_DEFAULTS = {
+    "ca_mensuel": 12500,
+    "budget_percent": 8,    # 8% du CA
+    "cout_livraison": 15,   # 15€ par livraison
+}
+SETTINGS_CHECK_INTERVAL = 2  # secondes
+LEGACY_BUDGET_CONFIG_FILE = "/tmp/budget_config.json"
+
+STATE_DB_SCHEMA.append(
+    "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at TEXT NOT NULL)"
+)
+
+_settings_cache = {"version": None, "values": {}, "checked_at": 0.0}
+_settings_lock = threading.Lock()
+
+
+def _migrate_legacy_settings(conn):
+    """Reprend le CA mensuel de l'ancien fichier /tmp/budget_config.json (une seule fois)"""
+    try:
+        with open(LEGACY_BUDGET_CONFIG_FILE, "r") as f:
+            ca = json.load(f).get("ca_mensuel")
+    except (FileNotFoundError, json.JSONDecodeError, AttributeError):
+        return
+    if ca is None:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM settings WHERE key = 'ca_mensuel'").fetchone() is None:
+            conn.execute("INSERT INTO settings (key, value, updated_at) VALUES ('ca_mensuel', ?, ?)",
+                         (json.dumps(ca), datetime.now(timezone.utc).isoformat()))
+            conn.execute("INSERT INTO sequences (name, value) VALUES ('settings', 1) "
+                         "ON CONFLICT (name) DO UPDATE SET value = value + 1")
+            print(f"[SETTINGS] CA mensuel repris de {LEGACY_BUDGET_CONFIG_FILE}: {ca}")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def get_settings() -> dict:
+    """Tous les réglages (valeurs par défaut complétées par la base)"""
+    with _settings_lock:
+        now = time.monotonic()
+        if _settings_cache["version"] is not None and now - _settings_cache["checked_at"] < SETTINGS_CHECK_INTERVAL:
+            return _settings_cache["values"]
+
+        conn = get_state_db()
+        try:
+            row = conn.execute("SELECT value FROM sequences WHERE name = 'settings'").fetchone()
+            if row is None:
+                _migrate_legacy_settings(conn)
+                row = conn.execute("SELECT value FROM sequences WHERE name = 'settings'").fetchone()
+            version = row[0] if row else 0
+            if version != _settings_cache["version"]:
+                values = dict(SETTINGS_DEFAULTS)
+                values.update({key: json.loads(value)
+                               for key, value in conn.execute("SELECT key, value FROM settings")})
+                _settings_cache["values"] = values
+                _settings_cache["version"] = version
+        finally:
+            conn.close()
+        _settings_cache["checked_at"] = now
+        return _settings_cache["values"]
+
+
+def get_setting(key: str):
+    return get_settings().get(key, SETTINGS_DEFAULTS.get(key))
+
+
+def set_settings(values: dict) -> dict:
+    """Enregistre plusieurs réglages dans une seule transaction et retourne les réglages à jour"""
+    conn = get_state_db()
     try:
-        with open(BUDGET_CONFIG_FILE, "r") as f:
-            config = json.load(f)
-            return config.get("ca_mensuel", 12500)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return 12500  # Valeur par défaut
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            updated_at = datetime.now(timezone.utc).isoformat()
+            conn.executemany(
+                "INSERT OR REPLACE INTO settings (key, value, updated_at) VALUES (?, ?, ?)",
+                [(key, json.dumps(value), updated_at) for key, value in values.items()]
+            )
+            conn.execute("INSERT INTO sequences (name, value) VALUES ('settings', 1) "
+                         "ON CONFLICT (name) DO UPDATE SET value = value + 1")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+    with _settings_lock:
+        _settings_cache["version"] = None  # relecture immédiate dans ce worker
+    return get_settings()
+
+
+def get_ca_mensuel():
+    """CA mensuel de référence pour le budget livraisons"""
+    return get_setting("ca_mensuel")
+
 
 def set_ca_mensuel(ca):
-    """Sauvegarde le CA mensuel dans le fichier config"""
-    with open(BUDGET_CONFIG_FILE, "w") as f:
-        json.dump({"ca_mensuel": ca}, f)
+    """Sauvegarde le CA mensuel"""
+    set_settings({"ca_mensuel": ca})
 
 
 @app.route("/api/budget", methods=["GET"])
 def api_budget():
     """Retourne le budget livraisons du mois en cours"""
-    ca_mensuel = get_ca_mensuel()
-    budget_max = ca_mensuel * BUDGET_PERCENT / 100
-
-    # Compter les livraisons du mois en cours
-    now = datetime.now()
-    livraisons = get_livraisons()
-    livraisons_mois = 0
-
-    for liv in livraisons:
-        created = liv.get("createdTime", "")
-        date_liv = liv.get("fields", {}).get("Date", created)
-
-        if date_liv:
-            try:
-                if "T" in str(date_liv):
-                    date_obj = datetime.fromisoformat(date_liv.replace("Z", "+00:00"))
-                else:
-                    date_obj = datetime.strptime(str(date_liv), "%Y-%m-%d")
+    settings = get_settings()
+    ca_mensuel = settings["ca_mensuel"]
+    cout_livraison = settings["cout_livraison"]
+    budget_max = ca_mensuel * settings["budget_percent"] / 100
 
-                if date_obj.year == now.year and date_obj.month == now.month:
-                    livraisons_mois += 1
-            except (ValueError, TypeError):
-                pass
+    # Livraisons du mois en cours (compteurs matérialisés)
+    mois = datetime.now().strftime("%Y-%m")
+    counts = get_livraison_counts(depuis=mois).get(mois, {"total": 0, "par_type": {}, "par_statut": {}})
+    livraisons_mois = counts["total"]
 
-    budget_utilise = livraisons_mois * COUT_LIVRAISON
+    budget_utilise = livraisons_mois * cout_livraison
     reste = max(0, budget_max - budget_utilise)
     pourcentage = (budget_utilise / budget_max * 100) if budget_max > 0 else 0
-    livraisons_max = int(budget_max / COUT_LIVRAISON)
+    livraisons_max = int(budget_max / cout_livraison) if cout_livraison > 0 else 0
     livraisons_reste = max(0, livraisons_max - livraisons_mois)
 
     return jsonify({
@@ -1998,27 +5379,68 @@ def api_budget():
         "livraisons_reste": livraisons_reste,
         "reste": reste,
         "pourcentage": round(pourcentage, 1),
-        "cout_unitaire": COUT_LIVRAISON
+        "cout_unitaire": cout_livraison,
+        "budget_percent": settings["budget_percent"],
+        "par_type": counts["par_type"],
+        "par_statut": counts["par_statut"]
+    })
+
+
+@app.route("/api/budget/historique", methods=["GET"])
+def api_budget_history():
+    """Historique mensuel du budget livraisons
+
+    Query params: mois (nombre de mois, défaut 12, mois en cours compris)
+    """
+    nb_mois = min(max(request.args.get("mois", 12, type=int), 1), 120)
+    now = datetime.now()
+    months = []
+    for i in range(nb_mois - 1, -1, -1):
+        year, month = divmod(now.year * 12 + now.month - 1 - i, 12)
+        months.append(f"{year:04d}-{month + 1:02d}")
+
+    counts = get_livraison_counts(depuis=months[0])
+    settings = get_settings()
+    budget_max = settings["ca_mensuel"] * settings["budget_percent"] / 100
+    historique = []
+    for mois in months:
+        count = counts.get(mois, {"total": 0, "par_type": {}, "par_statut": {}})
+        budget_utilise = count["total"] * settings["cout_livraison"]
+        historique.append({
+            "mois": mois,
+            "livraisons_count": count["total"],
+            "budget_utilise": budget_utilise,
+            "pourcentage": round(budget_utilise / budget_max * 100, 1) if budget_max > 0 else 0,
+            "par_type": count["par_type"],
+            "par_statut": count["par_statut"]
+        })
+
+    return jsonify({
+        "budget_max": budget_max,
+        "cout_unitaire": settings["cout_livraison"],
+        "historique": historique
     })
 
 
 @app.route("/api/budget", methods=["POST"])
 def api_budget_update():
-    """Met à jour le CA mensuel"""
+    """Met à jour les réglages du budget: ca_mensuel, budget_percent, cout_livraison (au moins un)"""
     data = request.get_json() or {}
-    ca = data.get("ca_mensuel")
+    values = {key: data[key] for key in ("ca_mensuel", "budget_percent", "cout_livraison")
+              if data.get(key) is not None}
 
-    if ca is None:
-        return jsonify({"error": "ca_mensuel requis"}), 400
+    if not values:
+        return jsonify({"error": "ca_mensuel, budget_percent ou cout_livraison requis"}), 400
 
     try:
-        ca = float(ca)
-        if ca < 0:
-            return jsonify({"error": "CA doit être positif"}), 400
-        set_ca_mensuel(ca)
-        return jsonify({"success": True, "ca_mensuel": ca})
-    except ValueError:
-        return jsonify({"error": "CA invalide"}), 400
+        values = {key: float(value) for key, value in values.items()}
+    except (ValueError, TypeError):
+        return jsonify({"error": "Valeur invalide"}), 400
+    if any(value < 0 for value in values.values()):
+        return jsonify({"error": "Les valeurs doivent être positives"}), 400
+
+    settings = set_settings(values)
+    return jsonify({"success": True, **{key: settings[key] for key in SETTINGS_DEFAULTS}})
 
 
 @app.route("/api/test/cleanup", methods=["POST"])
@@ -2481,9 +5903,15 @@ def api_test_fake_bouquets():
             "created": 0
         })
 
-    # Créer les nouveaux bouquets
-    for bouquet in fake_bouquets[:60 - fake_count]:  # Ne pas dépasser 60 au total
-        result = create_bouquet_in_airtable(bouquet)
+    # Créer les nouveaux bouquets (plage d'IDs réservée en une fois)
+    to_create = fake_bouquets[:60 - fake_count]  # Ne pas dépasser 60 au total
+    try:
+        bouquet_ids = reserve_bouquet_ids(len(to_create)) if to_create else []
+    except RuntimeError as e:
+        return jsonify({"message": str(e), "created": 0}), 500
+
+    for bouquet, bouquet_id in zip(to_create, bouquet_ids):
+        result = create_bouquet_in_airtable(bouquet, bouquet_id=bouquet_id)
         if result.get("success"):
             results["created"] += 1
             results["details"].append(f"💐 {bouquet['nom']} ({bouquet['style']}, {bouquet['taille']})")
@@ -2524,7 +5952,10 @@ def api_test_cleanup_bouquets():
             delete_url = f"{url}/{record['id']}"
             resp = req.delete(delete_url, headers=headers)
             if resp.status_code == 200:
+                forget_bouquet(record)
                 deleted += 1
+    if deleted:
+        bump_catalogue_generation()
 
     return jsonify({"deleted": deleted, "message": f"{deleted} bouquets FAKE supprimés"})
 
@@ -2533,7 +5964,7 @@ def api_test_cleanup_bouquets():
 def api_sync():
     """Synchronisation complète Pennylane → Suivi → Clients"""
     try:
-        results = sync_all()
+        results = sync_all(request.args.get("mode"))
         return jsonify(results)
     except Exception as e:
         print(f"[SYNC] Error: {e}")
@@ -2544,7 +5975,7 @@ def api_sync():
 def api_sync_pennylane():
     """Sync Pennylane → Suivi Facturation uniquement"""
     try:
-        results = sync_pennylane_to_suivi()
+        results = sync_pennylane_to_suivi(request.args.get("mode"))
         return jsonify(results)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -2554,9 +5985,71 @@ def api_sync_pennylane():
 def api_sync_clients():
     """Sync Suivi Facturation → Clients (sans parsing IA pour la rapidité)"""
     try:
-        results = sync_suivi_to_clients(skip_parsing=True)
+        results = sync_suivi_to_clients(skip_parsing=True, mode=request.args.get("mode"))
+        return jsonify(results)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/simulation", methods=["GET"])
+def api_simulation():
+    """Simulation de charge sur N semaines (livraisons, tournées, stock, budget)
+
+    Query params: semaines (défaut 12), production_hebdo (bouquets produits par semaine),
+    livreurs (défaut NB_LIVREURS)
+    """
+    try:
+        nb_semaines = min(max(request.args.get("semaines", 12, type=int), 1), SIMULATION_MAX_SEMAINES)
+        production_hebdo = request.args.get("production_hebdo", 0, type=int)
+        nb_livreurs = request.args.get("livreurs", type=int)
+
+        _, _, all_clients = get_existing_clients()
+        settings = get_settings()
+        results = run_planning_task(
+            simulate_capacity, all_clients, get_livraisons(), nb_semaines,
+            stock_initial=len(get_available_bouquets()), production_hebdo=production_hebdo,
+            ca_mensuel=settings["ca_mensuel"], budget_percent=settings["budget_percent"],
+            cout_livraison=settings["cout_livraison"], nb_livreurs=nb_livreurs,
+            today=datetime.now().date()  # dans la clé du cache: la simulation change de jour en jour
+        )
+        return jsonify(results)
+    except Exception as e:
+        print(f"[SIMULATION] Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/planning/echeances", methods=["GET"])
+def api_planning_echeances():
+    """Aperçu des livraisons récurrentes dues dans l'horizon (sans écriture)"""
+    try:
+        horizon = request.args.get("horizon", type=int)
+        return jsonify(generate_recurring_livraisons(horizon, dry_run=True))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/planning/generer", methods=["POST"])
+def api_planning_generer():
+    """Crée les livraisons récurrentes dues dans l'horizon (lots de 10)"""
+    try:
+        horizon = request.args.get("horizon", type=int)
+        return jsonify(generate_recurring_livraisons(horizon))
+    except Exception as e:
+        print(f"[PLANNING] Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/clients/geocode", methods=["POST"])
+def api_geocode_clients():
+    """Géocode les adresses clients (référentiel local) et stocke Latitude/Longitude"""
+    if not CLIENTS_COORDONNEES:
+        return jsonify({"error": "CLIENTS_COORDONNEES désactivé (champs Latitude/Longitude requis dans CLIENTS)"}), 400
+    try:
+        force = request.args.get("force", "").lower() in ("1", "true", "yes")
+        results = geocode_clients(force=force)
         return jsonify(results)
     except Exception as e:
+        print(f"[GEOCODE] Error: {e}")
         return jsonify({"error": str(e)}), 500
 
 
@@ -2706,9 +6199,6 @@ def api_inbox():
         tournees_data = prepare_tournees()
         tournees = tournees_data.get("tournees", [])
 
-        # 4. Grouper les clients en attente par zone pour les mini-tournées
-        clients_par_zone = defaultdict(list)
-
         inbox_clients = []
         for card in cards:
             fields = card.get("fields", {})
@@ -2735,11 +6225,13 @@ def api_inbox():
 
             # Récupérer les infos complémentaires depuis la table Clients
             client_record = clients_by_name.get(client_name.upper())
+            lat, lon = None, None
             if client_record:
                 client_fields = client_record.get("fields", {})
                 # Si pas d'adresse dans Suivi Facturation, prendre celle de Clients
                 if not adresse:
                     adresse = client_fields.get("Adresse", "")
+                    lat, lon = client_fields.get("Latitude"), client_fields.get("Longitude")
                 nb_bouquets = client_fields.get("Nb_Bouquets", 1)
 
             # Calculer zone depuis l'adresse
@@ -2764,6 +6256,8 @@ def api_inbox():
                 "adresse": adresse,
                 "zone": zone,
                 "code_postal": code_postal,
+                "lat": lat,
+                "lon": lon,
                 "nb_bouquets": nb_bouquets,
                 "montant": montant,
                 "notes": notes,
@@ -2773,36 +6267,29 @@ def api_inbox():
             }
 
             inbox_clients.append(client_info)
-            clients_par_zone[zone].append(client_info)
+
+        # 4. Mini-tournées: groupes de clients en attente proches les uns des autres
+        mini_tournees = run_planning_task(propose_mini_tournees, inbox_clients)
+        mini_par_client = {i: mini for mini in mini_tournees for i in mini["indices"]}
 
         # 5. Calculer les options de placement pour chaque client
-        for client in inbox_clients:
-            options = []
-            zone = client["zone"]
-
-            # Option 1: Greffe - existe-t-il une tournée cette semaine dans la même zone?
-            for tournee in tournees:
-                tournee_zones = tournee.get("zones", [])
-                if zone in tournee_zones or zone == "Autre":
-                    # Vérifier s'il reste de la place (< 12 clients)
-                    if tournee.get("nb_clients", 0) < 12:
-                        temps_ajoute = 20  # ~20 min par client
-                        options.append({
-                            "type": "greffe",
-                            "tournee_id": tournee.get("numero"),
-                            "tournee_nom": f"Tournée {tournee.get('numero')} - {tournee.get('jour', 'À planifier')}",
-                            "tournee_jour": tournee.get("jour", "À planifier"),
-                            "temps_ajoute": temps_ajoute,
-                            "nb_clients_tournee": tournee.get("nb_clients", 0)
-                        })
-
-            # Option 2: Mini-tournée - y a-t-il 2+ autres clients en attente dans la même zone?
-            autres_clients_zone = [c for c in clients_par_zone.get(zone, []) if c["card_id"] != client["card_id"]]
-            if len(autres_clients_zone) >= 2:
+        greffes = run_planning_task(compute_greffe_options, inbox_clients, tournees)
+        for i, (client, greffe_options) in enumerate(zip(inbox_clients, greffes)):
+            # Option 1: Greffe - meilleures insertions dans les tournées de la semaine
+            options = list(greffe_options)
+
+            # Option 2: Mini-tournée - le client fait-il partie d'un groupe proposé?
+            mini = mini_par_client.get(i)
+            if mini:
+                autres = [c for k, c in zip(mini["indices"], mini["clients"]) if k != i]
                 options.append({
                     "type": "mini",
-                    "clients_groupables": [{"nom": c["nom"], "adresse": c["adresse"]} for c in autres_clients_zone[:5]],
-                    "nb_clients_groupables": len(autres_clients_zone)
+                    "mini_tournee_id": mini["id"],
+                    "clients_groupables": autres,
+                    "nb_clients_groupables": len(autres),
+                    "ordre": [c["nom"] for c in mini["clients"]],
+                    "distance_km": mini["distance_km"],
+                    "duree_min": mini["duree_min"],
                 })
 
             # Option 3: Filet - toujours disponible
@@ -2820,7 +6307,8 @@ def api_inbox():
             "success": True,
             "total": len(inbox_clients),
             "alertes": sum(1 for c in inbox_clients if c["alerte"]),
-            "clients": inbox_clients
+            "clients": inbox_clients,
+            "mini_tournees": [{k: v for k, v in mini.items() if k != "indices"} for mini in mini_tournees]
         })
 
     except Exception as e:
@@ -2987,7 +6475,7 @@ def analyze_and_create():
     if not data or "image_base64" not in data:
         return jsonify({"error": "image_base64 required"}), 400
     
-    image_upload = upload_to_imgbb(data["image_base64"])
+    image_upload = store_image(data["image_base64"], data.get("media_type", "image/jpeg"))
     image_url = image_upload.get("url")
     
     analysis = analyze_image_with_claude(data["image_base64"], data.get("media_type", "image/jpeg"))
@@ -3002,6 +6490,62 @@ def analyze_and_create():
     return jsonify({"analysis": analysis, "created": result, "image_url": image_url})
 
 
+# Nombre max de photos par requête d'intake groupé (3 lots de VISION_BATCH_SIZE);
+# l'analyse est de toute façon bornée par VISION_DEADLINE, sous le timeout gunicorn
+MAX_BATCH_IMAGES = 12
+
+
+@app.route("/analyze-batch", methods=["POST"])
+def analyze_batch():
+    data = request.json
+    images = (data or {}).get("images")
+    if not images or not all(isinstance(i, dict) and "image_base64" in i for i in images):
+        return jsonify({"error": "images required (liste de {image_base64, media_type})"}), 400
+    if len(images) > MAX_BATCH_IMAGES:
+        return jsonify({"error": f"Maximum {MAX_BATCH_IMAGES} images par requête"}), 400
+
+    return jsonify({"analyses": analyze_images_batch_with_claude(images)})
+
+
+@app.route("/analyze-and-create-batch", methods=["POST"])
+def analyze_and_create_batch():
+    """Intake groupé: stocke, analyse (requêtes multi-images) et crée les bouquets"""
+    data = request.json
+    images = (data or {}).get("images")
+    if not images or not all(isinstance(i, dict) and "image_base64" in i for i in images):
+        return jsonify({"error": "images required (liste de {image_base64, media_type, nom})"}), 400
+    if len(images) > MAX_BATCH_IMAGES:
+        return jsonify({"error": f"Maximum {MAX_BATCH_IMAGES} images par requête"}), 400
+
+    analyses = analyze_images_batch_with_claude(images)
+
+    # Une seule réservation d'IDs pour toutes les analyses réussies
+    to_create = [i for i, analysis in enumerate(analyses) if "error" not in analysis]
+    try:
+        bouquet_ids = reserve_bouquet_ids(len(to_create)) if to_create else []
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 500
+    ids_by_position = dict(zip(to_create, bouquet_ids))
+
+    results = []
+    for i, (image, analysis) in enumerate(zip(images, analyses)):
+        if i not in ids_by_position:
+            results.append({"analysis": analysis, "created": None, "image_url": None})
+            continue
+
+        image_url = store_image(image["image_base64"], image.get("media_type", "image/jpeg")).get("url")
+        if image.get("nom"):
+            analysis["nom"] = image["nom"]
+        created = create_bouquet_in_airtable(analysis, image_url, bouquet_id=ids_by_position[i])
+        results.append({"analysis": analysis, "created": created, "image_url": image_url})
+
+    return jsonify({
+        "results": results,
+        "created": sum(1 for r in results if r["created"] and r["created"].get("success")),
+        "errors": sum(1 for r in results if not r["created"] or not r["created"].get("success"))
+    })
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port)